@@ -2,21 +2,27 @@
 # -*- coding: utf-8 -*-
 
 # KCOR_analysis.py
-# Analyze the KCOR_output.xlsx file produced by KCOR.py to compute ASMR (age-standardized mortality rates)
+# Analyze the KCOR output produced by KCOR.py to compute ASMR (age-standardized mortality rates)
 # using Method B (direct standardization) with Czech 5-year age distribution as weights.  
 # The ASMR is computed per Dose group, with confidence intervals, and added as rows with birth_year = 0.
 # The output is saved to KCOR_with_ASMR_byDose.xlsx (configurable via CLI).
-# Usage: python KCOR_analysis.py <input_excel> [output_excel]
+# Input and output can each be a KCOR store (a directory with a Parquet partition per enrollment sheet,
+# see kcor_store.py, much faster) or an .xlsx workbook.
+# Usage: python KCOR_analysis.py <input_store_or_excel> [output_store_or_excel]
 # Example: python KCOR_analysis.py KCOR_output.xlsx KCOR_with_ASMR_byDose.xlsx
-# Requires: pandas, numpy, scipy (for exact Poisson CIs)
+#          python KCOR_analysis.py ../data/KCOR_output ../analysis/KCOR_analysis
+# Requires: pandas, numpy, scipy (for exact Poisson CIs, see rate_ci.py)
 # to run: cd code;make KCOR_analysis
 
-import sys, math
+import sys
 import pandas as pd
 import numpy as np
 from datetime import date
 from pathlib import Path
 
+import kcor_store
+import rate_ci
+
 # ==================== CONFIG ====================
 
 # Standard population weights (5-year starts)
@@ -31,6 +37,7 @@ CZECH_REFERENCE_POP = {
 }
 PT_STD = float(sum(CZECH_REFERENCE_POP.values()))      # constant standard person-time per week
 BUCKETS = sorted(CZECH_REFERENCE_POP.keys())
+WEIGHTS = np.array([CZECH_REFERENCE_POP[b] for b in BUCKETS], dtype=float)   # in BUCKETS order
 ALPHA = 0.05
 Z = 1.959963984540054                                  # ~97.5th percentile (two-sided 95%)
 
@@ -65,31 +72,26 @@ def to_bucket_start(y):
     if y > BUCKETS[-1] + 4: return BUCKETS[-1]
     return y - ((y - BUCKETS[0]) % 5)
 
-def rate_ci_poisson(D, PT, alpha=ALPHA):
-    """95% CI for rate = D/PT. Exact gamma via chi-square if SciPy is available; otherwise log-rate approx."""
-    D = float(D); PT = float(PT)
-    if PT <= 0 or np.isnan(D) or np.isnan(PT):
-        return (np.nan, np.nan)
-    if D == 0:
-        return (0.0, -math.log(alpha) / PT)  # exact upper bound at zero deaths
-    try:
-        from scipy.stats import chi2
-        lo = 0.5 * chi2.ppf(alpha / 2.0, 2.0 * D) / PT
-        hi = 0.5 * chi2.ppf(1.0 - alpha / 2.0, 2.0 * (D + 1.0)) / PT
-        return (lo, hi)
-    except Exception:
-        r = D / PT
-        se_log = 1.0 / math.sqrt(D)
-        return (math.exp(math.log(r) - Z * se_log), math.exp(math.log(r) + Z * se_log))
+def standardize(by_bucket, deaths, person_time):
+    """ASMR (Method B) per (date, Dose) of the bucket totals by_bucket, with its delta-method CI, per 100K person-years."""
+    groups = by_bucket.groupby([COL_DATE, "Dose"])
+    out = groups.size().reset_index()[[COL_DATE, "Dose"]]
+    bucket = np.searchsorted(BUCKETS, by_bucket["bucket"].to_numpy(dtype=float))
+    (rate, lo, hi) = rate_ci.direct_standardized(groups.ngroup().to_numpy(), len(out), bucket,
+                                                 by_bucket[deaths].to_numpy(dtype=float),
+                                                 by_bucket[person_time].to_numpy(dtype=float), WEIGHTS, Z)
+    # Convert to per 100K person-years
+    out["rate"], out["lo"], out["hi"] = rate * 52 * 1e5, lo * 52 * 1e5, hi * 52 * 1e5
+    return out
 
 # ==================== CORE ====================
 
 def process_book(inp_path: str, out_path: str):
-    xls = pd.ExcelFile(inp_path)
-    writer = pd.ExcelWriter(out_path, engine="xlsxwriter")
+    # inp_path and out_path are KCOR stores (a Parquet partition per enrollment sheet, see kcor_store.py)
+    # or .xlsx workbooks
+    writer = kcor_store.writer(out_path)
 
-    for sheet in xls.sheet_names:
-        df = pd.read_excel(inp_path, sheet_name=sheet)
+    for (sheet, df) in kcor_store.iter_tables(inp_path):
 
         # --- Coerce & derive ---
         df = df.copy()
@@ -113,59 +115,33 @@ def process_book(inp_path: str, out_path: str):
 
         # --- CMR & CIs per row (per 100K person-years) ---
         agg["CMR"] = (agg["deaths"] / agg["person_time"]) * 52 * 1e5  # Convert to per 100K person-years
-        ci = agg.apply(lambda r: rate_ci_poisson(r["deaths"], r["person_time"]), axis=1, result_type="expand")
+        (lo, hi) = rate_ci.poisson_rate_ci(agg["deaths"], agg["person_time"], ALPHA)
         # Scale confidence intervals to per 100K person-years
-        agg["CMR_LCL"], agg["CMR_UCL"] = ci[0] * 52 * 1e5, ci[1] * 52 * 1e5
+        agg["CMR_LCL"], agg["CMR_UCL"] = lo * 52 * 1e5, hi * 52 * 1e5
 
         # --- Cumulative by (birth_year, Dose) (per 100K person-years) ---
         agg["cum_deaths"] = agg.groupby(["birth_year","Dose"])["deaths"].cumsum()
         agg["cum_person_time"] = agg.groupby(["birth_year","Dose"])["person_time"].cumsum()
         agg["CUM_CMR"] = (agg["cum_deaths"] / agg["cum_person_time"]) * 52 * 1e5  # Convert to per 100K person-years
-        cum_ci = agg.apply(lambda r: rate_ci_poisson(r["cum_deaths"], r["cum_person_time"]), axis=1, result_type="expand")
+        (lo, hi) = rate_ci.poisson_rate_ci(agg["cum_deaths"], agg["cum_person_time"], ALPHA)
         # Scale cumulative confidence intervals to per 100K person-years
-        agg["CUM_CMR_LCL"], agg["CUM_CMR_UCL"] = cum_ci[0] * 52 * 1e5, cum_ci[1] * 52 * 1e5
+        agg["CUM_CMR_LCL"], agg["CUM_CMR_UCL"] = lo * 52 * 1e5, hi * 52 * 1e5
 
         # ---------- ASMR rows per Dose (birth_year = 0), Method B ----------
         tmp = agg.copy()
         tmp["bucket"] = tmp["birth_year"].apply(to_bucket_start)
         tmp = tmp[~tmp["bucket"].isna()]  # exclude unknown birth years from ASMR
 
-        weights = pd.DataFrame({"bucket": list(CZECH_REFERENCE_POP.keys()),
-                                "w": list(CZECH_REFERENCE_POP.values())})
-
         # Bucket totals per (date, dose)
         by_bucket = tmp.groupby([COL_DATE, "Dose", "bucket"], as_index=False).agg(
             deaths=("deaths", "sum"),
             person_time=("person_time", "sum"),
         )
-        by_bucket["rate"] = by_bucket["deaths"] / by_bucket["person_time"]
-        merged = by_bucket.merge(weights, on="bucket", how="left")
-
-        # Weekly ASMR per (date, dose) with delta-method CI; plus standardized deaths (Method B)
-        asmr_rows = []
-        for (dt, dose), sub_all in merged.groupby([COL_DATE, "Dose"]):
-            sub = sub_all[sub_all["person_time"] > 0]
-            if sub.empty:
-                asmr_rows.append((dt, dose, np.nan, np.nan, np.nan))
-                continue
-            W = sub["w"].sum()
-            ASMR = (sub["w"] * sub["rate"]).sum() / W
-            # delta method: Var(ASMR) ≈ sum ((w_i/W)^2 * D_i / PT_i^2)
-            var = ((sub["w"]/W)**2 * (sub["deaths"] / (sub["person_time"]**2).replace(0,np.nan))).sum()
-            var = float(var) if np.isfinite(var) else np.nan
-            if np.isfinite(var) and var >= 0:
-                se = math.sqrt(var)
-                lo = max(0.0, ASMR - Z * se)
-                hi = ASMR + Z * se
-            else:
-                lo = hi = np.nan
-            # Convert ASMR to per 100K person-years
-            ASMR_per_100k = ASMR * 52 * 1e5 if np.isfinite(ASMR) else np.nan
-            lo_per_100k = lo * 52 * 1e5 if np.isfinite(lo) else np.nan
-            hi_per_100k = hi * 52 * 1e5 if np.isfinite(hi) else np.nan
-            asmr_rows.append((dt, dose, ASMR_per_100k, lo_per_100k, hi_per_100k))
-
-        asmr_df = pd.DataFrame(asmr_rows, columns=[COL_DATE, "Dose", "ASMR", "ASMR_LCL", "ASMR_UCL"]).sort_values(["Dose", COL_DATE])
+
+        # Weekly ASMR per (date, dose) with delta-method CI (Method B)
+        asmr_df = standardize(by_bucket, "deaths", "person_time")
+        asmr_df = asmr_df.rename(columns={"rate": "ASMR", "lo": "ASMR_LCL", "hi": "ASMR_UCL"})
+        asmr_df = asmr_df.sort_values(["Dose", COL_DATE])
         # Calculate cumulative ASMR directly from weekly rates
         asmr_df["week_index"] = asmr_df.groupby("Dose").cumcount() + 1
         asmr_df["ASMR_cum_CMR"] = asmr_df.groupby("Dose")["ASMR"].expanding().mean().reset_index(level=0, drop=True)
@@ -174,31 +150,9 @@ def process_book(inp_path: str, out_path: str):
         by_bucket = by_bucket.sort_values([ "Dose", COL_DATE, "bucket"])
         by_bucket["cum_deaths"] = by_bucket.groupby(["Dose","bucket"])["deaths"].cumsum()
         by_bucket["cum_pt"]     = by_bucket.groupby(["Dose","bucket"])["person_time"].cumsum()
-        by_bucket["cum_rate"]   = by_bucket["cum_deaths"] / by_bucket["cum_pt"]
-        merged_cum = by_bucket.merge(weights, on="bucket", how="left")
-
-        cum_ci_rows = []
-        for (dt, dose), sub_all in merged_cum.groupby([COL_DATE, "Dose"]):
-            sub = sub_all[sub_all["cum_pt"] > 0]
-            if sub.empty:
-                cum_ci_rows.append((dt, dose, np.nan, np.nan))
-            else:
-                W = sub["w"].sum()
-                ASMR_cum = (sub["w"] * sub["cum_rate"]).sum() / W
-                var = ((sub["w"]/W)**2 * (sub["cum_deaths"] / (sub["cum_pt"]**2).replace(0,np.nan))).sum()
-                var = float(var) if np.isfinite(var) else np.nan
-                if np.isfinite(var) and var >= 0:
-                    se = math.sqrt(var)
-                    lo = max(0.0, ASMR_cum - Z * se)
-                    hi = ASMR_cum + Z * se
-                    # Convert to per 100K person-years
-                    lo_per_100k = lo * 52 * 1e5
-                    hi_per_100k = hi * 52 * 1e5
-                else:
-                    lo_per_100k = hi_per_100k = np.nan
-                cum_ci_rows.append((dt, dose, lo_per_100k, hi_per_100k))
-
-        cum_ci_df = pd.DataFrame(cum_ci_rows, columns=[COL_DATE, "Dose", "ASMR_cum_LCL", "ASMR_cum_UCL"])
+
+        cum_ci_df = standardize(by_bucket, "cum_deaths", "cum_pt")
+        cum_ci_df = cum_ci_df.rename(columns={"lo": "ASMR_cum_LCL", "hi": "ASMR_cum_UCL"}).drop(columns="rate")
         asmr_out = asmr_df.merge(cum_ci_df, on=[COL_DATE, "Dose"], how="left")
 
         # Final ASMR rows (birth_year == 0), per Dose
@@ -230,7 +184,7 @@ def process_book(inp_path: str, out_path: str):
             "cum_deaths", "cum_person_time",
         ]
         out = out[[c for c in cols if c in out.columns]]
-        out.to_excel(writer, sheet_name=sheet[:31], index=False)
+        writer.write(sheet, out)
 
     writer.close()
     print(f"Wrote output to: {out_path}")
@@ -239,7 +193,7 @@ def process_book(inp_path: str, out_path: str):
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python KCOR_analysis.py <input_excel> [output_excel]")
+        print("Usage: python KCOR_analysis.py <input_store_or_excel> [output_store_or_excel]")
         print("Example: python KCOR_analysis.py KCOR_output.xlsx KCOR_with_ASMR_byDose.xlsx")
         sys.exit(1)
     inp = Path(sys.argv[1])
@@ -0,0 +1,151 @@
+# Several groupings of one big DataFrame from a single pass
+#
+# vax.py writes seven summaries of the same records, each a
+# df.groupby(cols, dropna=False) over a different set of columns, and each
+# groupby factorized the same string columns of the whole DataFrame again.
+# Here every column is factorized once into integer codes, the rows are
+# counted into a cube of the distinct combinations of all the columns used
+# by any grouping (usually far fewer than the rows), and each grouping is
+# then summed up from the cube cells instead of from the rows.
+#
+# Groups come out in the order groupby(sort=True, dropna=False) gives:
+# sorted by each column in turn, with the missing values last.
+#
+# Example usage:
+#   cube = aggregate.make_cube(df, ['sex', 'age', 'brand_1', 'brand_2'])
+#   (cell_group, keys) = aggregate.group_cells(cube, ['age', 'brand_1'])
+#   keys['shots'] = aggregate.group_sum(cell_group, len(keys), cube.size)
+#
+# GroupSum is the same kind of groupby sum for data that comes a chunk at a
+# time (vax_24.py --chunksize): each chunk is summed by group and the partial
+# sums are merged, so memory goes with the number of groups, not the rows.
+#   total = aggregate.GroupSum(['age', 'brand_1'], ['died'], count='Count')   # dropna=True to leave out missing keys
+#   for chunk in chunks:
+#       total.add(chunk)
+#   summary = total.result()
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# keys are kept below this so the mixed radix products can't overflow int64
+MAX_KEY = 1 << 62
+
+# dims: the column names, uniques: {column: the values, sorted}, codes:
+# {column: code of each cell, len(uniques) for missing}, size: number of
+# rows in each cell, row_cell: cell number of each row
+Cube = namedtuple('Cube', ['dims', 'uniques', 'codes', 'size', 'row_cell'])
+
+
+def factorize(values):
+    # (codes, uniques) with the uniques sorted and the missing values coded len(uniques)
+    codes, uniques = pd.factorize(values, sort=True)
+    codes[codes < 0] = len(uniques)
+    return (codes, uniques)
+
+
+def combine(codes, sizes):
+    # one int64 key per row for several code arrays, ordered like the rows
+    # sorted by the codes in turn. When the key range gets too big the keys
+    # so far are renumbered densely, which keeps their order.
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    n = 1
+    for (c, size) in zip(codes, sizes):
+        if n * size >= MAX_KEY:
+            (uniq, key) = np.unique(key, return_inverse=True)
+            n = len(uniq)
+        key = key * size + c
+        n *= size
+    return key
+
+
+def make_cube(df, dims):
+    # counts of the rows of df by every combination of the dims columns
+    uniques = {}
+    row_codes = []
+    for dim in dims:
+        (codes, uniques[dim]) = factorize(df[dim])
+        row_codes.append(codes)
+    key = combine(row_codes, [len(uniques[dim]) + 1 for dim in dims])
+    (cell_keys, first, row_cell) = np.unique(key, return_index=True, return_inverse=True)
+    codes = {dim: c[first] for (dim, c) in zip(dims, row_codes)}
+    size = np.bincount(row_cell, minlength=len(cell_keys))
+    return Cube(dims, uniques, codes, size, row_cell)
+
+
+def cell_histogram(cube, bins, n_bins):
+    # rows counted by (cell, bin) for the rows with a bin below n_bins, as
+    # (cells, bins, counts) arrays of the nonzero ones. For measures that
+    # only a few rows have, like deaths.
+    bins = np.asarray(bins)
+    keep = bins < n_bins
+    key = cube.row_cell[keep].astype(np.int64) * n_bins + bins[keep]
+    (key, counts) = np.unique(key, return_counts=True)
+    return (key // n_bins, key % n_bins, counts)
+
+
+def group_cells(cube, dims):
+    # (cell_group, keys): the group number of each cube cell for a grouping
+    # by dims, and a DataFrame of the dims values of each group in groupby order
+    key = combine([cube.codes[dim] for dim in dims], [len(cube.uniques[dim]) + 1 for dim in dims])
+    (group_keys, first, cell_group) = np.unique(key, return_index=True, return_inverse=True)
+    keys = {}
+    for dim in dims:
+        values = pd.Series(cube.uniques[dim])
+        codes = cube.codes[dim][first]
+        if (codes == len(values)).any():
+            values = values.reindex(range(len(values) + 1))   # NaN for the missing code
+        keys[dim] = values.take(codes).reset_index(drop=True)
+    return (cell_group, pd.DataFrame(keys))
+
+
+def group_sum(cell_group, n_groups, weights):
+    # sum of a per cell measure (like cube.size) for each group
+    return np.bincount(cell_group, weights=weights, minlength=n_groups).astype(np.asarray(weights).dtype)
+
+
+class GroupSum:
+    # Running groupby(index, dropna=dropna)[values].sum() over the DataFrames
+    # given to add(), plus the number of rows in each group as a count
+    # column if count is given. Sums of sums are sums, so the partial sums
+    # are merged whenever they hold more rows than merge_rows (and at the end).
+    def __init__(self, index, values, count=None, dropna=False, merge_rows=1_000_000):
+        self.index = list(index)
+        self.values = list(values)
+        self.count = count
+        self.dropna = dropna
+        self.merge_rows = merge_rows
+        self.parts = []
+        self.rows = 0
+
+    def add(self, df):
+        groups = df.groupby(self.index, dropna=self.dropna, observed=True)
+        part = groups[self.values].sum() if self.values else pd.DataFrame(index=groups.size().index)
+        if self.count:
+            part[self.count] = groups.size()
+        part = part.reset_index()
+        for col in self.index:
+            # each chunk has its own categories, plain values merge across chunks
+            if isinstance(part[col].dtype, pd.CategoricalDtype):
+                part[col] = part[col].astype(object)
+        self.parts.append(part)
+        self.rows += len(part)
+        if self.rows > self.merge_rows:
+            self.merge()
+
+    def merge(self):
+        # the parts summed into one, in groupby order
+        if len(self.parts) > 1:
+            merged = pd.concat(self.parts, ignore_index=True)
+            self.parts = [merged.groupby(self.index, dropna=False, sort=True).sum().reset_index()]
+        self.rows = len(self.parts[0]) if self.parts else 0
+        # merge again only when the parts have grown well past the merged size
+        self.merge_rows = max(self.merge_rows, 2 * self.rows)
+
+    def result(self):
+        # DataFrame of the index columns and the sums, one row per group
+        self.merge()
+        if not self.parts:
+            return pd.DataFrame(columns=self.index + self.values + ([self.count] if self.count else []))
+        return self.parts[0]
@@ -0,0 +1,171 @@
+# Mortality by vaccine lot group from the CR format source file
+#
+# Generalizes batch_filter_safe.awk and batch_filter_unsafe.awk, which each
+# had a few Pfizer lot numbers hardcoded and needed an awk run per list.
+# Here the lot lists come from a config file (batch_lots.json), every dose
+# record is tagged with its lot group in one pass over the file, and the
+# output is person-days alive and deaths by week since the dose for every
+# lot group, so comparing hundreds of lots is still a single scan.
+#
+# Follow up for a dose starts on the dose day and ends the day before the
+# person's next dose, on the death day or on the last date in the file,
+# whichever comes first, and at most --weeks weeks. A death is counted in
+# its week since the dose if it's within the follow up.
+#
+# Example usage:
+# python batch_lots.py ../data/CR_records.csv >../data/batch_lots.csv
+# python batch_lots.py ../data/CR_records.csv --doses 1 --by-lot --weeks 52 >../data/batch_lots_dose1.csv
+# python batch_lots.py ../data/CR_records.csv --select unsafe >unsafe.csv   # the rows batch_filter_unsafe.awk printed
+#
+# Output columns: group, dose, week, person_days, deaths
+
+import argparse
+import csv
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+import date_codec
+import xz_reader
+
+CONFIG = 'batch_lots.json'
+N_DOSES = 7
+
+# column numbers in the CR format
+DEATH_COL = 2
+
+
+def date_col(dose):
+    return 3 + (dose - 1) * 4
+
+
+def lot_col(dose):
+    return 4 + (dose - 1) * 4
+
+
+def load_groups(fname=CONFIG, by_lot=False):
+    # {lot: group name} from the config file, with by_lot every lot is its own group
+    with open(fname) as f:
+        groups = json.load(f)['groups']
+    lot_group = {}
+    for (group, lots) in groups.items():
+        for lot in lots:
+            if lot in lot_group and lot_group[lot] != group:
+                print(f'WARNING: lot {lot} is in groups {lot_group[lot]} and {group}, using {group}', file=sys.stderr)
+            lot_group[lot] = lot if by_lot else group
+    return lot_group
+
+
+class LotIndex:
+    # hashed lot -> group number lookup for whole columns
+    def __init__(self, lot_group):
+        self.names = sorted(set(lot_group.values()))
+        self.lots = pd.Index(list(lot_group))
+        self.codes = np.array([self.names.index(lot_group[lot]) for lot in self.lots], dtype=np.int32)
+
+    def tag(self, lots):
+        # group number for each lot, -1 if it's not in any group
+        pos = self.lots.get_indexer(lots)
+        return np.where(pos >= 0, self.codes[pos], -1)
+
+
+def strip(values):
+    return pd.Series(values).str.strip().to_numpy()
+
+
+def read_doses(fname, index, doses):
+    # the tagged dose records as arrays (group, dose, dose day, next dose
+    # day, death day) and the last date in the file
+    parts = []
+    last_date = 0
+    for chunk in xz_reader.iter_chunks(fname, dtype=str, keep_default_na=False):
+        cols = [chunk.iloc[:, i].to_numpy() for i in range(chunk.shape[1])]
+        death = date_codec.parse_column(strip(cols[DEATH_COL]), 'ymd-')
+        dates = np.stack([date_codec.parse_column(strip(cols[date_col(d)]), 'ymd-') for d in range(1, N_DOSES + 1)], axis=1)
+        # the day of the next dose after each dose (NO_DATE if none)
+        later = np.minimum.accumulate(dates[:, ::-1], axis=1)[:, ::-1]
+        next_day = np.concatenate([later[:, 1:], np.full((len(chunk), 1), date_codec.NO_DATE, dtype=np.int32)], axis=1)
+
+        for days in [death, dates]:
+            dated = days[days != date_codec.NO_DATE]
+            last_date = max(last_date, int(dated.max(initial=0)))
+
+        for d in doses:
+            group = index.tag(strip(cols[lot_col(d)]))
+            keep = (group >= 0) & (dates[:, d - 1] != date_codec.NO_DATE)
+            parts.append((group[keep], np.full(int(keep.sum()), d, dtype=np.int32),
+                          dates[keep, d - 1], next_day[keep, d - 1], death[keep]))
+
+    if not parts:
+        return ([np.zeros(0, dtype=np.int32)] * 5, last_date)
+    return ([np.concatenate(p) for p in zip(*parts)], last_date)
+
+
+def lot_table(group, dose, day, next_day, death, last_date, n_groups, n_weeks):
+    # (person_days, deaths) arrays of shape (n_groups, N_DOSES, n_weeks)
+    day = day.astype(np.int64)
+    death = death.astype(np.int64)
+    end = np.minimum.reduce([next_day.astype(np.int64) - 1, death, np.full(len(day), last_date), day + n_weeks * 7 - 1])
+    length = np.maximum(end - day + 1, 0)
+    cell = (group.astype(np.int64) * N_DOSES + dose - 1) * (n_weeks + 1)
+    size = n_groups * N_DOSES * (n_weeks + 1)
+
+    # each record adds 7 days to every week it saw in full and the rest
+    # of its days to the week it ended in. n_full counts the records by
+    # full weeks, the reverse cumsum turns that into records per week.
+    full = length // 7
+    n_full = np.bincount(cell + full, minlength=size).reshape(-1, n_weeks + 1)
+    past = np.cumsum(n_full[:, ::-1], axis=1)[:, ::-1]
+    rest = np.bincount(cell + full, weights=length % 7, minlength=size).reshape(-1, n_weeks + 1)
+    person_days = 7 * past[:, 1:] + rest[:, :-1].astype(np.int64)
+
+    died = (death >= day) & (death <= end)
+    week = (death[died] - day[died]) // 7
+    deaths = np.bincount(cell[died] + week, minlength=size).reshape(-1, n_weeks + 1)[:, :-1]
+
+    shape = (n_groups, N_DOSES, n_weeks)
+    return (person_days.reshape(shape), deaths.reshape(shape))
+
+
+def write_table(names, person_days, deaths, out_file=sys.stdout):
+    writer = csv.writer(out_file)
+    writer.writerow(['group', 'dose', 'week', 'person_days', 'deaths'])
+    for (g, d, w) in zip(*np.nonzero(person_days + deaths)):
+        writer.writerow([names[g], d + 1, w, person_days[g, d, w], deaths[g, d, w]])
+
+
+def select_rows(fname, index, group, dose=1, out_file=sys.stdout):
+    # writes the rows whose lot for dose is in the group, like the awk scripts did for dose 1
+    g = index.names.index(group)
+    header = True
+    for chunk in xz_reader.iter_chunks(fname, dtype=str, keep_default_na=False):
+        mask = index.tag(strip(chunk.iloc[:, lot_col(dose)].to_numpy())) == g
+        chunk[mask].to_csv(out_file, header=header, index=False)
+        header = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Person-days and deaths by week since dose for each vaccine lot group.")
+    parser.add_argument('fname', help='CR format records file (can be the .xz)')
+    parser.add_argument('--config', default=CONFIG, help=f'lot groups (default {CONFIG})')
+    parser.add_argument('--by-lot', action='store_true', help='make each lot in the config its own group')
+    parser.add_argument('--doses', type=int, nargs='+', default=list(range(1, N_DOSES + 1)), help='doses to tag (default all)')
+    parser.add_argument('--weeks', type=int, default=104, help='weeks of follow up after each dose (default 104)')
+    parser.add_argument('--select', metavar='GROUP', default=None,
+                        help="instead of the table, write the rows whose dose 1 lot is in GROUP (like batch_filter_*.awk)")
+    args = parser.parse_args()
+
+    index = LotIndex(load_groups(args.config, args.by_lot))
+    print(f'{len(index.lots)} lots in {len(index.names)} groups', file=sys.stderr)
+
+    if args.select is not None:
+        if args.select not in index.names:
+            parser.error(f"no group {args.select} in {args.config}, choose from {', '.join(index.names)}")
+        select_rows(args.fname, index, args.select)
+    else:
+        ((group, dose, day, next_day, death), last_date) = read_doses(args.fname, index, args.doses)
+        print(f"{len(group)} tagged doses, data ends {date_codec.format_day(last_date, 'ymd-')}", file=sys.stderr)
+        (person_days, deaths) = lot_table(group, dose, day, next_day, death, last_date, len(index.names), args.weeks)
+        write_table(index.names, person_days, deaths)
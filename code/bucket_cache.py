@@ -0,0 +1,273 @@
+# Cache for the (alive_ct, dead_ct) bucket counts computed by buckets.py
+#
+# buckets.py used to pickle its results to <prefix>.pickle and reuse that file
+# whenever it existed, even if the records file or the arguments had changed.
+# Here each result is stored under a key made from
+#   - a hash of the content of the records file (or of every file in a records dataset)
+#   - a hash of the arguments that change the counts (n_vax, FILTER, dataset filters)
+#   - a hash of the code the counts depend on (CODE_FILES: buckets.py and the
+#     date parsing and dataset reading it uses), so changing it starts fresh
+# Entries are directories with one .npy file per column (month, dose, batch,
+# week, age, alive, dead) plus a meta.json, and are loaded memory mapped.
+#
+# Example usage (run from the code directory):
+#   python bucket_cache.py list
+#   python bucket_cache.py verify
+#   python bucket_cache.py evict --older-than 30 --max-size 2000
+#
+# The default cache directory is ../data/bucket_cache
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+CACHE_DIR = '../data/bucket_cache'
+
+# bump if the layout of an entry changes
+CACHE_FORMAT = 1
+
+COLUMNS = ['month', 'dose', 'batch', 'week', 'age', 'alive', 'dead']
+
+# the modules (in the code directory) whose code changes the counts
+CODE_FILES = ['buckets.py', 'date_codec.py', 'records_store.py']
+
+# remembers the content hash of each input file by (size, mtime) so we
+# don't re-read a multi-GB file just to look up its cache entry
+HASH_MEMO = 'file_hashes.json'
+
+
+def read_memo(memo_path):
+    # the hash memo, empty if there is none or it can't be read (it's only
+    # a shortcut, the hashes are computed again)
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return memo if isinstance(memo, dict) else {}
+
+
+def write_memo(memo_path, memo):
+    # written to a temp file and renamed, so runs at the same time (make -j)
+    # never leave a half written memo behind
+    (fd, tmp_path) = tempfile.mkstemp(prefix=HASH_MEMO + '.', suffix='.tmp', dir=os.path.dirname(memo_path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(memo, f, indent=1)
+        os.replace(tmp_path, memo_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def file_hash(fname, block_size=1 << 20):
+    # sha256 of the content of a file
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def input_hash(fname, cache_dir=CACHE_DIR):
+    # content hash of the input file, reusing the last one we computed if
+    # the file has the same size and modification time. For a directory
+    # (a records dataset) it's a hash of the names and hashes of its files.
+    if os.path.isdir(fname):
+        h = hashlib.sha256()
+        for (root, dirs, files) in sorted(os.walk(fname)):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                h.update(f'{os.path.relpath(path, fname)}:{input_hash(path, cache_dir)}\n'.encode())
+        return h.hexdigest()
+    st = os.stat(fname)
+    memo_path = os.path.join(cache_dir, HASH_MEMO)
+    memo = read_memo(memo_path)
+    path = os.path.abspath(fname)
+    entry = memo.get(path)
+    if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+        return entry['sha256']
+    print(f'hashing {fname}...')
+    digest = file_hash(fname)
+    memo = read_memo(memo_path)   # again, another run may have added to it meanwhile
+    memo[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    write_memo(memo_path, memo)
+    return digest
+
+
+def code_version():
+    # hash of the names and content hashes of CODE_FILES, which do the counting
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for name in CODE_FILES:
+        h.update(f'{name}:{file_hash(os.path.join(code_dir, name))}\n'.encode())
+    return h.hexdigest()
+
+
+def args_hash(args):
+    # args is a dict of the arguments that change the counts
+    return hashlib.sha256(json.dumps(args, sort_keys=True).encode()).hexdigest()
+
+
+def cache_key(fname, args, cache_dir=CACHE_DIR):
+    # returns (key, meta) for the input file and arguments
+    meta = {
+        'format': CACHE_FORMAT,
+        'input': os.path.abspath(fname),
+        'input_sha256': input_hash(fname, cache_dir),
+        'args': args,
+        'code_sha256': code_version(),
+    }
+    key = hashlib.sha256(f"{meta['format']}:{meta['input_sha256']}:{args_hash(args)}:{meta['code_sha256']}".encode())
+    return key.hexdigest()[:32], meta
+
+
+def entry_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key)
+
+
+def store(key, meta, cols, cache_dir=CACHE_DIR):
+    # write the bucket table, a dict {column: array} of the COLUMNS (see
+    # buckets.BucketTable). Written to a temp directory and renamed so a
+    # killed run never leaves a half written entry behind.
+    cols = {'month': np.asarray(cols['month'], dtype='U7'),
+            **{name: np.asarray(cols[name], dtype=np.int64) for name in COLUMNS[1:]}}
+    path = entry_path(key, cache_dir)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    files = {}
+    for name in COLUMNS:
+        fname = os.path.join(tmp_path, name + '.npy')
+        np.save(fname, cols[name])
+        files[name] = file_hash(fname)
+    meta = dict(meta, rows=len(cols['alive']), files=files,
+                created=datetime.datetime.now().isoformat(timespec='seconds'))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load(key, cache_dir=CACHE_DIR):
+    # returns the bucket table as a dict {column: memory mapped array}, or
+    # None if there is no entry for the key
+    path = entry_path(key, cache_dir)
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    cols = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+    os.utime(meta_path)   # last used time, for evict
+    return cols
+
+
+def entries(cache_dir=CACHE_DIR):
+    # (key, meta, size in bytes, last used time) for every entry
+    result = []
+    if not os.path.isdir(cache_dir):
+        return result
+    for key in sorted(os.listdir(cache_dir)):
+        meta_path = os.path.join(cache_dir, key, 'meta.json')
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path) as f:
+            meta = json.load(f)
+        size = sum(os.path.getsize(os.path.join(cache_dir, key, n)) for n in os.listdir(os.path.join(cache_dir, key)))
+        result.append((key, meta, size, os.path.getmtime(meta_path)))
+    return result
+
+
+def list_entries(cache_dir=CACHE_DIR):
+    total = 0
+    for (key, meta, size, used) in entries(cache_dir):
+        total += size
+        used = datetime.datetime.fromtimestamp(used).strftime('%Y-%m-%d %H:%M')
+        print(f"{key}  {size / 1e6:9.1f} MB  {meta['rows']:>10} buckets  used {used}  {meta['input']} {meta['args']}")
+    print(f'total {total / 1e6:.1f} MB')
+
+
+def verify_entries(cache_dir=CACHE_DIR):
+    # checks the column files against the hashes in meta.json, and reports
+    # entries whose input file or counting code (CODE_FILES) have changed since (stale)
+    n_bad = 0
+    code = code_version()
+    for (key, meta, size, used) in entries(cache_dir):
+        problems = []
+        for name in COLUMNS:
+            fname = os.path.join(cache_dir, key, name + '.npy')
+            if not os.path.exists(fname):
+                problems.append(f'missing {name}.npy')
+            elif file_hash(fname) != meta['files'][name]:
+                problems.append(f'{name}.npy is corrupt')
+            elif len(np.load(fname, mmap_mode='r')) != meta['rows']:
+                problems.append(f'{name}.npy has the wrong length')
+        if problems:
+            n_bad += 1
+            print(f"{key}  BAD: {', '.join(problems)}")
+            continue
+        notes = []
+        if meta['code_sha256'] != code:
+            notes.append('counting code changed')
+        if not os.path.exists(meta['input']):
+            notes.append('input file is gone')
+        elif input_hash(meta['input'], cache_dir) != meta['input_sha256']:
+            notes.append('input file changed')
+        print(f"{key}  ok{' (stale: ' + ', '.join(notes) + ')' if notes else ''}")
+    return n_bad
+
+
+def evict(older_than=None, max_size=None, stale=False, cache_dir=CACHE_DIR):
+    # older_than is in days since last used, max_size in MB (the least
+    # recently used entries go first), stale removes entries made by older
+    # counting code
+    now = time.time()
+    code = code_version()
+    remaining = []
+    for (key, meta, size, used) in sorted(entries(cache_dir), key=lambda e: e[3], reverse=True):
+        if older_than is not None and now - used > older_than * 86400:
+            reason = 'not used in %d days' % older_than
+        elif stale and meta['code_sha256'] != code:
+            reason = 'stale'
+        else:
+            remaining.append((key, size))
+            continue
+        print(f'evicting {key} ({reason})')
+        shutil.rmtree(entry_path(key, cache_dir))
+    if max_size is not None:
+        total = 0
+        for (key, size) in remaining:
+            total += size
+            if total > max_size * 1e6:
+                print(f'evicting {key} (over {max_size} MB)')
+                shutil.rmtree(entry_path(key, cache_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the buckets.py result cache.")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'cache directory (default {CACHE_DIR})')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='list the cache entries')
+    sub.add_parser('verify', help='check the entries and report stale ones')
+    p = sub.add_parser('evict', help='remove entries by age, total size or staleness')
+    p.add_argument('--older-than', type=float, default=None, help='remove entries not used in this many days')
+    p.add_argument('--max-size', type=float, default=None, help='keep the most recently used entries within this many MB')
+    p.add_argument('--stale', action='store_true', help='remove entries made by older counting code (CODE_FILES)')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        list_entries(args.cache_dir)
+    elif args.command == 'verify':
+        if verify_entries(args.cache_dir):
+            sys.exit(1)
+    elif args.command == 'evict':
+        evict(args.older_than, args.max_size, args.stale, args.cache_dir)
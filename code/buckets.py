@@ -1,17 +1,29 @@
+import argparse
 import csv
 import datetime
 import bisect
-import os
-import pickle
-import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import bucket_cache
+import date_codec
+import records_store
 
 ##################################################
 # USAGE
 # python buckets.py <src_file.csv> <optional prefix> <optional vax count> <optional fitler flag>
 # src_file.csv is the file you want processed, has to be in the format of the NZ data
-# prefix - as a prefix to the output files and also for the pickle cache
+# prefix - as a prefix to the output files
 # vax count - only process people with exactly a certain number of doses
 # filter flag - 'FILTER' if you want to filter people who may have skipped a dose
+# --columnar - keep the records in NumPy arrays instead of dicts, use this for the full file
+# --vax-year/--dose/--vax-code - partitions to read when src is a records dataset (uses the columnar mode)
+# --workers N - count the buckets in N processes (uses the columnar mode, also for N = 1)
+# --groupings raw,no_batch,... - which outputs to write (see GROUPINGS), all for every one
+# results are cached in ../data/bucket_cache (see bucket_cache.py), --no-cache to skip it
 ##################################################
 
 # Don't judge me here, these are global because I wrote it just
@@ -38,7 +50,7 @@ all_dates = set()
 def read_nov9_csv(fname):
     # if we don't have a death date, then we use today for the age
     today = datetime.date.today()
-    date_sep_char = None
+    date_fmt = None
 
     with open(fname, 'r') as file:
         reader = csv.reader(file)
@@ -48,17 +60,14 @@ def read_nov9_csv(fname):
             # determine if - or / is the date separator
             # once we find one, we keep it the same for
             # the whole file
-            if date_sep_char is None:
+            if date_fmt is None:
                 # we check death, vax, and birth dates for a valid date
                 # first one wins
                 for test_row in [4, 5, 6]:
-                    if '-' in row[test_row]:
-                        date_sep_char = '-'
-                        break
-                    if '/' in row[test_row]:
-                        date_sep_char = '/'
+                    date_fmt = date_codec.detect_format(row[test_row])
+                    if date_fmt is not None:
                         break
-            if date_sep_char is None:
+            if date_fmt is None:
                 continue
             # the unique identifer for the person, typically
             # this is the obfuscated MRN or something like that
@@ -72,8 +81,7 @@ def read_nov9_csv(fname):
 
             # vax date
             if len(row[5]) > 0:
-                (m, d, y) = row[3].split(date_sep_char)
-                vax_date = datetime.date(int(y), int(m), int(d))
+                vax_date = date_codec.parse_date(row[3], date_fmt)
                 if pid not in vax_dates:
                     vax_dates[pid] = []
                 bisect.insort(vax_dates[pid], (vax_date, vax_dose, vax_batch))
@@ -82,8 +90,7 @@ def read_nov9_csv(fname):
 
             # death date
             if len(row[4]) > 0:
-                (m, d, y) = row[4].split(date_sep_char)
-                death_date = datetime.date(int(y), int(m), int(d))
+                death_date = date_codec.parse_date(row[4], date_fmt)
                 if pid in death_dates and death_dates[pid] != death_date:
                     print(f'WARNING: death date for #{pid} is not consistent')
                 death_dates[pid] = death_date
@@ -94,8 +101,7 @@ def read_nov9_csv(fname):
                 death_date = today
 
             # birth date
-            (m, d, y) = row[6].split(date_sep_char)
-            birth_date = datetime.date(int(y), int(m), int(d))
+            birth_date = date_codec.parse_date(row[6], date_fmt)
             tmp_age = (death_date - birth_date).days // 365
             if pid in vax_age and vax_age[pid] != tmp_age:
                 print(f'WARNING: age for #{pid} is not consistent')
@@ -109,7 +115,149 @@ def read_nov9_csv(fname):
 #######################################
 
 
+def select_people(n_vax=None):
+    # this does a check for people with a ceartain number of
+    # doses, you probably don't need this, but I used it for
+    # some of my exploration.
+    use_people = set()
+    if n_vax is not None:
+        print(f'filtering for people with exactly {n_vax} doses')
+        for p in list(all_people):
+            if len(vax_dates[p]) == n_vax:
+                add = True
+                for i in range(n_vax):
+                    (vax_date, vax_dose, vax_batch) = vax_dates[p][i]
+                    if vax_dose != i + 1:
+                        add = False
+                        break
+                if add:
+                    use_people.add(p)
+        print(f'{len(use_people)} remaining from {len(all_people)}')
+    else:
+        use_people = all_people.copy()
+    return use_people
+
+
+def next_month(d):
+    # first day of the month after d
+    if d.month == 12:
+        return datetime.date(d.year + 1, 1, 1)
+    return datetime.date(d.year, d.month + 1, 1)
+
+
+def last_bucket_day(death_list, n_people, start_date, end_date):
+    # make_buckets_by_day stops at the first month boundary where nobody
+    # died during the previous month (the count of people still alive didn't
+    # change), otherwise it runs through end_date.  This works out the last
+    # day it processes without walking the days.
+    # death_list is the sorted list of death day numbers (date ordinals)
+    # of the people we use.
+    # On a given day, everyone who died before that day has been removed,
+    # so at the start of a new month, the people still around are the ones
+    # who didn't die or died on/after the last day of the previous month.
+    still_alive = -1    # any value that will never match
+    cur_date = next_month(start_date)
+    while cur_date <= end_date:
+        sa = n_people - bisect.bisect_left(death_list, cur_date.toordinal() - 1)
+        if sa == still_alive:
+            return cur_date - datetime.timedelta(days=1)
+        still_alive = sa
+        cur_date = next_month(cur_date)
+    return end_date
+
+
 def make_buckets(n_vax=None):
+    # Same counts as make_buckets_by_day, but instead of walking every day
+    # and every living person, each person is turned into a handful of
+    # intervals: unvaxxed from the start until their first shot, then from
+    # each shot until the next one. Each interval is cut where the week
+    # since the shot or the calendar month changes, and every piece adds its
+    # number of days to the bucket it falls in. Someone who dies is counted
+    # in the bucket they were in on the day they died.
+
+    # person-days we have someone in each bucket for each month
+    alive_ct = {}
+
+    # people who died in each bucket in each month
+    dead_ct = {}
+
+    use_people = select_people(n_vax)
+
+    # same date range as make_buckets_by_day
+    start_date = datetime.date(2020, 1, 1).replace(day=1)
+    end_date = max(all_dates) + datetime.timedelta(days=60)
+
+    death_list = sorted(death_dates[p].toordinal() for p in use_people if p in death_dates)
+    stop_date = last_bucket_day(death_list, len(use_people), start_date, end_date)
+
+    print(f'processing date range {start_date} to {stop_date}...')
+
+    # work in day numbers and look up the month key and the last day of the
+    # month for each day so we don't do date math for every piece
+    start = start_date.toordinal()
+    stop = stop_date.toordinal()
+    month_key = []
+    month_end = []
+    d = start_date
+    while d <= stop_date:
+        m_end = next_month(d).toordinal() - 1
+        key = f'{d.year:04d}-{d.month:02d}'
+        for _ in range(d.toordinal(), m_end + 1):
+            month_key.append(key)
+            month_end.append(m_end)
+        d = next_month(d)
+
+    for p in use_people:
+        age = vax_age[p]
+        death = death_dates[p].toordinal() if p in death_dates else None
+        last = stop if death is None or death > stop else death
+        if last < start:
+            continue    # died before we start counting
+
+        # (first day, shot day, dose, batch) of each interval. The shots
+        # are sorted, so if two land on the same day the later one wins
+        # just like the reverse search in make_buckets_by_day.
+        intervals = [(start, None, 0, 0)]
+        for (vax_date, vax_dose, vax_batch) in vax_dates.get(p, ()):
+            v = vax_date.toordinal()
+            intervals.append((v, v, vax_dose, vax_batch))
+
+        key = None
+        for i, (first, v, dose, batch) in enumerate(intervals):
+            end = intervals[i + 1][0] - 1 if i + 1 < len(intervals) else last
+            if end > last:
+                end = last
+            day = first if first > start else start
+            while day <= end:
+                piece_end = month_end[day - start]
+                if v is None:
+                    week = 0
+                else:
+                    week = (day - v) // 7
+                    if v + 7 * week + 6 < piece_end:
+                        piece_end = v + 7 * week + 6
+                if end < piece_end:
+                    piece_end = end
+
+                key = (month_key[day - start], dose, batch, week, age)
+                if key not in alive_ct:
+                    alive_ct[key] = 0
+                    dead_ct[key] = 0
+                alive_ct[key] += piece_end - day + 1
+                day = piece_end + 1
+
+        # key is now the bucket they were in on their last day. If they
+        # died before the last day we process, count the death there.
+        if death is not None and death < stop:
+            dead_ct[key] += 1
+
+    return (alive_ct, dead_ct)
+
+
+def make_buckets_by_day(n_vax=None):
+    # The original day by day version of make_buckets. It's far too slow
+    # for the full records file, but it's kept as the reference to check
+    # make_buckets against on small files.
     # This is a pretty inefficient loop, if I did this in a productiong
     # system, I'd use something more fancy.  But for this purpose this
     # is easy to write and easy to verify that it's correct.
@@ -129,25 +277,7 @@ def make_buckets(n_vax=None):
     # was in, so we know where to put them when they die
     last_key = {}
 
-    use_people = set()
-    # this does a check for people with a ceartain number of
-    # doses, you probably don't need this, but I used it for
-    # some of my exploration.
-    if n_vax is not None:
-        print(f'filtering for people with exactly {n_vax} doses')
-        for p in list(all_people):
-            if len(vax_dates[p]) == n_vax:
-                add = True
-                for i in range(n_vax):
-                    (vax_date, vax_dose, vax_batch) = vax_dates[p][i]
-                    if vax_dose != i + 1:
-                        add = False
-                        break
-                if add:
-                    use_people.add(p)
-        print(f'{len(use_people)} remaining from {len(all_people)}')
-    else:
-        use_people = all_people.copy()
+    use_people = select_people(n_vax)
 
     # here are the dates we loop over, I started early when I knew no
     # one would die so that I could make sure I was counting right
@@ -237,17 +367,429 @@ def make_buckets(n_vax=None):
 #######################################
 #######################################
 
+# Columnar mode
+# The dicts and sets above cost gigabytes once the whole country is in the
+# file, so this keeps the same information in NumPy arrays indexed by a
+# person number (0..N-1) instead of by the pid string. Dates are day numbers
+# (date ordinals) and the buckets are counted with bincount over encoded keys.
+
+# date ordinal used for "no date", sorts after every real date
+NO_DATE = date_codec.NO_DATE
+
+# the person table: pid, age and death are per person; the dose_ arrays have
+# one entry per vax record, sorted by (person, date, dose, batch) just like the
+# vax_dates lists. last_date is the latest vax or death date in the file.
+People = namedtuple('People', ['pid', 'age', 'death', 'dose_person', 'dose_date', 'dose', 'batch', 'last_date'])
+
+
+def last_rows(keys):
+    # unique keys and the index of the last row with each key
+    rev_keys, rev_index = np.unique(keys[::-1], return_index=True)
+    return rev_keys, len(keys) - 1 - rev_index
+
+
+def csv_chunks(fname, chunksize):
+    # (pid, batch, dose, death, birth, is_vax, vax date of the is_vax rows)
+    # arrays for each chunk of a records file
+    date_fmt = None
+    reader = pd.read_csv(fname, dtype=str, keep_default_na=False, usecols=range(7), chunksize=chunksize)
+    for chunk in reader:
+        cols = [chunk.iloc[:, i].to_numpy() for i in range(7)]
+        if date_fmt is None:
+            # the first row with a date in the death, vax or birth
+            # column decides the date format for the whole file
+            # and rows before it are skipped
+            for row_num in range(len(chunk)):
+                for test_row in [4, 5, 6]:
+                    date_fmt = date_codec.detect_format(cols[test_row][row_num])
+                    if date_fmt is not None:
+                        break
+                if date_fmt is not None:
+                    break
+            if date_fmt is None:
+                continue
+            cols = [c[row_num:] for c in cols]
+
+        pid = cols[0]
+        try:
+            pid = pid.astype(np.int64)
+        except ValueError:
+            pass    # not numeric, keep the strings
+        is_vax = cols[5] != ''
+        yield (pid, cols[1].astype(np.int64), cols[2].astype(np.int64),
+               date_codec.parse_column(cols[4], date_fmt), date_codec.parse_column(cols[6], date_fmt),
+               is_vax, date_codec.parse_column(cols[3][is_vax], date_fmt))
+
+
+def dataset_chunks(path, filters):
+    # same as csv_chunks for a records dataset (see records_store.py), where
+    # the dates are already day numbers
+    for batch in records_store.iter_batches(path, **filters):
+        is_vax = batch['Vax_name'] != ''
+        yield (batch['mrn'], batch['Vax_code'].astype(np.int64), batch['Dose_number'].astype(np.int64),
+               batch['Death_date'], batch['Birth_date'], is_vax, batch['Vax_date'][is_vax])
+
+
+def read_nov9_columnar(fname, chunksize=2000000, filters=None):
+    # same rules as read_nov9_csv, but everything ends up in arrays.
+    # fname can also be a records dataset, read with the partition filters.
+    today = datetime.date.today().toordinal()
+
+    pids = []
+    row_death = []
+    row_age = []
+    vax_pid = []
+    vax_date = []
+    vax_dose = []
+    vax_batch = []
+
+    if records_store.is_dataset(fname):
+        chunks = dataset_chunks(fname, filters or {})
+    else:
+        chunks = csv_chunks(fname, chunksize)
+    for (pid, batch, dose, death, birth, is_vax, vax_day) in chunks:
+        # age is computed on each row from that row's death date (or today)
+        tmp_age = (np.where(death == NO_DATE, today, death).astype(np.int64) - birth) // 365
+
+        vax_pid.append(pid[is_vax])
+        vax_date.append(vax_day)
+        vax_dose.append(dose[is_vax])
+        vax_batch.append(batch[is_vax])
+
+        pids.append(pid)
+        row_death.append(death)
+        row_age.append(tmp_age)
+
+    if not pids:
+        raise ValueError(f'no dated records found in {fname}')
+
+    # turn the pids into person numbers
+    if any(p.dtype == object for p in pids):
+        pids = [p.astype(str) for p in pids]
+        vax_pid = [p.astype(str) for p in vax_pid]
+    pid, person = np.unique(np.concatenate(pids), return_inverse=True)
+    n_people = len(pid)
+    person = person.astype(np.int32)
+    row_death = np.concatenate(row_death)
+    row_age = np.concatenate(row_age)
+
+    # the last row wins for the age and the death date like the dicts do,
+    # but count the people whose rows don't agree
+    has_death = row_death != NO_DATE
+    death = np.full(n_people, NO_DATE, dtype=np.int32)
+    p, last = last_rows(person[has_death])
+    death[p] = row_death[has_death][last]
+    first_death = np.full(n_people, NO_DATE, dtype=np.int32)
+    np.minimum.at(first_death, person[has_death], row_death[has_death])
+    n_bad = int(np.count_nonzero(first_death[person[has_death]] != row_death[has_death]))
+    if n_bad:
+        print(f'WARNING: death date is not consistent on {n_bad} records')
+
+    age = np.empty(n_people, dtype=np.int32)
+    p, last = last_rows(person)
+    age[p] = row_age[last]
+    n_bad = int(np.count_nonzero(age[person] != row_age))
+    if n_bad:
+        print(f'WARNING: age is not consistent on {n_bad} records')
+
+    # the vax records, sorted per person like the vax_dates lists
+    dose_person = np.searchsorted(pid, np.concatenate(vax_pid)).astype(np.int32)
+    dose_date = np.concatenate(vax_date)
+    dose = np.concatenate(vax_dose)
+    batch = np.concatenate(vax_batch)
+    order = np.lexsort((batch, dose, dose_date, dose_person))
+
+    dated = dose_date != NO_DATE
+    last_date = max(int(dose_date[dated].max(initial=0)), int(death[death != NO_DATE].max(initial=0)))
+
+    return People(pid, age, death, dose_person[order], dose_date[order], dose[order], batch[order], last_date)
+
+
+def select_people_columnar(people, n_vax=None, do_filter=False):
+    # the people to keep as a bool mask. FILTER drops anyone with no
+    # shots or whose doses are not 1, 2, 3... in date order, n_vax keeps
+    # the people with exactly n_vax doses in order.
+    n_people = len(people.age)
+    counts = np.bincount(people.dose_person, minlength=n_people)
+    first = np.cumsum(counts) - counts
+    pos = np.arange(len(people.dose_person)) - first[people.dose_person]
+    n_in_order = np.bincount(people.dose_person, weights=(people.dose == pos + 1), minlength=n_people)
+    in_order = n_in_order == counts
+
+    keep = np.ones(n_people, dtype=bool)
+    if do_filter:
+        print(f'filtering...')
+        keep &= (counts > 0) & in_order
+    print(f'remaining {int(keep.sum())} people')
+    if n_vax is not None:
+        print(f'filtering for people with exactly {n_vax} doses')
+        n_before = int(keep.sum())
+        keep &= (counts == n_vax) & in_order
+        print(f'{int(keep.sum())} remaining from {n_before}')
+    return keep
+
+
+def expand(n):
+    # for counts n, the row each piece came from and its index within that row
+    row = np.repeat(np.arange(len(n)), n)
+    k = np.arange(len(row)) - np.repeat(np.cumsum(n) - n, n)
+    return row, k
+
+
+def pieces_by_week(first, end, v, month_of, month_first, start):
+    # cut each interval [first, end] at the weeks since the shot on day v and
+    # at the month boundaries; returns (row, week, month, days) per piece
+    w0 = (first - v) // 7
+    w1 = (end - v) // 7
+    row, k = expand(w1 - w0 + 1)
+    week = w0[row] + k
+    ps = np.maximum(first[row], v[row] + 7 * week)
+    pe = np.minimum(end[row], v[row] + 7 * week + 6)
+    # a week is never longer than a month so it can span at most two months
+    ms = month_of[ps - start]
+    me = month_of[pe - start]
+    split = ms != me
+    cut = month_first[me]
+    days = np.where(split, cut - ps, pe - ps + 1)
+    return (np.concatenate([row, row[split]]),
+            np.concatenate([week, week[split]]),
+            np.concatenate([ms, me[split]]),
+            np.concatenate([days, (pe - cut + 1)[split]]))
+
+
+def pieces_by_month(first, end, month_of, month_first, month_last, start):
+    # cut each interval [first, end] at the month boundaries
+    m0 = month_of[first - start]
+    m1 = month_of[end - start]
+    row, k = expand(m1 - m0 + 1)
+    month = m0[row] + k
+    days = np.minimum(end[row], month_last[month]) - np.maximum(first[row], month_first[month]) + 1
+    return row, month, days
+
+
+def sum_by_code(code_parts, count_parts):
+    # add up the counts for each distinct code
+    codes, inverse = np.unique(np.concatenate(code_parts), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate(count_parts), minlength=len(codes))
+    return codes, counts.astype(np.int64)
+
+
+# the bucket counts as columns, one entry per (month, dose, batch, week, age) key
+BucketTable = namedtuple('BucketTable', ['month', 'dose', 'batch', 'week', 'age', 'alive', 'dead'])
+
+
+def bucket_dates(people, keep):
+    # the first and last day counted for the people in keep, same rules as make_buckets
+    start_date = datetime.date(2020, 1, 1).replace(day=1)
+    end_date = datetime.date.fromordinal(people.last_date) + datetime.timedelta(days=60)
+
+    death = people.death[keep]
+    death_list = np.sort(death[death != NO_DATE])
+    stop_date = last_bucket_day(death_list, int(keep.sum()), start_date, end_date)
+    print(f'processing date range {start_date} to {stop_date}...')
+    return (start_date, stop_date)
+
+
+def make_buckets_columnar(people, keep):
+    # Same counts as make_buckets, computed on the People arrays, as a BucketTable
+    (start_date, stop_date) = bucket_dates(people, keep)
+    return make_bucket_table(people, keep, start_date, stop_date)
+
+
+def make_bucket_table(people, keep, start_date, stop_date, max_pieces=5000000):
+    # Every interval (unvaxxed until the first shot, then shot to shot) is
+    # cut into pieces that each fall in one bucket, the bucket key is packed
+    # into one int64 and the days are added up with bincount.
+    start = start_date.toordinal()
+    stop = stop_date.toordinal()
+
+    # month number for each day, and the first and last day of each month
+    month_labels = []
+    month_first = []
+    d = start_date
+    while d <= stop_date:
+        month_labels.append(f'{d.year:04d}-{d.month:02d}')
+        month_first.append(d.toordinal())
+        d = next_month(d)
+    month_first = np.array(month_first + [next_month(stop_date).toordinal()], dtype=np.int64)
+    month_last = month_first[1:] - 1
+    month_of = np.repeat(np.arange(len(month_labels)), np.diff(month_first))
+
+    # last day counted for each person, and who is counted at all
+    last = np.minimum(people.death.astype(np.int64), stop)
+    active = keep & (last >= start)
+    if not active.any():
+        return BucketTable(*(np.zeros(0, dtype=t) for t in ['U7'] + [np.int64] * 6))
+
+    # the vax records of the people we count
+    use = active[people.dose_person] & (people.dose_date != NO_DATE)
+    dp = people.dose_person[use]
+    v = people.dose_date[use].astype(np.int64)
+    dose = people.dose[use]
+    batch = people.batch[use]
+
+    # each shot lasts until the day before the next one (if two shots are on
+    # the same day the later one in sort order wins, the other is empty)
+    same = np.zeros(len(dp), dtype=bool)
+    same[:-1] = dp[1:] == dp[:-1]
+    end = last[dp]
+    end[same] = np.minimum(v[1:][same[:-1]] - 1, end[same])
+    first = np.maximum(v, start)
+    ok = first <= end
+
+    # unvaxxed from the start until the first shot
+    zero_person = np.flatnonzero(active)
+    zero_end = last[zero_person]
+    p, first_row = np.unique(dp, return_index=True)
+    has_shot = np.isin(zero_person, p)
+    zero_end[has_shot] = np.minimum(zero_end[has_shot], v[first_row] - 1)
+    zero_ok = zero_end >= start
+    zero_person = zero_person[zero_ok]
+    zero_end = zero_end[zero_ok]
+
+    # pack (month, dose, batch, week, age) into one int64
+    dose_values = np.unique(np.concatenate([[0], dose]))
+    batch_values = np.unique(np.concatenate([[0], batch]))
+    age_min = int(people.age.min())
+    n_week = int((stop - v.min()) // 7 + 1) if len(v) else 1
+    n_age = int(people.age.max()) - age_min + 1
+    radix = (len(dose_values), len(batch_values), n_week, n_age)
+
+    def pack(month, dose_code, batch_code, week, age):
+        code = month.astype(np.int64)
+        for (value, r) in zip((dose_code, batch_code, week, age - age_min), radix):
+            code = code * r + value
+        return code
+
+    code_parts = []
+    day_parts = []
+
+    # vaxxed intervals, a slice at a time so the pieces fit in memory
+    rows = np.flatnonzero(ok)
+    n = (end[rows] - v[rows]) // 7 - (first[rows] - v[rows]) // 7 + 1
+    bounds = np.searchsorted(np.cumsum(n), np.arange(max_pieces, n.sum(), max_pieces))
+    for part in np.split(rows, bounds):
+        (row, week, month, days) = pieces_by_week(first[part], end[part], v[part], month_of, month_first, start)
+        row = part[row]
+        code_parts.append(pack(month,
+                               np.searchsorted(dose_values, dose[row]),
+                               np.searchsorted(batch_values, batch[row]),
+                               week, people.age[dp[row]]))
+        day_parts.append(days)
+
+    # unvaxxed intervals are all week 0 so only the months matter
+    (row, month, days) = pieces_by_month(np.full(len(zero_person), start), zero_end, month_of, month_first, month_last, start)
+    zeros = np.zeros(len(row), dtype=np.int64)
+    code_parts.append(pack(month, np.searchsorted(dose_values, zeros), np.searchsorted(batch_values, zeros),
+                           zeros, people.age[zero_person[row]]))
+    day_parts.append(days)
+
+    (codes, alive) = sum_by_code(code_parts, day_parts)
+
+    # the people who died before the last day are counted in the
+    # bucket they were in on the day they died
+    dead_person = np.flatnonzero(active & (last < stop))
+    dead_day = last[dead_person]
+    lo = min(start, int(v.min())) if len(v) else start
+    span = max(stop, int(v.max())) - lo + 1 if len(v) else stop - lo + 1
+    idx = np.searchsorted(dp.astype(np.int64) * span + (v - lo),
+                          dead_person.astype(np.int64) * span + (dead_day - lo), side='right') - 1
+    vaxxed = (idx >= 0)
+    vaxxed[vaxxed] = dp[idx[vaxxed]] == dead_person[vaxxed]
+    dead_dose = np.zeros(len(dead_person), dtype=np.int64)
+    dead_batch = np.zeros(len(dead_person), dtype=np.int64)
+    dead_week = np.zeros(len(dead_person), dtype=np.int64)
+    dead_dose[vaxxed] = dose[idx[vaxxed]]
+    dead_batch[vaxxed] = batch[idx[vaxxed]]
+    dead_week[vaxxed] = (dead_day[vaxxed] - v[idx[vaxxed]]) // 7
+    dead_codes = pack(month_of[dead_day - start],
+                      np.searchsorted(dose_values, dead_dose), np.searchsorted(batch_values, dead_batch),
+                      dead_week, people.age[dead_person])
+    (dead_codes, dead) = sum_by_code([dead_codes], [np.ones(len(dead_codes))])
+
+    # unpack the keys
+    parts = []
+    rest = codes
+    for r in reversed(radix):
+        parts.append(rest % r)
+        rest = rest // r
+    (age, week, batch_code, dose_code) = parts
+    dead_ct = np.zeros(len(codes), dtype=np.int64)
+    dead_ct[np.searchsorted(codes, dead_codes)] = dead
+    return BucketTable(np.array(month_labels, dtype='U7')[rest], dose_values[dose_code], batch_values[batch_code],
+                       week, age + age_min, alive, dead_ct)
+
+
+def merge_bucket_tables(tables):
+    # add up bucket tables that were counted separately (e.g. for different people)
+    cols = [np.concatenate([t[i] for t in tables]) for i in range(len(BucketTable._fields))]
+    code = np.zeros(len(cols[0]), dtype=np.int64)
+    for col in cols[:5]:
+        (values, inverse) = np.unique(col, return_inverse=True)
+        code = code * len(values) + inverse.ravel()
+    (codes, first, inverse) = np.unique(code, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = [np.bincount(inverse, weights=col, minlength=len(codes)).astype(np.int64) for col in cols[5:]]
+    return BucketTable(*(col[first] for col in cols[:5]), *sums)
+
+
+def bucket_table_to_dicts(table):
+    # the table as alive_ct/dead_ct dicts like make_buckets returns
+    keys = list(zip(table.month.tolist(), table.dose.tolist(), table.batch.tolist(),
+                    table.week.tolist(), table.age.tolist()))
+    return (dict(zip(keys, table.alive.tolist())), dict(zip(keys, table.dead.tolist())))
+
+
+def dicts_to_bucket_table(alive_ct, dead_ct):
+    # the alive_ct/dead_ct dicts of make_buckets as a BucketTable, sorted by key
+    keys = sorted(alive_ct)
+    return BucketTable(np.array([k[0] for k in keys], dtype='U7'),
+                       *(np.array([k[i] for k in keys], dtype=np.int64) for i in range(1, 5)),
+                       np.array([alive_ct[k] for k in keys], dtype=np.int64),
+                       np.array([dead_ct[k] for k in keys], dtype=np.int64))
+
+
+def people_subset(people, mask):
+    # the People table for just the people in mask, renumbered from 0
+    new_index = (np.cumsum(mask) - 1).astype(np.int32)
+    rows = mask[people.dose_person]
+    return People(people.pid[mask], people.age[mask], people.death[mask], new_index[people.dose_person[rows]],
+                  people.dose_date[rows], people.dose[rows], people.batch[rows], people.last_date)
+
+
+def shard_table(args):
+    # worker for make_buckets_sharded
+    (shard, start_date, stop_date) = args
+    return make_bucket_table(shard, np.ones(len(shard.age), dtype=bool), start_date, stop_date)
+
+
+def make_buckets_sharded(people, keep, workers):
+    # The counts just add up over people, so split the people into shards
+    # by a hash of their pid, count each shard in its own process and add
+    # the tables together. The date range is worked out on everybody first
+    # so every shard counts the same days as a single run would.
+    (start_date, stop_date) = bucket_dates(people, keep)
+    shard_of = pd.util.hash_array(people.pid) % workers
+    shards = [people_subset(people, keep & (shard_of == s)) for s in range(workers)]
+    print(f'counting {workers} shards of {", ".join(str(len(s.age)) for s in shards)} people...')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tables = list(pool.map(shard_table, [(s, start_date, stop_date) for s in shards]))
+    return merge_bucket_tables(tables)
+
+
+#######################################
+#######################################
+#######################################
+
 
-def print_buckets(filename, alive, dead, header=None):
-    with open(filename, 'w') as out_file:
-        if header:
-            for h in header:
-                print(h, end='\t', file=out_file)
-            print('alive\tdead', file=out_file)
-        for key in sorted(alive):
-            for e in key:
-                print(e, end='\t', file=out_file)
-            print(f'{alive[key]}\t{dead[key]}', file=out_file)
+def print_buckets(filename, keys, alive, dead, header=None):
+    # a tab separated line per bucket: the key columns, alive, dead. The
+    # buckets must be sorted by key and each key there once.
+    out = pd.DataFrame({i: col for (i, col) in enumerate(keys)})
+    out['alive'] = alive
+    out['dead'] = dead
+    out.to_csv(filename, sep='\t', index=False, header=list(header) + ['alive', 'dead'] if header else False,
+               lineterminator='\n')
 
 
 #######################################
@@ -273,6 +815,7 @@ def regroup_buckets(alive_ct, dead_ct, new_key):
 
     return (alive_group, dead_group)
 
+
 #######################################
 #######################################
 #######################################
@@ -308,121 +851,177 @@ def stratify(weeks, years):
 
 
 def group_steve(key):
-    # a grouping steve wanted
+    # a grouping steve wanted: bin 0 under 4 weeks, 1 under 12, 2 under 24, else 3
     (date_key, dose, batch, week, age) = key
-    bin = 0
-    if week >= 4:
-        bin = 1
-    if week >= 12:
-        bin = 2
-    if week >= 24:
-        bin = 3
+    bin = (week >= 4) * 1 + (week >= 12) + (week >= 24)
     return (date_key, dose, bin)
 
 
 def group_month(key):
-    # turn weeks into months
+    # turn weeks into months, 6 and over are 6
     (date_key, dose, batch, week, age) = key
-    month = week // 4
-    if month > 6:
-        month = 6
+    month = np.minimum(week // 4, 6)
     return (date_key, dose, month)
 
+
+# the outputs buckets.py can write, by name. key is the regrouping function
+# (None for the raw buckets), the file is <prefix>_<suffix>. It's given the
+# key as a tuple of columns (month, dose, batch, week, age) of a BucketTable
+# (or of single values) and returns the new key columns, so it has to work
+# on whole arrays: no ifs on the values, use numpy (np.minimum, np.where).
+Grouping = namedtuple('Grouping', ['key', 'suffix', 'header'])
+GROUPINGS = {}
+
+# what gets written if --groupings isn't given
+DEFAULT_GROUPINGS = ['raw', 'no_batch', 'all_ages', 'decade']
+
+
+def register_grouping(name, key, suffix, header):
+    # add an output, e.g.
+    #   register_grouping('quarter', stratify(13, 10), 'month_dose_quarter_decade.txt', ['month', 'dose', 'week', 'decade'])
+    GROUPINGS[name] = Grouping(key, suffix, header)
+
+
+register_grouping('raw', None, 'month_dose_batch_week_age.txt', ['month', 'dose', 'batch', 'week', 'age'])
+register_grouping('no_batch', no_batch, 'month_dose_week_age.txt', ['month', 'dose', 'week', 'age'])
+register_grouping('all_ages', all_ages, 'month_dose_week.txt', ['month', 'dose', 'week'])
+register_grouping('decade', stratify(1, 10), 'month_dose_week_decade.txt', ['month', 'dose', 'week', 'decade'])
+register_grouping('dose_week', dose_week, 'dose_week.txt', ['dose', 'week'])
+register_grouping('steve', group_steve, 'month_dose_steve.txt', ['month', 'dose', 'bin'])
+register_grouping('vax_month', group_month, 'month_dose_vax_month.txt', ['month', 'dose', 'vax_month'])
+
+
+def regroup_table(table, key):
+    # (key columns, alive, dead) of the BucketTable summed by the new keys
+    # key(...) makes from its key columns (None keeps the raw buckets), sorted by key
+    cols = tuple(table[:5]) if key is None else key(tuple(table[:5]))
+    frame = pd.DataFrame({i: np.broadcast_to(col, len(table.alive)) for (i, col) in enumerate(cols)})
+    frame['alive'] = table.alive
+    frame['dead'] = table.dead
+    sums = frame.groupby(list(range(len(cols))), sort=True).sum()
+    return ([sums.index.get_level_values(i).to_numpy() for i in range(len(cols))],
+            sums['alive'].to_numpy(), sums['dead'].to_numpy())
+
+
+def write_groupings(prefix, table, names, workers=4):
+    # regroups the BucketTable for all the named outputs, with whole column
+    # operations, and writes the files in parallel
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for name in names:
+            g = GROUPINGS[name]
+            (keys, alive, dead) = regroup_table(table, g.key)
+            print(f'{name}: {len(alive)} buckets -> {prefix + g.suffix}')
+            futures.append(pool.submit(print_buckets, prefix + g.suffix, keys, alive, dead, header=g.header))
+        for f in futures:
+            f.result()
+
 #######################################
 #######################################
 #######################################
 
 
-# what source file to read - it has to have the format
-# we got from the NZ data
-if len(sys.argv) > 1:
-    fname = sys.argv[1]
-else:
-    exit(0)
-
-# a way to change the output file names
-if len(sys.argv) > 2:
-    prefix = sys.argv[2]
-else:
-    prefix = "ts"  # default prefix (ts for time-series)
-
-# optional for printing out people
-# with exactly number of vaccines
-if len(sys.argv) > 3:
-    n_vax = int(sys.argv[3])
-else:
-    n_vax = None
-
-# really optional, if we arg 3 above, we may also want
-# to filter out people who've skipped a vax dose
-if len(sys.argv) > 4:
-    do_filter = sys.argv[4] == 'FILTER'
-else:
-    do_filter = False
-
-print(fname, prefix, n_vax, do_filter)
-
-# lazy caching to make re-runs quick
-if len(prefix) > 0:
-    cache_path = f'{prefix}.pickle'
-    prefix = prefix + '_'
-
-if not os.path.exists(cache_path):
-    print('reading data file...')
-    read_nov9_csv(fname)
-    print(f'{len(all_people)} people')
-    print(f'{len(vaxxed_people)} vaxxed people')
-    print(f'{len(unvaxxed_people)} unvaxxed people')
-    print(f'{sum(len(v) for v in vax_dates.values())} vax doses')
-    print(f'{len(death_dates)} death records')
-
-    if do_filter:
-        # remove people who may have skipped a dose or
-        # at least don't have all of their doses in this
-        # set of records
-        print(f'filtering...')
-        for p in list(all_people):
-            if p not in vax_dates:
-                all_people.remove(p)
-            else:
-                for i in range(len(vax_dates[p])):
-                    (vax_date, vax_dose, vax_batch) = vax_dates[p][i]
-                    if vax_dose != i + 1:
-                        all_people.remove(p)
-                        break
-
-    print(f'remaining {len(all_people)} people')
-
-    print('processing buckets...')
-    (alive_ct, dead_ct) = make_buckets(n_vax=n_vax)
-    with open(cache_path, 'wb') as f:
-        pickle.dump((alive_ct, dead_ct), f)
-else:
-    print('reading cached data...')
-    with open(cache_path, 'rb') as f:
-        (alive_ct, dead_ct) = pickle.load(f)
-
-print(f'{len(alive_ct)} buckets')
-
-print('writing all bucket combinations...')
-print_buckets(prefix + 'month_dose_batch_week_age.txt', alive_ct, dead_ct, header=['month', 'dose', 'batch', 'week', 'age'])
-print('done...')
-
-print('grouping by batch...')
-(alive, dead) = regroup_buckets(alive_ct, dead_ct, no_batch)
-print(f'{len(alive)} buckets')
-print_buckets(prefix + 'month_dose_week_age.txt', alive, dead, header=['month', 'dose', 'week', 'age'])
-print('done...')
-
-
-print('grouping by all ages...')
-(alive, dead) = regroup_buckets(alive_ct, dead_ct, all_ages)
-print(f'{len(alive)} buckets')
-print_buckets(prefix + 'month_dose_week.txt', alive, dead, header=['month', 'dose', 'week'])
-print('done...')
-
-print('age stratifying...')
-(alive, dead) = regroup_buckets(alive_ct, dead_ct, stratify(1, 10))
-print(f'{len(alive)} buckets')
-print_buckets(prefix + 'month_dose_week_decade.txt', alive, dead, header=['month', 'dose', 'week', 'decade'])
-print('done...')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tally person-days and deaths by (month, dose, batch, week, age).")
+    # what source file to read - it has to have the format
+    # we got from the NZ data
+    parser.add_argument('fname', help='records file in buckets.py format, or a records dataset directory (see records_store.py)')
+    # a way to change the output file names
+    parser.add_argument('prefix', nargs='?', default='ts', help='prefix for the output files and the cache (ts for time-series)')
+    # optional for printing out people
+    # with exactly number of vaccines
+    parser.add_argument('n_vax', nargs='?', type=int, default=None, help='only people with exactly this many doses')
+    # really optional, if we arg 3 above, we may also want
+    # to filter out people who've skipped a vax dose
+    parser.add_argument('filter', nargs='?', default='', help="FILTER to drop people who may have skipped a dose")
+    parser.add_argument('--columnar', action='store_true',
+                        help='read the records into NumPy arrays instead of dicts (much less memory on the full file)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='count the buckets in this many processes (implies --columnar)')
+    records_store.add_filter_args(parser)
+    parser.add_argument('--groupings', default=','.join(DEFAULT_GROUPINGS),
+                        help=f"comma separated outputs to write, from {', '.join(GROUPINGS)} or all (default {','.join(DEFAULT_GROUPINGS)})")
+    parser.add_argument('--cache-dir', default=bucket_cache.CACHE_DIR, help='where to cache the bucket counts')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the cache")
+    args = parser.parse_args()
+
+    fname = args.fname
+    prefix = args.prefix
+    n_vax = args.n_vax
+    do_filter = args.filter == 'FILTER'
+    groupings = list(GROUPINGS) if args.groupings == 'all' else args.groupings.split(',')
+    for name in groupings:
+        if name not in GROUPINGS:
+            parser.error(f"unknown grouping {name}, choose from {', '.join(GROUPINGS)}")
+    filters = records_store.filters_from_args(args)
+    is_dataset = records_store.is_dataset(fname)
+    if not is_dataset and any(v is not None for v in filters.values()):
+        parser.error('--vax-year, --dose and --vax-code need a records dataset')
+
+    print(fname, prefix, n_vax, do_filter)
+
+    if len(prefix) > 0:
+        prefix = prefix + '_'
+
+    # caching to make re-runs quick, keyed on the content of the records
+    # file, the arguments and the version of this script
+    cached = None
+    if not args.no_cache:
+        (cache_key, cache_meta) = bucket_cache.cache_key(fname, dict(filters, n_vax=n_vax, filter=do_filter), args.cache_dir)
+        cached = bucket_cache.load(cache_key, args.cache_dir)
+
+    if cached is not None:
+        print('reading cached data...')
+        table = BucketTable(**cached)
+    elif args.columnar or args.workers is not None or is_dataset:
+        print('reading data file into arrays...')
+        people = read_nov9_columnar(fname, filters=filters)
+        print(f'{len(people.pid)} people')
+        print(f'{len(np.unique(people.dose_person[people.dose > 0]))} vaxxed people')
+        print(f'{len(people.dose)} vax doses')
+        print(f'{int(np.count_nonzero(people.death != NO_DATE))} death records')
+
+        keep = select_people_columnar(people, n_vax=n_vax, do_filter=do_filter)
+
+        print('processing buckets...')
+        if args.workers is not None and args.workers > 1:
+            table = make_buckets_sharded(people, keep, args.workers)
+        else:
+            table = make_buckets_columnar(people, keep)
+    else:
+        print('reading data file...')
+        read_nov9_csv(fname)
+        print(f'{len(all_people)} people')
+        print(f'{len(vaxxed_people)} vaxxed people')
+        print(f'{len(unvaxxed_people)} unvaxxed people')
+        print(f'{sum(len(v) for v in vax_dates.values())} vax doses')
+        print(f'{len(death_dates)} death records')
+
+        if do_filter:
+            # remove people who may have skipped a dose or
+            # at least don't have all of their doses in this
+            # set of records
+            print(f'filtering...')
+            for p in list(all_people):
+                if p not in vax_dates:
+                    all_people.remove(p)
+                else:
+                    for i in range(len(vax_dates[p])):
+                        (vax_date, vax_dose, vax_batch) = vax_dates[p][i]
+                        if vax_dose != i + 1:
+                            all_people.remove(p)
+                            break
+
+        print(f'remaining {len(all_people)} people')
+
+        print('processing buckets...')
+        table = dicts_to_bucket_table(*make_buckets(n_vax=n_vax))
+
+    if cached is None and not args.no_cache:
+        bucket_cache.store(cache_key, cache_meta, table._asdict(), args.cache_dir)
+
+    print(f'{len(table.alive)} buckets')
+
+    print('writing ' + ', '.join(groupings) + '...')
+    write_groupings(prefix, table, groupings)
+    print('done...')
@@ -1,16 +1,24 @@
 # Convert input file from CR format to buckets.py format
 # Example usage
 # python convert.py input_file.csv >output_file.csv
+# python convert.py input_file.csv.xz >output_file.csv   # reads the compressed file directly
+# python convert.py --day-numbers input_file.csv >output_file.csv   # dates as day numbers (date.toordinal())
+# python convert.py --parquet ../data/records_parquet input_file.csv   # partitioned dataset, see records_store.py
 
 import csv
-from datetime import datetime
+import datetime
 import argparse
 import sys
 
+import date_codec
+import records_store
+import xz_reader
+
 UVAX="U"
-DEC_2019=datetime.strptime("2019-12-31", '%Y-%m-%d')
+DEC_2019=datetime.date(2019, 12, 31).toordinal()
+JAN_2020=datetime.date(2020, 1, 1).toordinal()
 
-def process_vaccine_data(input_file):
+def process_vaccine_data(input_file, day_numbers=False, out_writer=None):
   """
   Reads the large CSV file in Czech Republic format and 
   and writes the results to two output CSV files, one for male, one for female, in the buckets format.
@@ -18,67 +26,80 @@ def process_vaccine_data(input_file):
   Args:
       input_file (str): Path to the input CSV file.
       output_file (str)
+      day_numbers (bool): write the dates as day numbers instead of m/d/Y
+      out_writer: where the rows go (no header is written), a csv writer on stdout if None
   """
-  with open(input_file, 'r') as infile:
+  out_fmt = 'day' if day_numbers else 'mdy/'
+  if out_writer is None:
     out_writer = csv.writer(sys.stdout)
     # Write header row for both output files
     out_writer.writerow(['mrn', 'Vax_code', 'Dose_number', 'Vax_date', 'Death_date', 'Vax_name', 'Birth_date'])
-      
-    reader = csv.reader(infile)
-    for row_num, row in enumerate(reader, start=1):
-      # Skip header row
-      if row_num == 1:
-        continue
-      
-      # Extract data
-      mrn = str(row_num)
-      sex = row[0]
-      birth_year = row[1]
-      if not birth_year:
-        continue    # skip this record if no birth year
-      death_date = row[2]
-
-      if death_date:   # if death date present, convert the format just once, not in the loop
-          try:
-            death_date_obj = datetime.strptime(death_date, '%Y-%m-%d')   # we can subtract date objects
-            death_date = death_date_obj.strftime('%m/%d/%Y')  # convert back to a printable date
-          except ValueError:
-            print(f"Error: Invalid death_date format {death_date} for row {row_num}")
-            death_date = ""
-      # write an ouput record to register the person to be unvaccinated as of 1-1-2020 if they didn't die before 1-1-2020
-      if not death_date or death_date_obj > DEC_2019:
-          # Basically, everyone alive got shot #0 (of brand "Saline") at start of the trial of 2020!
-          output_row = [mrn, 0, 0, "1/1/2020", death_date, UVAX, f"1/1/{birth_year}"]
-          out_writer.writerow(output_row)
-      # Process vaccine data for each dose
-      for dose_num in range(1, 8):
-        vax_date = row[3 + (dose_num - 1) * 4]
-        #  loop if vax_date is empty (no more doses)
-        if not vax_date:
-          continue    # see if any other doses since a dose can be missing so contine and don't break
-        vax_code = int(row[5 + (dose_num - 1) * 4][2:]) # must be an integer
-        vax_name = row[6 + (dose_num - 1) * 4]
+    
+  # the rows after the header (row 1), input_file can be the .xz file
+  for row_num, row in enumerate(xz_reader.iter_rows(input_file), start=2):
+    # Extract data
+    mrn = str(row_num)
+    sex = row[0]
+    birth_year = row[1]
+    if not birth_year:
+      continue    # skip this record if no birth year
+    death_date = row[2]
 
-        # Convert date format for vax_date and death_date (if not empty)
+    if death_date:   # if death date present, convert the format just once, not in the loop
         try:
-          vax_date_obj = datetime.strptime(vax_date, '%Y-%m-%d')
-          vax_date = vax_date_obj.strftime('%m/%d/%Y')
+          death_day = date_codec.parse_day(death_date, 'ymd-')   # we can compare day numbers
+          death_date = date_codec.format_day(death_day, out_fmt)  # convert back to a printable date
         except ValueError:
-          print(f"Error: Invalid vax_date format {vax_date} for row {row_num}")
-          vax_date = ""
-        
-        # Write an output row for each dose given 
-        output_row = [mrn, vax_code, dose_num, vax_date, death_date, vax_name, f"1/1/{birth_year}"]
+          print(f"Error: Invalid death_date format {death_date} for row {row_num}")
+          death_date = ""
+    # write an ouput record to register the person to be unvaccinated as of 1-1-2020 if they didn't die before 1-1-2020
+    birth_date = f"1/1/{birth_year}"
+    if day_numbers:
+        try:
+          birth_date = date_codec.parse_day(birth_date, 'mdy/')
+        except ValueError:
+          print(f"Error: Invalid birth year {birth_year} for row {row_num}")
+          continue
+    if not death_date or death_day > DEC_2019:
+        # Basically, everyone alive got shot #0 (of brand "Saline") at start of the trial of 2020!
+        output_row = [mrn, 0, 0, JAN_2020 if day_numbers else "1/1/2020", death_date, UVAX, birth_date]
         out_writer.writerow(output_row)
+    # Process vaccine data for each dose
+    for dose_num in range(1, 8):
+      vax_date = row[3 + (dose_num - 1) * 4]
+      #  loop if vax_date is empty (no more doses)
+      if not vax_date:
+        continue    # see if any other doses since a dose can be missing so contine and don't break
+      vax_code = int(row[5 + (dose_num - 1) * 4][2:]) # must be an integer
+      vax_name = row[6 + (dose_num - 1) * 4]
+
+      # Convert date format for vax_date and death_date (if not empty)
+      try:
+        vax_date = date_codec.format_day(date_codec.parse_day(vax_date, 'ymd-'), out_fmt)
+      except ValueError:
+        print(f"Error: Invalid vax_date format {vax_date} for row {row_num}")
+        vax_date = ""
+      
+      # Write an output row for each dose given 
+      output_row = [mrn, vax_code, dose_num, vax_date, death_date, vax_name, birth_date]
+      out_writer.writerow(output_row)
 
 if __name__ == "__main__":
     # Set up argument parsing
     parser = argparse.ArgumentParser(description="Convert input file to buckets format.")
     parser.add_argument('in_filename', type=str, help='The input CSV file to convert to buckets format')
+    parser.add_argument('--day-numbers', action='store_true', help='write dates as day numbers (smaller and faster for buckets.py to read)')
+    parser.add_argument('--parquet', metavar='DIR', default=None,
+                        help='write a Parquet dataset partitioned by vax year, dose and vax code to DIR instead of CSV to stdout')
     
     # Parse the arguments
     args = parser.parse_args()
     
     # Call the function with the provided filename
-    process_vaccine_data(args.in_filename)
+    if args.parquet:
+        writer = records_store.RecordWriter(args.parquet)
+        process_vaccine_data(args.in_filename, day_numbers=True, out_writer=writer)
+        writer.close()
+    else:
+        process_vaccine_data(args.in_filename, args.day_numbers)
     
@@ -2,6 +2,8 @@
 import pandas as pd
 import numpy as np
 
+import date_codec
+
 # Load and process the same way as KCOR_CMR.py
 a = pd.read_csv('data/vax_24.csv', dtype=str, low_memory=False)
 a = a.rename(columns={
@@ -21,7 +23,7 @@ a['birth_year'] = pd.to_numeric(a['birth_year'], errors='coerce')
 a['born'] = a['birth_year'].apply(lambda x: int(x) if pd.notnull(x) else -1)
 
 # Parse death dates
-a['death_date_lpz'] = pd.to_datetime(a['death_date_lpz'].str.replace(r'[^0-9-]', '', regex=True) + '-1', format='%G-%V-%u', errors='coerce')
+a['death_date_lpz'] = date_codec.iso_week_column(a['death_date_lpz'].str.replace(r'[^0-9-]', '', regex=True))
 a['week'] = a['death_date_lpz'].dt.strftime('%G-%V').astype(str)
 
 print(f'Total records: {len(a)}')
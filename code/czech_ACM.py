@@ -30,6 +30,9 @@
 # data.dtypes() to print out datatypes 
 import pandas as pd
 
+import aggregate
+import vax24_store
+
 data_file='../data/vax_24.csv'
 data_file='../data/sample.csv' # for debug
 output_file = '../data/cfr_by_week.csv'
@@ -40,6 +43,9 @@ COVID_died='died_from_COVID' # 1 or 0
 index_fields = ['YearOfBirth', 'VaccineCode_FirstDose', 'DateOfDeath', 'Date_FirstDose', COVID_died]   
 value_fields= []
 
+# the columns read from the file
+COLUMNS = ['YearOfBirth', 'Date_COVID_death', 'Date_FirstDose', 'VaccineCode_FirstDose', 'DateOfDeath']
+
 # And the value fields that I want to sum up so I can compute an IFR
 # the first two will create # COVID deaths and # of ACM deaths for people in the cohort
 # value_fields= ['Date_COVID_death', 'DateOfDeath']    
@@ -50,44 +56,59 @@ value_fields= []
 
 import itertools
 
-def main(data_file, output_file):
-    # Load the CSV file into a DataFrame. 
-    # I have plenty of memory so let pandas know that to avoid type errors on dose 6 which happens later in the fil
-
-    data = pd.read_csv(data_file, low_memory=False)
-
-    # rename the columns in English
-    data.columns = [
-        'ID', 'Infection', 'Gender', 'YearOfBirth', 'DateOfPositiveTest', 'DateOfResult', 'Recovered', 'Date_COVID_death',
-        'Symptom', 'TestType', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose',
-        'Date_FifthDose', 'Date_SixthDose', 'Date_SeventhDose', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose',
-        'VaccineCode_ThirdDose', 'VaccineCode_FourthDose', 'VaccineCode_FifthDose', 'VaccineCode_SixthDose',
-        'VaccineCode_SeventhDose', 'PrimaryCauseHospCOVID', 'bin_Hospitalization', 'min_Hospitalization',
-        'days_Hospitalization', 'max_Hospitalization', 'bin_ICU', 'min_ICU', 'days_ICU', 'max_ICU', 'bin_StandardWard',
-        'min_StandardWard', 'days_StandardWard', 'max_StandardWard', 'bin_Oxygen', 'min_Oxygen', 'days_Oxygen',
-        'max_Oxygen', 'bin_HFNO', 'min_HFNO', 'days_HFNO', 'max_HFNO', 'bin_MechanicalVentilation_ECMO',
-        'min_MechanicalVentilation_ECMO', 'days_MechanicalVentilation_ECMO', 'max_MechanicalVentilation_ECMO',
-        'Mutation', 'DateOfDeath', 'Long_COVID', 'DCCI']
-
-    # Transform YearOfBirth to extract the first year as an integer, handling missing or invalid entries
-    data['YearOfBirth'] = data['YearOfBirth'].str.split('-').str[0].replace('', None).dropna().astype('Int32')
-
-    # Transform the VaccineCode columns to clean then up
-    # remove leading and trailing spaces, convert to uppercase so can be found in dictionary
-    brand_cols=['VaccineCode_FirstDose']
-    for col in brand_cols:
-        data[col] = data[col].str.strip().str.upper()
+def main(data_file, output_file, chunksize=None):
+    # Load the columns we need. data_file can be the vax_24 store (see vax24_store.py) or vax_24.csv itself.
+    # Either way the columns are named in English, YearOfBirth is the first year of the range,
+    # VaccineCode_FirstDose is cleaned up (stripped and upper cased, categorical) and the dates are converted
+    # from the YYYY-WW ISO week format to the Monday of the week. They are grouped as they are, the
+    # output has no time part.
+    # With chunksize the file is read that many rows at a time and the counts of the chunks are
+    # added up (aggregate.GroupSum), so memory goes with the number of groups instead of the people.
+
+    # this line does all the work 
+    # setting dropna=false allows index entries to include blank (e.g, no vaccinated data) since otherwise those rows are dropped
+    # use sum() for adding numeric value fields
+    # this is when we were counting date value_fields= ['Date_COVID_death', 'DateOfDeath']    
+    # summary_df = data.groupby(index_fields)[value_fields].count().reset_index() 
+    # make sure both have dropna=False!!
+
+    # summary_df = data.groupby(index_fields, dropna=False)[value_fields].sum().reset_index()  
+    # summary_df["Count"] = data.groupby(index_fields, dropna=False).size().values # add count
+    
+    # no value fields so it's just the Count of each group
+    total = aggregate.GroupSum(index_fields, value_fields, count='Count')
+    if chunksize:
+        for data in vax24_store.iter_load(data_file, COLUMNS, chunksize):
+            total.add(add_fields(data))
+    else:
+        total.add(add_fields(vax24_store.load(data_file, COLUMNS)))
+    summary_df = total.result()
+
+    # now modify the labels to be more user friendly. Will replace blank with blank
+    from mfg_codes import MFG_DICT
+
+    # Transform VaccineCode_xxxDose using the dictionary so have friendly names.
+    doses=['d1']
+    dose_dict={'d1':'FirstDose','d2':'SecondDose', 'd3':'ThirdDose'}
+    
+    for d in doses:
+        summary_df['VaccineCode_'+dose_dict[d]] = summary_df['VaccineCode_'+dose_dict[d]].map(MFG_DICT) 
+
+    # Now switch back NONE to empty since we used NONE as a placeholder everywhere
+    # no need for this anymore since not using NONE
+    # summary_df.replace('NONE', '', inplace=True)
+
+    # Write the summary DataFrame to a CSV file
+    summary_df.to_csv(output_file, index=False)
+
+    print(f"Summary file has been written to {output_file}.")
+
 
+def add_fields(data):
+    # the records with the derived fields added
     # Ensure Infection is an integer (empty=0)
     # data['Infection'] = data['Infection'].fillna(0).astype('Int32')
 
-    # Convert dates from YYYY-WW format to pandas datetime format
-    for col in ['Date_COVID_death', 'DateOfPositiveTest', 'DateOfDeath', 'Date_FirstDose', 'Date_ThirdDose']:
-        data[col] = pd.to_datetime(data[col] + '-1', format='%G-%V-%u', errors='coerce').dt.date
-    # the dt.date will remove the time part of the date so things are cleaner. The  ISO format adds the time.
-    # %G-%V-%u because the Czech data uses ISO 8601 weeks
-    # format='%Y-%W-%w' was incorrect
-
     # Create 'died_in_NCmonth' column for deaths between May 30, 2021, and Oct 12, 2021 (inclusive)
     # data['died_in_NCmonth_2021'] = data['DateOfDeath'].apply(lambda x: 1 if pd.notna(x) and pd.Timestamp('2021-05-30') <= x <= pd.Timestamp('2021-10-12') else 0)
     # data['died_in_NCmonth_2022'] = data['DateOfDeath'].apply(lambda x: 1 if pd.notna(x) and pd.Timestamp('2022-05-10') <= x <= pd.Timestamp('2022-07-10') else 0)
@@ -145,49 +166,17 @@ def main(data_file, output_file):
     
     """
 
-    # this line does all the work 
-    # setting dropna=false allows index entries to include blank (e.g, no vaccinated data) since otherwise those rows are dropped
-    # use sum() for adding numeric value fields
-    # this is when we were counting date value_fields= ['Date_COVID_death', 'DateOfDeath']    
-    # summary_df = data.groupby(index_fields)[value_fields].count().reset_index() 
-    # make sure both have dropna=False!!
-
-    # summary_df = data.groupby(index_fields, dropna=False)[value_fields].sum().reset_index()  
-    # summary_df["Count"] = data.groupby(index_fields, dropna=False).size().values # add count
-    
-    # no value fields so can make it a one-liner
-    summary_df = data.groupby(index_fields, dropna=False).size().reset_index(name="Count")  
- 
-    
-    # now modify the labels to be more user friendly. Will replace blank with blank
-    from mfg_codes import MFG_DICT
-
-    # Transform VaccineCode_xxxDose using the dictionary so have friendly names.
-    doses=['d1']
-    dose_dict={'d1':'FirstDose','d2':'SecondDose', 'd3':'ThirdDose'}
-    
-    for d in doses:
-        summary_df['VaccineCode_'+dose_dict[d]] = summary_df['VaccineCode_'+dose_dict[d]].map(MFG_DICT) 
-
-    # Now switch back NONE to empty since we used NONE as a placeholder everywhere
-    # no need for this anymore since not using NONE
-    # summary_df.replace('NONE', '', inplace=True)
-
-    # Write the summary DataFrame to a CSV file
-    summary_df.to_csv(output_file, index=False)
-
-    print(f"Summary file has been written to {output_file}.")
-
+    return data
 
-import sys
 
-# Check for command-line arguments
-if len(sys.argv) != 3:
-    print("Usage: python script.py <source_file> <output_file>")
-    sys.exit(1)
+import argparse
 
-# Command-line arguments
-data_file = sys.argv[1]
-output_file = sys.argv[2]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count vax_24.csv (or its store) records by birth year, first dose, date of death and COVID death.")
+    parser.add_argument('data_file', help='vax_24.csv or the store made from it (vax24_store.py)')
+    parser.add_argument('output_file', help='the summary CSV to write')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='read this many records at a time to bound memory (default the whole file at once)')
+    args = parser.parse_args()
 
-main(data_file, output_file)
\ No newline at end of file
+    main(args.data_file, args.output_file, args.chunksize)
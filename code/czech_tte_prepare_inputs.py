@@ -22,7 +22,15 @@ import sys
 import os
 import pandas as pd
 import numpy as np
-from datetime import datetime
+
+import date_codec
+import loaders
+import vax24_store
+
+# the columns used, when reading the vax_24 store
+STORE_COLUMNS = ['ID', 'Gender', 'YearOfBirth', 'DateOfPositiveTest', 'Date_COVID_death', 'DateOfDeath'] + \
+    [f'{kind}_{dose}Dose' for kind in ('Date', 'VaccineCode')
+     for dose in ('First', 'Second', 'Third', 'Fourth', 'Fifth', 'Sixth', 'Seventh')]
 
 def iso_week_to_date(iso_week_str):
     """Convert 'YYYY-WW' (or 'YYYYWW') to Monday date of that ISO week. Pass through YYYY-MM-DD if present."""
@@ -45,42 +53,15 @@ def iso_week_to_date(iso_week_str):
     except Exception:
         return pd.NaT
 
-def parse_year(y):
-    y_str = str(y)
-    if len(y_str) < 4:
-        return np.nan
-    try:
-        year = int(y_str[:4])
-        if 1900 <= year <= datetime.now().year:
-            return year
-    except Exception:
-        pass
-    return np.nan
-
-def qstats(x):
-    x = np.asarray(x, dtype=float)
-    x = x[np.isfinite(x)]
-    if x.size == 0:
-        return dict(mean=np.nan, sd=np.nan, p25=np.nan, p50=np.nan, p75=np.nan)
-    return dict(
-        mean=float(np.mean(x)),
-        sd=float(np.std(x, ddof=1)) if x.size > 1 else 0.0,
-        p25=float(np.nanpercentile(x, 25)),
-        p50=float(np.nanpercentile(x, 50)),
-        p75=float(np.nanpercentile(x, 75)),
-    )
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument('--input', required=True, help='Path to Czech raw CSV (same file KCOR.py uses)')
-    ap.add_argument('--outdir', required=True, help='Output directory for baseline.csv, vax.csv, events.csv')
-    ap.add_argument('--t0', required=False, default=None, help='t0 date (YYYY-MM-DD) to compute age at t0 and cohort report (optional)')
-    args = ap.parse_args()
-
-    os.makedirs(args.outdir, exist_ok=True)
+def load_input(path):
+    """Records from the raw Czech CSV, or from the vax_24 store (see vax24_store.py), columns in English,
+    Date* as Timestamps and only the records with Infection <= 1."""
+    # the vax_24 store is already in English with the dates converted
+    if vax24_store.is_store(path):
+        return vax24_store.load(path, STORE_COLUMNS, max_infection=1)
 
     # Load raw
-    df = pd.read_csv(args.input, low_memory=False)
+    df = pd.read_csv(path, low_memory=False)
 
     # If columns match KCOR schema length, rename to English
     english_cols = [
@@ -98,18 +79,44 @@ def main():
     if len(df.columns) == len(english_cols):
         df.columns = english_cols
 
-    # Convert all Date* columns via ISO-week logic
+    # Convert all Date* columns via ISO-week logic, once per distinct value
     date_cols = [c for c in df.columns if c.startswith('Date')]
     for c in date_cols:
-        df[c] = df[c].apply(iso_week_to_date)
+        df[c] = date_codec.iso_week_column(df[c], parse=iso_week_to_date)
 
     # Keep Infection <= 1 to avoid multiple-episode duplicates
     if 'Infection' in df.columns:
         df = df[(df['Infection'].fillna(0).astype(float) <= 1)]
+    return df
+
+def qstats(x):
+    x = np.asarray(x, dtype=float)
+    x = x[np.isfinite(x)]
+    if x.size == 0:
+        return dict(mean=np.nan, sd=np.nan, p25=np.nan, p50=np.nan, p75=np.nan)
+    return dict(
+        mean=float(np.mean(x)),
+        sd=float(np.std(x, ddof=1)) if x.size > 1 else 0.0,
+        p25=float(np.nanpercentile(x, 25)),
+        p50=float(np.nanpercentile(x, 50)),
+        p75=float(np.nanpercentile(x, 75)),
+    )
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--input', required=True, help='Path to Czech raw CSV (same file KCOR.py uses) or the vax_24 store made from it (.parquet)')
+    ap.add_argument('--outdir', required=True, help='Output directory for baseline.csv, vax.csv, events.csv')
+    ap.add_argument('--t0', required=False, default=None, help='t0 date (YYYY-MM-DD) to compute age at t0 and cohort report (optional)')
+    args = ap.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+
+    df = load_input(args.input)
 
     # Sex map
-    sex_map = {'M': 'M', 'F': 'F', 'Male': 'M', 'Female': 'F', 'm': 'M', 'f': 'F', 1: 'M', 2: 'F'}
-    sex = df['Gender'].map(sex_map).fillna(df['Gender'].astype(str).str.upper().str[0])
+    sex_map = {'M': 'M', 'F': 'F', 'Male': 'M', 'Female': 'F', 'm': 'M', 'f': 'F', 1: 'M', 2: 'F', '1': 'M', '2': 'F'}   # the store has the codes as strings
+    gender = df['Gender'].astype(object)   # plain values, the store's are categorical
+    sex = gender.map(sex_map).fillna(gender.astype(str).str.upper().str[0])
 
     # Age at t0 (preferred); if missing, fallback to 2022-01-01
     if args.t0:
@@ -118,9 +125,9 @@ def main():
     else:
         t0 = None
         ref_year = 2022
-    yob = df['YearOfBirth'].apply(parse_year)
+    yob = pd.Series(loaders.decode_yob(df['YearOfBirth']), index=df.index)
     age = (ref_year - yob).astype('float')
-    age = age.where(np.isfinite(age), np.nan)
+    age = age.where(yob != loaders.NO_YEAR, np.nan)
 
     # Prior infection earliest
     earliest_inf = df[['ID','DateOfPositiveTest']].dropna().groupby('ID').DateOfPositiveTest.min()
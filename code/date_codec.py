@@ -0,0 +1,148 @@
+# Date parsing shared by buckets.py and convert.py
+#
+# The record files have millions of rows but only a few thousand different
+# dates, so each distinct date string is parsed once and remembered. Dates
+# are handled as day numbers (datetime.date.toordinal()), and convert.py can
+# write day numbers instead of m/d/Y strings so buckets.py doesn't have to
+# parse dates at all.
+#
+# Formats:
+#   'mdy/'  01/31/2021  (buckets.py format)
+#   'mdy-'  01-31-2021
+#   'ymd-'  2021-01-31  (CR format)
+#   'day'   737821      (day numbers)
+#
+# The vax_24.csv family of files has ISO weeks like 2021-05 instead, which
+# iso_week_column turns into the date of the Monday of the week, again
+# parsing each distinct week string once (there are only a few hundred).
+
+import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# day number for a missing date, sorts after every real date
+NO_DATE = np.iinfo(np.int32).max
+
+# day number of 1/1/1970, to turn day numbers into numpy dates
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+# an ISO week string plus '-1' (Monday), %G-%V-%u because the Czech data uses ISO 8601 weeks
+ISO_WEEK_FORMAT = '%G-%V-%u'
+
+
+def detect_format(value):
+    # the buckets.py format of a date string, or None if it doesn't look
+    # like a date. Dates with - are month first like the ones with /.
+    if '-' in value:
+        return 'mdy-'
+    if '/' in value:
+        return 'mdy/'
+    if value.isdigit():
+        return 'day'
+    return None
+
+
+@lru_cache(maxsize=None)
+def parse_day(s, fmt):
+    # day number for one date string, NO_DATE for ''
+    if not s:
+        return NO_DATE
+    if fmt == 'day':
+        return int(s)
+    if fmt == 'ymd-':
+        return datetime.datetime.strptime(s, '%Y-%m-%d').toordinal()
+    (m, d, y) = s.split(fmt[3])
+    return datetime.date(int(y), int(m), int(d)).toordinal()
+
+
+@lru_cache(maxsize=None)
+def parse_date(s, fmt):
+    # datetime.date for one date string, None for ''
+    day = parse_day(s, fmt)
+    return None if day == NO_DATE else datetime.date.fromordinal(day)
+
+
+@lru_cache(maxsize=None)
+def format_day(day, fmt):
+    # date string for a day number, '' for NO_DATE
+    if day == NO_DATE:
+        return ''
+    if fmt == 'day':
+        return str(day)
+    d = datetime.date.fromordinal(day)
+    if fmt == 'ymd-':
+        return d.strftime('%Y-%m-%d')
+    return d.strftime(f'%m{fmt[3]}%d{fmt[3]}%Y')
+
+
+def parse_column(values, fmt, invalid='raise'):
+    # day numbers (int32) for an array of date strings. With
+    # invalid='missing' strings that don't parse are NO_DATE.
+    codes, uniques = pd.factorize(values)
+    # one extra entry at the end for the missing values, which factorize codes as -1
+    table = np.full(len(uniques) + 1, NO_DATE, dtype=np.int32)
+    for (i, s) in enumerate(uniques):
+        try:
+            table[i] = parse_day(s, fmt)
+        except ValueError:
+            if invalid != 'missing':
+                raise
+            table[i] = NO_DATE
+    return table[codes]
+
+
+def format_column(days, fmt):
+    # date strings for an array of day numbers
+    codes, uniques = pd.factorize(days)
+    table = np.array([format_day(int(day), fmt) for day in uniques], dtype=object)
+    return table[codes]
+
+
+def years(days):
+    # calendar year of each day number, 0 for NO_DATE
+    y = (days.astype(np.int64) - EPOCH).astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+    return np.where(days == NO_DATE, 0, y).astype(np.int32)
+
+
+def year_month(days):
+    # (year, month) arrays for day numbers, both 0 for NO_DATE
+    months = (days.astype(np.int64) - EPOCH).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    missing = days == NO_DATE
+    return (np.where(missing, 0, months // 12 + 1970).astype(np.int32),
+            np.where(missing, 0, months % 12 + 1).astype(np.int32))
+
+
+@lru_cache(maxsize=None)
+def parse_iso_week(s):
+    # pd.Timestamp of the Monday of an ISO week string like 2021-05, NaT if it doesn't parse
+    return pd.to_datetime(s + '-1', format=ISO_WEEK_FORMAT, errors='coerce')
+
+
+def iso_week_column(values, parse=None):
+    # Series of the Mondays (datetime64, NaT if missing or bad) of a column
+    # of ISO week strings, with the index of values if it's a Series (see
+    # date_objects for datetime.date values). parse is a function for one
+    # string to use instead of the usual format.
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object).astype(str)
+    if parse is None:
+        table = pd.to_datetime(uniques + '-1', format=ISO_WEEK_FORMAT, errors='coerce')
+    else:
+        table = pd.to_datetime(pd.Series([parse(u) for u in uniques], dtype=object))
+    # one extra entry at the end for the missing values, which factorize codes as -1
+    table = table.reindex(range(len(table) + 1))
+    column = table.take(codes)
+    column.index = values.index if isinstance(values, pd.Series) else pd.RangeIndex(len(column))
+    return column
+
+
+def date_objects(values):
+    # datetime.date values (NaT if missing) for a datetime64 Series, like
+    # .dt.date gives but converting each distinct date once
+    codes, uniques = pd.factorize(values)
+    table = pd.Series(pd.DatetimeIndex(uniques)).reindex(range(len(uniques) + 1)).dt.date
+    column = table.take(codes)
+    column.index = values.index
+    return column
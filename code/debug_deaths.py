@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 
+import date_codec
+
 # Load raw data
 print("Loading raw data...")
 a = pd.read_csv('data/vax_24.csv', dtype=str, low_memory=False)
@@ -37,9 +39,8 @@ print(f'\nBirth year distribution:')
 print(a_filtered['born'].value_counts().head(10))
 
 # Parse death dates
-a_filtered['death_date_lpz'] = pd.to_datetime(
-    a_filtered['death_date_lpz'].str.replace(r'[^0-9-]', '', regex=True) + '-1', 
-    format='%G-%V-%u', errors='coerce'
+a_filtered['death_date_lpz'] = date_codec.iso_week_column(
+    a_filtered['death_date_lpz'].str.replace(r'[^0-9-]', '', regex=True)
 )
 
 print(f'\nDeath date parsing:')
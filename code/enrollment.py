@@ -0,0 +1,104 @@
+# Dose groups at many enrollment dates from one pass over the records
+#
+# old/KCOR.py puts everyone in a dose group at each enrollment date (the
+# number of doses they had by then, capped) and counts them by year of
+# birth, date of death and sex. It used to copy the whole frame, rebuild
+# the dose masks, one-hot encode and group for every enrollment date.
+#
+# A person's dose group only ever goes up, so it is known at every
+# enrollment date from the few enrollment indexes where it steps up: the
+# first enrollment on or after each dose date (np.searchsorted on the sorted
+# enrollment dates), with a reverse running minimum over the doses since a
+# later dose counts even if an earlier one is missing, as the old code did.
+# The people are grouped into cells first (see aggregate.make_cube) and
+# sweep() goes through the enrollment dates in order keeping the
+# (cells x groups) counts, applying at each date only the steps that happen
+# there (the doses given since the date before). So every ISO week can be
+# an enrollment date for little more than the cost of one, and
+# sweep_cube() keeps just the nonzero counts (enrollment x cell x group).
+#
+# Example usage:
+#   cube = aggregate.make_cube(data, ['YearOfBirth', 'DateOfDeath', 'Gender'])
+#   enroll = [date_codec.parse_iso_week(w) for w in ['2021-24', '2022-06']]
+#   counts = enrollment.dose_group_counts(cube.row_cell, len(cube.size), [data['Date_FirstDose'], ...], enroll)
+#   counts[cell, k, g]   # people of cell in dose group g at enroll[k]
+#   (k, cell, group, count) = enrollment.sweep_cube(cube.row_cell, len(cube.size), dose_dates, weekly_mondays)
+
+import numpy as np
+
+
+def first_enrollment(dates, enroll):
+    # index into the sorted enroll dates of the first one on or after each
+    # date, len(enroll) if none is or there is no date (NaT)
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    first = np.searchsorted(enroll, dates, side='left')
+    first[np.isnat(dates)] = len(enroll)
+    return first
+
+
+def group_starts(dose_dates, enroll, max_group):
+    # (max_group, people) array, row j-1 the first enrollment index at which
+    # the person is in dose group j or higher: the first dose on or before it
+    # among doses j, j+1, ... (so a group past max_group counts as max_group)
+    firsts = np.stack([first_enrollment(d, enroll) for d in dose_dates])
+    starts = np.minimum.accumulate(firsts[::-1], axis=0)[::-1]
+    return starts[:max_group]
+
+
+def sweep(cells, n_cells, dose_dates, enroll, max_group=5, n_groups=7):
+    # (k, counts) for each of the enrollment dates enroll (sorted), counts
+    # the (n_cells, n_groups) int64 array of the people of each cell (cells:
+    # the cell number of each person) in each dose group at enroll[k].
+    # dose_dates are the date columns of doses 1, 2, ... Group 0 is no dose
+    # by then, groups are capped at max_group. The counts are updated from
+    # one date to the next with just the dose group steps at that date, and
+    # the same array is yielded each time (copy it to keep it).
+    enroll = np.asarray(enroll, dtype='datetime64[ns]')
+    n_enroll = len(enroll)
+    starts = group_starts(dose_dates, enroll, max_group)
+    cells = np.asarray(cells, dtype=np.int64)
+
+    # the steps as (enrollment, cell * n_groups + new group), sorted by enrollment
+    step_at = starts.reshape(-1)
+    step_key = (cells * n_groups + np.arange(1, max_group + 1)[:, None]).reshape(-1)
+    keep = step_at < n_enroll
+    (step_at, step_key) = (step_at[keep], step_key[keep])
+    order = np.argsort(step_at, kind='stable')
+    (step_at, step_key) = (step_at[order], step_key[order])
+    bounds = np.searchsorted(step_at, np.arange(n_enroll + 1))
+
+    size = n_cells * n_groups
+    counts = np.bincount(cells * n_groups, minlength=size)   # everyone starts in group 0
+    for k in range(n_enroll):
+        # each step moves a person from the group below to the new group
+        keys = step_key[bounds[k]:bounds[k + 1]]
+        if len(keys):
+            counts += np.bincount(keys, minlength=size)
+            counts -= np.bincount(keys - 1, minlength=size)
+        yield (k, counts.reshape(n_cells, n_groups))
+
+
+def dose_group_counts(cells, n_cells, dose_dates, enroll, max_group=5, n_groups=7):
+    # (n_cells, len(enroll), n_groups) int64 array of the sweep counts at
+    # each of the enrollment dates enroll, which can be in any order (the
+    # counts are in that order)
+    order = np.argsort(np.asarray(enroll, dtype='datetime64[ns]'), kind='stable')
+    enroll = np.asarray(enroll, dtype='datetime64[ns]')[order]
+    counts = np.zeros((n_cells, len(enroll), n_groups), dtype=np.int64)
+    for (k, at_k) in sweep(cells, n_cells, dose_dates, enroll, max_group, n_groups):
+        counts[:, k] = at_k
+    # back to the order enroll was given in
+    return counts[:, np.argsort(order)]
+
+
+def sweep_cube(cells, n_cells, dose_dates, enroll, max_group=5, n_groups=7):
+    # the nonzero sweep counts as a compact cube: (enroll_index, cell,
+    # group, count) arrays, one entry per enrollment date, cell and dose
+    # group with anyone in it
+    parts = []
+    for (k, counts) in sweep(cells, n_cells, dose_dates, enroll, max_group, n_groups):
+        (cell, group) = np.nonzero(counts)
+        parts.append((np.full(len(cell), k, dtype=np.int32), cell.astype(np.int32), group.astype(np.int8), counts[cell, group]))
+    if not parts:
+        return tuple(np.zeros(0, dtype=t) for t in (np.int32, np.int32, np.int8, np.int64))
+    return tuple(np.concatenate(col) for col in zip(*parts))
@@ -16,8 +16,15 @@ Output written to std out is a .csv file with a full matrix analysis
 
 Example usage:
 python full_matrix.py CR_records.csv >full_matrix.csv
+python full_matrix.py CR_records.csv.xz >full_matrix.csv   (reads the compressed file directly)
 
-Four different "clinical trials" are done in parallel.
+Four different "clinical trials" are done in parallel. They are defined in STUDIES, so more
+can be added (e.g. study 5, dose 4 in 2022) and picked with --studies without another pass
+over the file. Each study has its own follow up windows for the death counts (default 365
+days) and its own stratifiers (the columns it's broken down by, from STRATIFIERS, default all).
+--windows uses the same windows for every study instead.
+python full_matrix.py CR_records.csv.xz --studies 1 2 3 4 5 --windows 180 365 >full_matrix.csv
+A study's rows are blank in the columns of windows and stratifiers it doesn't have.
 
 Czech input file format is:
 Sex, Year of Birth, Date of Death, Vax1 date, Vax1 batch code, Vax1 Code, Vax1 Name, <repeat these 4 fields for 7 vaccines>
@@ -28,15 +35,16 @@ irnaty",2022-09-29,,"CO08","Comirnaty Original/Omicron BA.1",2023-10-10,"HH0832"
 
 '''
 
-# import numpy as np
+import numpy as np
 import pandas as pd
-import itertools
 import argparse
-import csv
-from datetime import datetime
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 import sys
 
+import date_codec
+import horizons
+import xz_reader
+
 # start_month is minimum month number for row to be processed
 # set to 1 to get everything.
 # set to 3 to ignore shots given in Jan and Feb 2021
@@ -45,7 +53,7 @@ import sys
 STUDY='STUDY'
 YOB='YOB'
 SEX='SEX'
-MONTH='MONTH'  # enrollment month in 2021 (0 if unvaxxed)
+MONTH='MONTH'  # enrollment month in the study year (0 if unvaxxed)
 MFG1='MFG1'
 MFG2='MFG2'
 MFG3='MFG3'
@@ -62,6 +70,8 @@ I_VD2=I_VD1+4
 I_MFG2=I_MFG1+4
 I_VD3=I_VD2+4
 I_MFG3=I_MFG2+4
+N_DOSES=7
+I_VD=[I_VD1+4*i for i in range(N_DOSES)]   # vax date for each of the 7 doses
 
 # Vax1 date, Vax1 batch code, Vax1 Code, Vax1 Name, 
 # sex
@@ -80,26 +90,14 @@ OTHER="OTHER"
 UNVAX="NONE"
 
 # Define the range of allowable values
-R_STUDY = list(range(1,5))   # four studies (1 shot, 2 shot, 3 shot, unvaxxed)
 R_YOB = range(1920, 2021)  # 1920 to 2020 inclusive
 R_SEX = [MALE, FEMALE, UNKNOWN]
 R_MONTH = list(range(0, 13))  # month in 2021 enrolled in the study. 0 means unvaxxed enrolled in 2022.
 R_MFG = [PFIZER, MODERNA, ASTRA, JANN, NOVAVAX, OTHER, UNVAX]
 
 
-Date=namedtuple('Date', ['month', 'day', 'year']) 
+JAN_2022=date_codec.parse_day("2022-01-01", 'ymd-')
 
-def parse_date(v_date):
-    # return a structure where you can reference .month, .year as numbers. Set all components to 0 if no date
-    # Note: leading spaces in the test file before the date will cause the date to be zero
-    # So , 2021-22-22, has a leading space
-    try:
-        return datetime.strptime(v_date, "%Y-%m-%d")
-    except:
-        return Date(0,0,0)
-    
-JAN_2022=parse_date("2022-01-01")    
-        
 MFG_DICT = {'CO01': PFIZER, 'CO02': MODERNA, 'CO08':PFIZER, 'CO09': PFIZER, 'CO15': MODERNA, 'CO16': PFIZER, 
             'CO19': MODERNA, 'CO20': PFIZER, 'CO21':PFIZER, 'CO23':PFIZER,
              'CO03': ASTRA, 'CO04':JANN, 'CO07': NOVAVAX }
@@ -111,114 +109,163 @@ def parse_mfg(mfg):
     except:
         return OTHER
 
-def died_within_year(dod, date_of_shot):
-    # if didn't die, dod is Date and date_of_shot will be a datetime object
-    # so make this test here to avoid a type mismatch in the subtraction in the last line
-    if dod.year==0:
-        return(False)
-    # compute difference in days
-    days_diff = (dod - date_of_shot).days
-    # Check if the death occurred within 12 months (365 days)
-    return (0 <= days_diff <= 365)
-        
-def track_vaccine_data(filename, start_month):
-    # Initialize dictionaries to keep track of counts
-    # 0 index is 1920, index 100 is 2020
-
-    # indices are [YOB, Sex, Vax type of shot 1, vax type of shot 2, month # of most recent shot]
-
+def parse_dates(values):
+    # day numbers, NO_DATE if there's no date or it doesn't parse
+    # Note: leading spaces in the test file before the date will cause the date to be missing
+    # So , 2021-22-22, has a leading space
+    return date_codec.parse_column(values, 'ymd-', invalid='missing')
+
+def mfg_index(values):
+    # index into R_MFG for each vaccine code
+    codes, uniques = pd.factorize(values)
+    table = np.array([R_MFG.index(parse_mfg(u)) for u in uniques] + [R_MFG.index(UNVAX)], dtype=np.int64)
+    return table[codes]
+
+def sex_index(values):
+    # index into R_SEX, anything but M or F is unknown
+    return np.where(values == MALE, 0, np.where(values == FEMALE, 1, 2))
+
+# The records of a chunk of the file as arrays, one entry per person.
+# vd, year and month are lists with an array for each dose (vd are day
+# numbers, year and month are 0 if there's no date). yob, sex and mfg (a
+# list for doses 1-3) are indexes into R_YOB, R_SEX and R_MFG. start_month
+# is the start_month argument.
+Records = namedtuple('Records', ['n', 'dod', 'vd', 'year', 'month', 'yob', 'sex', 'mfg', 'start_month'])
+
+def shots_in(r, year):
+    # number of shots 1-3 given in year on or after start_month
+    return sum(((r.year[i] == year) & (r.month[i] >= r.start_month)).astype(np.int64) for i in range(3))
+
+# What a study's counts can be broken down by: the column name, its values and
+# index(r, st) the index into the values for each person of the Records r in
+# study st. The output columns are in this order.
+Stratifier = namedtuple('Stratifier', ['values', 'index'])
+STRATIFIERS = {
+    YOB: Stratifier(R_YOB, lambda r, st: r.yob),
+    SEX: Stratifier(R_SEX, lambda r, st: r.sex),
+    MONTH: Stratifier(R_MONTH, lambda r, st: st.month(r)),
+    MFG1: Stratifier(R_MFG, lambda r, st: r.mfg[0]),
+    MFG2: Stratifier(R_MFG, lambda r, st: r.mfg[1]),
+    MFG3: Stratifier(R_MFG, lambda r, st: r.mfg[2]),
+}
+
+# the follow up windows (days) and stratifiers of a study unless it says otherwise
+DEFAULT_WINDOWS = [365]
+DEFAULT_STRATA = list(STRATIFIERS)
+
+# A study enrolls the people where enroll(r) is true, on their index date
+# index_date(r), in the enrollment month month(r) (0-12), and counts the deaths
+# in each of its follow up windows (days) from the index date, by its strata
+# (names in STRATIFIERS). enroll, index_date and month are functions of the
+# Records of a chunk returning an array. Enrollment condition must NEVER look
+# forward in time to determine enrollment eligibility!
+# The default strata record mfg of the first three doses, so a given record can tally
+# to no rows, one row, or several rows.
+Study = namedtuple('Study', ['number', 'enroll', 'index_date', 'month', 'windows', 'strata'],
+                   defaults=(DEFAULT_WINDOWS, DEFAULT_STRATA))
+
+STUDIES = [
+    # STUDY #1: got shot #1 in 2021. Enroll on shot #1 date.
+    Study(1, lambda r: r.year[0] == 2021, lambda r: r.vd[0], lambda r: r.month[0]),
+    # STUDY #2: got shot #2 in 2021. Enroll on second shot date.
+    Study(2, lambda r: r.year[1] == 2021, lambda r: r.vd[1], lambda r: r.month[1]),
+    # STUDY #3: got shot #3 in 2021. Enroll on third shot date.
+    Study(3, lambda r: r.year[2] == 2021, lambda r: r.vd[2], lambda r: r.month[2]),
+    # Study #4: got no shots in 2021 (on or after start_month), enroll on Jan 1, 2022.
+    # Shows mfg of all 3 shots (usually UUU) since might have gotten all shots in 2022.
     # How we handle the unvaccinated:
     # Don't do anything special for unvaccinated (which is just a UU) tally; just do not ignore them!!
-    # however, unvaccinated must die > July 1, 2021 or not die to be considered as UU. Only deaths before July 1,2022 are counted.
-
-    # Lists are too inefficent
-    # shot_count = [[[[0 for _ in range(4)] for _ in range(4)] for _ in range(3)] for _ in range(101)]
-    # can do this, but dataframes are better:
-    # shot_count = np.zeros((101,3,4,4,12), dtype=int)
-    # death_count = np.zeros((101,3,4,4,12), dtype=int)   # death within 1 yr of most recent shot
-
-    # Generate all combinations of the categories. MFG is listed twice since dose 1 vs. dose 2
-    combinations = list(itertools.product(R_STUDY, R_YOB, R_SEX, R_MONTH, R_MFG, R_MFG, R_MFG))
-
-    # Create a DataFrame with MultiIndex
-    index = pd.MultiIndex.from_tuples(combinations, names=[STUDY, YOB, SEX, MONTH, MFG1, MFG2, MFG3])
-
-    # now append the two counters to use at that index location and set counters to zero
-    df = pd.DataFrame(index=index, columns=[NUM_ENROLLED, NUM_DIED]).fillna(0)
-
-    # output will iterate over the indices and output a column for each index value as well as two columns for the shot and death counts
-    # so there are 6 output columns and 48 rows for each of 101 birth years, so 4848 rows x 6 columns so 29,088 cells with data
-
-    # Open the file and read it line by line
-
-    with open(filename, 'r') as file:
-        reader = csv.reader(file)
-        reader.__next__()  # bypass header
-
-        for row in reader:
-            # Extract the relevant fields from the Czech source file. Everything is read as a string.
-            sex=row[I_SEX]
-            sex=sex if sex !='' else UNKNOWN
-            yob=int(row[I_YOB])
-            if not yob in R_YOB:
-                continue  # ignore the row if not in years I track
-            dod=parse_date(row[I_DOD])
-
-            vd1=parse_date(row[I_VD1])
-            mfg1=parse_mfg(row[I_MFG1])
-            vd2=parse_date(row[I_VD2])
-            mfg2=parse_mfg(row[I_MFG2])
-            vd3=parse_date(row[I_VD3])
-            mfg3=parse_mfg(row[I_MFG3])
-                
-            # get the number of eligible shots given in 2021 which determine which studies the person is eligible for
-            num_shots_2021 = sum(1 for vax_date in [vd1, vd2, vd3] if vax_date.year == 2021 and vax_date.month >=start_month)
-            
-            # Enrollment condition must NEVER look forward in time to determine enrollment eligibility! 
-            # So we have an enroll on got first shot in 2021 to tally shot, then record death 1 year from enroll
-            # And we have an enroll on got second vax in 2021 condition to tally shot, and record death 1 yr from enroll. 
-            # We track the type of the first vax for this enrollment type.
-            # And we have an enroll on no vax at all given in 2021, enroll on Jan 1 2022, and record death if happened in 2022
-            # so that means a given record can tally to no rows, one row, or two rows!!!
-            
-            # simply record all 3 vaccines in the record with month
-            # extend record to cover 0 as a month
-            # all tallies show the vaccine count details for 3 vaccines. 
-
-            # record month enrolled, list mfg1, mfg2, mfg3 slot values
-
-            # STUDY #1: got shot #1 in 2021 on or after start_month. Enroll on shot #1 date. Death counted if within 1 yr from enroll
-            # Record mfg of all three doses.
-
-            if vd1.year==2021:
-                df.loc[(1, yob, sex, vd1.month,mfg1, mfg2, mfg3), NUM_ENROLLED] += 1 
-                if died_within_year(dod,vd1):
-                     df.loc[(1, yob, sex, vd1.month, mfg1, mfg2, mfg3), NUM_DIED] += 1
-             
-            # STUDY #2: got shot #2 in 2021 where second shot on or after start_month. Enroll on second shot date. 
-            # Death counted for 1 year from enroll. Record mfg of all 3 vax.
-            if vd2.year==2021:
-                df.loc[(2, yob, sex, vd2.month, mfg1, mfg2, mfg3), NUM_ENROLLED] += 1
-                if died_within_year(dod,vd2):
-                     df.loc[(2, yob, sex, vd2.month, mfg1, mfg2, mfg3), NUM_DIED] += 1
-            
-            # STUDY #3: got shot #2 in 2021 where second shot on or after start_month. Enroll on second shot date. 
-            # Death counted for 1 year from enroll. Record mfg of all 3 vax.
-            if vd3.year==2021:
-                df.loc[(3, yob, sex, vd3.month, mfg1, mfg2, mfg3), NUM_ENROLLED] += 1 
-                if died_within_year(dod,vd3):
-                     df.loc[(3, yob, sex, vd3.month, mfg1, mfg2, mfg3), NUM_DIED] += 1            
-            # Study #4: got no shots in 2021 and alive on Jan 1, 2022. Death counted for 1 year from enroll.
-            # Show mfg of all 3 shots (usually UUU) since might have gotten all shots in 2022.
-            if num_shots_2021 ==0:
-                df.loc[(4, yob, sex, 0 , mfg1, mfg2, mfg3), NUM_ENROLLED] += 1 
-                if died_within_year(dod, JAN_2022):
-                     df.loc[(4, yob, sex, 0, mfg1, mfg2, mfg3), NUM_DIED] += 1                     
-    
-    # remove rows with enrollment=0 to make things more managable
-    df = df[df[NUM_ENROLLED] != 0]
+    Study(4, lambda r: shots_in(r, 2021) == 0, lambda r: np.full(r.n, JAN_2022), lambda r: np.zeros(r.n, dtype=np.int32)),
+    # Study #5: got shot #4 in 2022. Enroll on the fourth shot date.
+    Study(5, lambda r: r.year[3] == 2022, lambda r: r.vd[3], lambda r: r.month[3]),
+]
+
+# the studies computed by default
+DEFAULT_STUDIES = [1, 2, 3, 4]
+
+class StudyCounts:
+    # The counts of one study in a dense tensor, an integer axis per stratum
+    # (101 x 3 x 13 x 7 x 7 x 7, about 1.3M cells with the default strata).
+    # Deaths are counted by follow up window bin (see horizons.py) in an
+    # extra last axis and cumulated over the windows at the end.
+    def __init__(self, st, windows=None):
+        self.st = st
+        self.windows = sorted(set(windows or st.windows))
+        self.shape = tuple(len(STRATIFIERS[name].values) for name in st.strata)
+        self.enrolled = np.zeros(self.shape, dtype=np.int64)
+        self.died = np.zeros(self.shape + (len(self.windows) + 1,), dtype=np.int64)
+
+    def add(self, r, valid):
+        # adds the people of the Records r enrolled in the study (and valid)
+        st = self.st
+        sel = valid & st.enroll(r)
+        cell = np.ravel_multi_index(tuple(STRATIFIERS[name].index(r, st)[sel] for name in st.strata), self.shape)
+        np.add.at(self.enrolled.reshape(-1), cell, 1)
+        # days from the index date to death, no death is past every window
+        days = r.dod[sel].astype(np.int64) - st.index_date(r)[sel]
+        np.add.at(self.died.reshape(-1), cell * (len(self.windows) + 1) + horizons.horizon_bins(days, self.windows, lower=0), 1)
+
+    def frame(self, plain):
+        # DataFrame of the cells with anyone enrolled: STUDY, the strata, # enrolled and the deaths
+        # columns, a "# died within Nd" for each window or just "# died" if plain
+        died = np.cumsum(self.died[..., :len(self.windows)], axis=-1).reshape(-1, len(self.windows))
+        # remove rows with enrollment=0 to make things more managable
+        cells = np.flatnonzero(self.enrolled)
+        coords = np.unravel_index(cells, self.shape)
+        df = pd.DataFrame({STUDY: np.full(len(cells), self.st.number)})
+        for (name, c) in zip(self.st.strata, coords):
+            df[name] = np.asarray(STRATIFIERS[name].values)[c]
+        df[NUM_ENROLLED] = self.enrolled.reshape(-1)[cells]
+        for (w, window) in enumerate(self.windows):
+            df[NUM_DIED if plain else f'{NUM_DIED} within {window}d'] = died[cells, w]
+        return df
+
+def track_vaccine_data(filename, start_month, studies=DEFAULT_STUDIES, windows=None):
+    # Each study is counted in its own dense tensor (see StudyCounts) and the
+    # records of each chunk of the file are added in with np.add.at for every
+    # study, so the file is read once however many studies there are.
+    # windows (days) replaces the follow up windows of every study if given.
+    counts = [StudyCounts(st, windows) for st in STUDIES if st.number in studies]
+
+    # the columns we need, filename can be the .xz file
+    usecols = sorted([I_SEX, I_YOB, I_DOD, I_MFG1, I_MFG2, I_MFG3] + I_VD)
+    for chunk in xz_reader.iter_chunks(filename, usecols=usecols, dtype=str, keep_default_na=False):
+        # Extract the relevant fields from the Czech source file. Everything is read as a string.
+        cols = dict(zip(usecols, (chunk.iloc[:, i].fillna('').to_numpy() for i in range(len(usecols)))))
+        yob = pd.to_numeric(cols[I_YOB], errors='coerce')
+        # ignore the row if not in years I track
+        valid = (yob >= R_YOB[0]) & (yob <= R_YOB[-1])
+        yob = np.where(valid, yob - R_YOB[0], 0).astype(np.int64)
+        mfg = [mfg_index(cols[c]) for c in (I_MFG1, I_MFG2, I_MFG3)]
+
+        vd = [parse_dates(cols[c]) for c in I_VD]
+        ym = [date_codec.year_month(d) for d in vd]
+        r = Records(len(chunk), parse_dates(cols[I_DOD]), vd, [y for (y, m) in ym], [m for (y, m) in ym],
+                    yob, sex_index(cols[I_SEX]), mfg, start_month)
+
+        for c in counts:
+            c.add(r, valid)
+
+    # one row per study and cell, the columns of every study's strata and windows
+    # the usual 1 year window is just "# died" when it's the only one
+    plain = all(c.windows == [365] for c in counts)
+    strata = [name for name in STRATIFIERS if any(name in c.st.strata for c in counts)]
+    windows = sorted(set(w for c in counts for w in c.windows))
+    died_cols = [NUM_DIED] if plain else [f'{NUM_DIED} within {w}d' for w in windows]
+    frames = []
+    for c in counts:
+        df = c.frame(plain)
+        # a study without a stratum or window is blank there (and the counts stay whole numbers)
+        for name in strata:
+            if name not in df.columns:
+                df[name] = ''
+        for col in died_cols:
+            if col not in df.columns:
+                df[col] = pd.array([pd.NA] * len(df), dtype='Int64')
+        frames.append(df[[STUDY] + strata + [NUM_ENROLLED] + died_cols])
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
     # Write the compact DataFrame to CSV file
-    df.to_csv(sys.stdout)
+    df.set_index([STUDY] + strata).to_csv(sys.stdout)
 
 if __name__ == "__main__":
     # Set up argument parsing
@@ -226,10 +273,14 @@ if __name__ == "__main__":
     parser.add_argument('filename', type=str, help='The CSV file to process')
     # optional positional arg with default
     parser.add_argument('start_month', nargs='?', default=1, type=int, help='Min vax month to process')    
+    parser.add_argument('--studies', type=int, nargs='+', default=DEFAULT_STUDIES, choices=[st.number for st in STUDIES],
+                        help=f"studies to compute, from {', '.join(str(st.number) for st in STUDIES)} (default {' '.join(map(str, DEFAULT_STUDIES))})")
+    parser.add_argument('--windows', type=int, nargs='+', default=None,
+                        help="follow up windows in days for the death counts of every study (default each study's own, 365)")
     # Parse the arguments
     args = parser.parse_args()
     
     # Call the function with the provided filename
-    track_vaccine_data(args.filename, args.start_month)
+    track_vaccine_data(args.filename, args.start_month, args.studies, args.windows)
 
 
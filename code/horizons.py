@@ -0,0 +1,67 @@
+# Counting deaths within several follow up horizons at once
+#
+# vax.py used to add a bool column per dose and horizon (death within 30,
+# 60, ... 750 days, 75 full length columns) and sum them in the groupby, and
+# full_matrix.py tested each follow up window separately. Here the days from
+# the index date to death are computed once per person and binned into the
+# sorted horizons with np.searchsorted: bin i means the death is within
+# horizons[i] days but not within horizons[i-1], and len(horizons) means it
+# isn't within any of them (or there is no death). Counting the bins per
+# group (a histogram) and taking the cumsum over the bins gives the deaths
+# within every horizon, so memory goes with groups x horizons, not with
+# people x horizons.
+#
+# For record level 0/1 columns (like vax_24.py's Died_ columns, summed by
+# a groupby) within_horizons makes them from the same bins, and in_windows
+# flags dates in named calendar windows, with whole array operations.
+#
+# Example usage:
+#   bins = horizons.horizon_bins(days_to_death, [30, 60, 90])
+#   deaths = horizons.cumulative_counts(group_codes, n_groups, bins, 3)   # deaths[g, i] died within 30/60/90 days
+#   died = horizons.within_horizons(days_to_death, [30, 60, 90], lower=0)   # {30: 0/1 array, ...}
+#   flags = horizons.in_windows(death_dates, {'summer_2021': ('2021-05-30', '2021-10-12')})
+
+import numpy as np
+
+
+def horizon_bins(days, horizons, lower=None):
+    # bin of each person's days to death (NaN or NA for no death, or past
+    # every horizon, as NO_DATE day numbers give). horizons must be sorted. A death is within horizon t if
+    # days <= t (and lower <= days if lower is given, e.g. 0 to leave out
+    # deaths before the index date).
+    days = np.asarray(days, dtype=np.float64)   # a nullable Int array's missing values become NaN
+    horizons = np.asarray(horizons)
+    bins = np.searchsorted(horizons, days, side='left')
+    out = np.isnan(days)
+    if lower is not None:
+        out |= days < lower
+    bins[out] = len(horizons)
+    return bins.astype(np.int16 if len(horizons) < np.iinfo(np.int16).max else np.int64)
+
+
+def cumulative_counts(codes, n_groups, bins, n_horizons, counts=None):
+    # (n_groups, n_horizons) array of the people in each group within each
+    # horizon, from their group codes (0 .. n_groups-1) and horizon_bins.
+    # counts is the number of people for each entry if they were already
+    # counted (e.g. by aggregate.cell_histogram), default one each.
+    cell = codes.astype(np.int64) * (n_horizons + 1) + bins
+    hist = np.bincount(cell, weights=counts, minlength=n_groups * (n_horizons + 1)).astype(np.int64)
+    hist = hist.reshape(n_groups, n_horizons + 1)[:, :n_horizons]
+    return np.cumsum(hist, axis=1)
+
+
+def within_horizons(days, horizons, lower=None):
+    # {horizon: int8 array, 1 if the death is within it} for any list of
+    # horizons, days as for horizon_bins (a nullable Int Series is fine)
+    order = sorted(horizons)
+    bins = horizon_bins(days, order, lower)
+    return {t: (bins <= order.index(t)).astype(np.int8) for t in horizons}
+
+
+def in_windows(dates, windows):
+    # {name: int8 array, 1 if the date is in the window} for windows
+    # {name: (first day, last day)} given as 'Y-m-d' strings, inclusive.
+    # dates is datetime64, NaT is in no window.
+    dates = np.asarray(dates)
+    return {name: ((dates >= np.datetime64(start)) & (dates <= np.datetime64(end))).astype(np.int8)
+            for (name, (start, end)) in windows.items()}
@@ -0,0 +1,178 @@
+# Columnar store of the KCOR tables, a partition per enrollment date
+#
+# old/KCOR.py wrote a sheet of KCOR_output.xlsx per enrollment date with
+# xlsxwriter and KCOR_analysis_no_detrend.py read the sheets back one by one
+# with pd.read_excel. Both took most of the run time, and a sheet can't hold
+# more than 1,048,576 rows. Here the tables are written as a Parquet dataset
+# partitioned by enrollment date:
+#   DIR/enrollment=2021-24/part-0.parquet
+#   DIR/_enrollments.json   (the enrollment dates in the order written)
+# and read back a partition at a time. The partitions are named like the
+# sheets were, so the analysis gets the enrollment date from the name as
+# before. An .xlsx with a sheet per enrollment date is only made for people
+# to look at (the export command). The readers and writers here take an
+# .xlsx path too, so the old workbooks and KCOR_test_data.xlsx still work.
+# A store is written next to its path and swapped in when complete, and
+# only ever replaces an older store, never a directory with other files.
+#
+# Example usage (run from the code directory):
+#   python old/KCOR.py ../data/vax_24.parquet ../data/KCOR_output
+#   python kcor_store.py list ../data/KCOR_output
+#   python kcor_store.py export ../data/KCOR_output ../data/KCOR_output.xlsx
+#
+# Needs pyarrow (pip install pyarrow), and xlsxwriter to write an .xlsx
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+ORDER_FILE = '_enrollments.json'
+PARTITION = 'enrollment'
+
+
+def need_pyarrow():
+    if pa is None:
+        raise ImportError('the KCOR store needs pyarrow (pip install pyarrow)')
+
+
+def is_xlsx(path):
+    # an .xlsx is a workbook, anything else is taken to be a store directory
+    return str(path).endswith('.xlsx')
+
+
+def partition_dir(path, enrollment):
+    return os.path.join(path, f'{PARTITION}={enrollment}')
+
+
+def is_store(path):
+    # True if path is a directory holding a KCOR store and nothing else
+    if not os.path.isdir(path):
+        return False
+    names = os.listdir(path)
+    return ORDER_FILE in names and all(name == ORDER_FILE or name.startswith(f'{PARTITION}=') for name in names)
+
+
+def check_replaceable(path):
+    # a store can only be written over an old store, never over other files
+    if os.path.lexists(path) and not is_store(path):
+        raise ValueError(f'{path} exists and is not a KCOR store, not replacing it')
+
+
+class StoreWriter:
+    # writes a table per enrollment date to a new store at path. The store is
+    # built in a temporary directory next to path and only moved there by
+    # close(), replacing an old store at path (but nothing else).
+    def __init__(self, path):
+        need_pyarrow()
+        path = os.path.normpath(path)
+        check_replaceable(path)
+        self.path = path
+        self.tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+        self.enrollments = []
+
+    def write(self, enrollment, df):
+        part = partition_dir(self.tmp, enrollment)
+        os.makedirs(part, exist_ok=True)
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(part, 'part-0.parquet'),
+                       compression='zstd')
+        self.enrollments.append(enrollment)
+
+    def close(self):
+        with open(os.path.join(self.tmp, ORDER_FILE), 'w') as f:
+            json.dump(self.enrollments, f)
+        check_replaceable(self.path)   # in case something was put there while writing
+        old = None
+        if os.path.lexists(self.path):
+            print(f'replacing {self.path}')
+            old = self.tmp + '.old'
+            os.replace(self.path, old)
+        os.replace(self.tmp, self.path)
+        if old is not None:
+            shutil.rmtree(old)
+
+
+class WorkbookWriter:
+    # the same for an .xlsx, a sheet per enrollment date
+    def __init__(self, path):
+        self.writer = pd.ExcelWriter(path, engine='xlsxwriter')
+
+    def write(self, enrollment, df):
+        df.to_excel(self.writer, sheet_name=str(enrollment)[:31], index=False)
+
+    def close(self):
+        self.writer.close()
+
+
+def writer(path):
+    # a writer for path: a store, or a workbook if it ends in .xlsx
+    return WorkbookWriter(path) if is_xlsx(path) else StoreWriter(path)
+
+
+def enrollments(path):
+    # the enrollment dates (sheet names) in path, in the order they were written
+    if is_xlsx(path):
+        return pd.ExcelFile(path).sheet_names
+    order = os.path.join(path, ORDER_FILE)
+    if os.path.exists(order):
+        with open(order) as f:
+            return json.load(f)
+    prefix = f'{PARTITION}='
+    return sorted(name[len(prefix):] for name in os.listdir(path) if name.startswith(prefix))
+
+
+def read(path, enrollment, columns=None):
+    # the table of one enrollment date
+    if is_xlsx(path):
+        df = pd.read_excel(path, sheet_name=enrollment)
+        return df if columns is None else df[columns]
+    need_pyarrow()
+    return pq.read_table(os.path.join(partition_dir(path, enrollment), 'part-0.parquet'), columns=columns).to_pandas()
+
+
+def iter_tables(path, columns=None):
+    # (enrollment, DataFrame) for each enrollment date in path
+    if is_xlsx(path):
+        with pd.ExcelFile(path) as book:
+            for sheet in book.sheet_names:
+                df = book.parse(sheet)
+                yield (sheet, df if columns is None else df[columns])
+        return
+    for enrollment in enrollments(path):
+        yield (enrollment, read(path, enrollment, columns))
+
+
+def export(path, xlsx):
+    # the store as a workbook, a sheet per enrollment date
+    out = WorkbookWriter(xlsx)
+    for (enrollment, df) in iter_tables(path):
+        out.write(enrollment, df)
+    out.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List or export the KCOR store (a Parquet partition per enrollment date).")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('list', help='the enrollment dates and their rows')
+    p.add_argument('store')
+    p = sub.add_parser('export', help='write the store as an .xlsx, a sheet per enrollment date')
+    p.add_argument('store')
+    p.add_argument('xlsx')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for (enrollment, df) in iter_tables(args.store):
+            print(f'{enrollment}\t{len(df)} rows')
+    elif args.command == 'export':
+        export(args.store, args.xlsx)
+        print(f'wrote {args.xlsx}')
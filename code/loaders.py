@@ -0,0 +1,189 @@
+# Typed loading of the Czech record files for vax.py and vax_24.py
+#
+# The scripts read the files with pd.read_csv and kept the vaccine codes,
+# lot numbers, brand names and date labels as Python string (object)
+# columns, and vax_24.py kept all 53 columns of vax_24.csv. Here only the
+# columns asked for are read (the file can be the .xz, see xz_reader.py) and
+# each gets a compact type:
+#   CATEGORY   categorical, categories sorted so groupby order is unchanged
+#   CODE       categorical of the values stripped and upper cased
+#   NUMBER     smallest int type (int16 for years) if every value is whole, else float32
+#   YEAR       Int16 (nullable), the first year of a range like 1950-1954
+#              (decode_yob gives plain ints with a NO_YEAR sentinel and a range check)
+#   DATE       datetime64 from Y-m-d
+#   ISO_WEEK   datetime64 of the Monday of an ISO week like 2021-05
+# Every conversion is done once per distinct value, not once per row.
+# Categorical columns should be grouped with observed=True.
+#
+# Example usage:
+#   df = loaders.load_cr('../data/CR_records.csv.xz', ['Rok_narozeni', 'Datum_1', 'OckovaciLatka_1'])
+#   df = loaders.load_vax24('../data/vax_24.csv', ['YearOfBirth', 'Date_FirstDose', 'VaccineCode_FirstDose'])
+#   for df in loaders.iter_vax24('../data/vax_24.csv', ['YearOfBirth', 'DateOfDeath'], 1_000_000):
+#       ...
+
+import datetime
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import date_codec
+import xz_reader
+
+# what decode_yob gives for a missing or invalid year of birth
+NO_YEAR = -1
+
+CATEGORY = 'category'
+CODE = 'code'
+NUMBER = 'number'
+YEAR = 'year'
+DATE = 'date'
+ISO_WEEK = 'iso_week'
+
+# CR_records.csv (the FOIA data), column -> kind
+CR_KINDS = {'Pohlavikod': CATEGORY, 'Rok_narozeni': NUMBER, 'DatumUmrti': DATE}
+for i in range(1, 8):
+    CR_KINDS.update({f'Datum_{i}': DATE, f'Sarze_{i}': CODE, f'OckovaciLatka_{i}': CATEGORY, f'Nazev_{i}': CATEGORY})
+
+# vax_24.csv (the Nov 2024 data) has Czech column names, these are the English ones in file order
+VAX24_COLUMNS = [
+    'ID', 'Infection', 'Gender', 'YearOfBirth', 'DateOfPositiveTest', 'DateOfResult', 'Recovered', 'Date_COVID_death',
+    'Symptom', 'TestType', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose',
+    'Date_FifthDose', 'Date_SixthDose', 'Date_SeventhDose', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose',
+    'VaccineCode_ThirdDose', 'VaccineCode_FourthDose', 'VaccineCode_FifthDose', 'VaccineCode_SixthDose',
+    'VaccineCode_SeventhDose', 'PrimaryCauseHospCOVID', 'bin_Hospitalization', 'min_Hospitalization',
+    'days_Hospitalization', 'max_Hospitalization', 'bin_ICU', 'min_ICU', 'days_ICU', 'max_ICU', 'bin_StandardWard',
+    'min_StandardWard', 'days_StandardWard', 'max_StandardWard', 'bin_Oxygen', 'min_Oxygen', 'days_Oxygen',
+    'max_Oxygen', 'bin_HFNO', 'min_HFNO', 'days_HFNO', 'max_HFNO', 'bin_MechanicalVentilation_ECMO',
+    'min_MechanicalVentilation_ECMO', 'days_MechanicalVentilation_ECMO', 'max_MechanicalVentilation_ECMO',
+    'Mutation', 'DateOfDeath', 'Long_COVID', 'DCCI']
+
+# column -> kind, the columns not listed are NUMBER
+VAX24_KINDS = {'ID': NUMBER, 'Gender': CATEGORY, 'YearOfBirth': YEAR, 'Symptom': CATEGORY, 'TestType': CATEGORY,
+               'PrimaryCauseHospCOVID': CATEGORY, 'Mutation': CATEGORY}
+VAX24_KINDS.update({col: ISO_WEEK for col in VAX24_COLUMNS if col.startswith('Date')})
+VAX24_KINDS.update({col: CODE for col in VAX24_COLUMNS if col.startswith('VaccineCode')})
+
+
+def categorical(codes, labels):
+    # Categorical with labels[codes] (code -1 missing) whose categories
+    # are the labels sorted, so it groups and sorts like the strings did
+    labels = pd.Index(labels)
+    cats = labels.dropna().unique().sort_values()
+    table = np.append(cats.get_indexer(labels), -1)
+    return pd.Categorical.from_codes(table[codes], categories=cats)
+
+
+def add_categories(values, new):
+    # values (a categorical Series) with room for the new labels, keeping the categories sorted
+    cats = values.cat.categories
+    return values.cat.set_categories(cats.append(pd.Index(new).difference(cats)).sort_values())
+
+
+def date_labels(dates, fmt):
+    # categorical of dates formatted with strftime fmt (e.g. '%m-%Y' for the month), NaN for NaT
+    codes, uniques = pd.factorize(dates)
+    return categorical(codes, pd.DatetimeIndex(uniques).strftime(fmt))
+
+
+def first_year(values):
+    # float Series of the year each value starts with: 1950 for '1950-1954', 1950 or 1950.0, NaN if none
+    text = pd.Series(values, dtype=object).astype(str)
+    return pd.to_numeric(text.str.extract(r'^\s*(\d{4})', expand=False), errors='coerce').astype(np.float64)
+
+
+def decode_yob(values, missing=NO_YEAR, first=1900, last=None):
+    # int array of the years of birth in values (range strings like '1950-1954'
+    # from the CSV, the store's Int16 or numbers), decoded once per distinct
+    # value. Missing values and years outside first..last (last defaults to
+    # this year) are missing.
+    last = last or datetime.date.today().year
+    codes, uniques = pd.factorize(pd.Series(values))
+    years = first_year(uniques).to_numpy()
+    table = np.append(np.where((years >= first) & (years <= last), years, missing), missing).astype(np.int64)
+    return table[codes]
+
+
+def compact_number(values):
+    # the smallest int type if all the values are there and whole, else
+    # float32 (float64 if they're too big for it to hold exactly)
+    if values.notna().all() and (values % 1 == 0).all():
+        return pd.to_numeric(values, downcast='integer')
+    return values.astype(np.float32 if values.abs().max() < 1 << 24 else np.float64)
+
+
+def convert(values, kind):
+    # one column of strings (NaN for empty) to the compact type for kind
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    if kind == CATEGORY:
+        return categorical(codes, uniques)
+    if kind == CODE:
+        return categorical(codes, uniques.str.strip().str.upper())
+    if kind == DATE:
+        table = pd.to_datetime(uniques.str.strip(), format='%Y-%m-%d', errors='coerce')
+    elif kind == ISO_WEEK:
+        table = date_codec.iso_week_column(uniques)
+    elif kind == YEAR:
+        table = first_year(uniques).astype('Int16')
+    else:
+        table = pd.to_numeric(uniques, errors='coerce').astype(np.float64)
+    # the extra entry at the end is for the missing values, which factorize codes as -1
+    values = table.reindex(range(len(table) + 1)).take(codes).reset_index(drop=True)
+    return compact_number(values).array if kind == NUMBER else values.array
+
+
+def concat(parts):
+    # DataFrames with the same columns as one, categoricals get the union of the categories (sorted)
+    if len(parts) == 1:
+        return parts[0]
+    cols = {}
+    for name in parts[0].columns:
+        values = [part[name] for part in parts]
+        if isinstance(values[0].dtype, pd.CategoricalDtype):
+            cols[name] = union_categoricals(values, sort_categories=True)
+        else:
+            cols[name] = pd.concat(values, ignore_index=True)
+    return pd.DataFrame(cols)
+
+
+def typed(chunk, kinds, names):
+    # a chunk of string columns converted by kinds and named names
+    return pd.DataFrame({name: convert(chunk.iloc[:, i], kind) for (i, (name, kind)) in enumerate(zip(names, kinds))})
+
+
+def read_typed(fname, usecols, kinds, names, workers=None):
+    # the usecols columns of fname converted by kinds and named names. Each
+    # block is converted as it's read so the strings are never all in memory.
+    parts = [typed(chunk, kinds, names) for chunk in xz_reader.iter_chunks(fname, workers, usecols=usecols, dtype=str)]
+    if not parts:
+        return pd.DataFrame(columns=names)
+    return concat(parts)
+
+
+def load_cr(fname, columns, names=None, workers=None):
+    # the columns of CR_records.csv (file order), renamed to names if given
+    names = names or columns
+    header = list(pd.read_csv(fname, nrows=0).columns)
+    order = sorted(range(len(columns)), key=lambda i: header.index(columns[i]))
+    return read_typed(fname, columns, [CR_KINDS[columns[i]] for i in order], [names[i] for i in order], workers)
+
+
+def load_vax24(fname, columns, workers=None):
+    # the columns (English names) of vax_24.csv, in file order
+    usecols = sorted(VAX24_COLUMNS.index(col) for col in columns)
+    names = [VAX24_COLUMNS[i] for i in usecols]
+    return read_typed(fname, usecols, [VAX24_KINDS.get(col, NUMBER) for col in names], names, workers)
+
+
+def iter_vax24(fname, columns, chunksize):
+    # the same as load_vax24 a chunksize rows DataFrame at a time, read in
+    # this process so only one chunk of the text is in memory. Each chunk
+    # has its own categories, and a NUMBER column can be an int type in one
+    # chunk and float in another.
+    usecols = sorted(VAX24_COLUMNS.index(col) for col in columns)
+    names = [VAX24_COLUMNS[i] for i in usecols]
+    kinds = [VAX24_KINDS.get(col, NUMBER) for col in names]
+    with pd.read_csv(fname, usecols=usecols, dtype=str, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield typed(chunk, kinds, names)
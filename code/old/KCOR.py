@@ -8,14 +8,25 @@
 # 
 #           cd code; make KCOR
 # 
-# The output file is in the data directory (specified in Makefile)
-#     KCOR.xlsx
+# The output is in the data directory (specified in Makefile)
+#     KCOR_output, a Parquet partition per enrollment date (see kcor_store.py)
+#     make KCOR-xlsx exports it to KCOR_output.xlsx
 
 import pandas as pd
 import numpy as np
-from pandas import ExcelWriter
 import datetime
 import itertools
+import os
+import sys
+
+# aggregate.py, date_codec.py, enrollment.py, kcor_store.py, loaders.py and vax24_store.py are in the code directory above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import aggregate
+import date_codec
+import enrollment
+import kcor_store
+import loaders
+import vax24_store
 
 
 #
@@ -113,58 +124,52 @@ COVID_died_and_unvaxxed='COVID_died_and_unvaxxed'
 # just for reference. I have to process each field manually 
 
 
-def main(data_file, output_file):
-    # Load the CSV file into a DataFrame. 
-    # I have plenty of memory so let pandas know that to avoid type errors on dose 6 which happens later in the fil
-
+def iso_weeks(first, last):
+    # the ISO weeks ('YYYY-WW') from first to last inclusive
+    mondays = pd.date_range(date_codec.parse_iso_week(first), date_codec.parse_iso_week(last), freq='7D')
+    return list(mondays.strftime('%G-%V'))
+
+
+def write_sweep(output_file, cube, cell_group, keys, dose_dates, enrollment_dates, enroll_timestamps):
+    # Write the counts at every enrollment week as one compact cube, a row for each enrollment week,
+    # YearOfBirth, DateOfDeath (the Monday of the death week), Gender and dose group that has anyone
+    # in it: EnrollmentWeek, YearOfBirth, DateOfDeath, Gender, dose_group, Count.
+    # Parquet if output_file ends in .parquet (needs pyarrow), else CSV.
+    print(f"Sweeping {len(enrollment_dates)} enrollment weeks {enrollment_dates[0]} to {enrollment_dates[-1]}")
+    (k, cell, group, count) = enrollment.sweep_cube(cube.row_cell, len(cube.size), dose_dates, enroll_timestamps, max_group=5)
+    # the cube cells are the groups here, cell_group maps them to the rows of keys
+    out = keys.take(cell_group[cell]).reset_index(drop=True)
+    out.insert(0, 'EnrollmentWeek', pd.Categorical.from_codes(k, categories=enrollment_dates))
+    out['dose_group'] = group
+    out['Count'] = count
+    if output_file.endswith('.parquet'):
+        out.to_parquet(output_file, index=False)
+    else:
+        out.to_csv(output_file, index=False)
+    print(f"Cube of {len(out)} rows written to {output_file}")
+
+
+def main(data_file, output_file, sweep_weeks=None):
+    # Load the columns we use into a DataFrame.
     print(f"Loading data from {data_file}")
-    data = pd.read_csv(data_file, low_memory=False)
-    print(f"Data loaded with {len(data)} rows and {len(data.columns)} columns")
-    
-    # rename the columns in English
-    data.columns = [
-        'ID', 'Infection', 'Gender', 'YearOfBirth', 'DateOfPositiveTest', 'DateOfResult', 'Recovered', 'Date_COVID_death',
-        'Symptom', 'TestType', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose',
-        'Date_FifthDose', 'Date_SixthDose', 'Date_SeventhDose', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose',
-        'VaccineCode_ThirdDose', 'VaccineCode_FourthDose', 'VaccineCode_FifthDose', 'VaccineCode_SixthDose',
-        'VaccineCode_SeventhDose', 'PrimaryCauseHospCOVID', 'bin_Hospitalization', 'min_Hospitalization',
-        'days_Hospitalization', 'max_Hospitalization', 'bin_ICU', 'min_ICU', 'days_ICU', 'max_ICU', 'bin_StandardWard',
-        'min_StandardWard', 'days_StandardWard', 'max_StandardWard', 'bin_Oxygen', 'min_Oxygen', 'days_Oxygen',
-        'max_Oxygen', 'bin_HFNO', 'min_HFNO', 'days_HFNO', 'max_HFNO', 'bin_MechanicalVentilation_ECMO',
-        'min_MechanicalVentilation_ECMO', 'days_MechanicalVentilation_ECMO', 'max_MechanicalVentilation_ECMO',
-        'Mutation', 'DateOfDeath', 'Long_COVID', 'DCCI']
-
-    # Convert all columns starting with 'Date' from ISO week format to datetime
-    print(f"Converting date columns from ISO week format...")
-    date_cols = [col for col in data.columns if col.startswith('Date')]
-    for col in date_cols:
-        print(f"  Converting {col}...")
-        # Keep as pandas Timestamp for efficient comparisons (don't convert to .date)
-        data[col] = pd.to_datetime(data[col] + '-1', format='%G-%V-%u', errors='coerce')
-    print(f"Date conversion complete.")
-    
+    # data_file can be the vax_24 store (see vax24_store.py) or vax_24.csv itself. Either way the columns
+    # are named in English and the dates are converted from the ISO week format to pandas Timestamps
+    # (kept as Timestamps for efficient comparisons, not converted to .date).
     # if you got infected more than once, it will create a duplicate record (with a different ID) so
-    # remove those records so we don't double count the deaths.
-
-    # Remove records where Infection > 1
-    data = data[(data['Infection'].fillna(0).astype(int) <= 1)]
-
-    # Transform YearOfBirth to 4-digit integer year, missing/invalid as -1
-    def parse_year(y):
-        y_str = str(y)
-        if len(y_str) == 1:
-            return -1
-        try:
-            year = int(y_str[:4])
-            if 1900 <= year <= datetime.datetime.now().year:
-                return year
-        except Exception:
-            pass
-        return -1
-    data['YearOfBirth'] = data['YearOfBirth'].apply(parse_year).astype(int)
-
-    # Enrollment dates: use the specified ISO week list
+    # remove those records (Infection > 1) so we don't double count the deaths.
+    data = vax24_store.load(data_file, ['Gender', 'YearOfBirth', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose',
+                                        'Date_FourthDose', 'Date_FifthDose', 'Date_SixthDose', 'DateOfDeath'],
+                            max_infection=1)
+    print(f"Data loaded with {len(data)} rows and {len(data.columns)} columns")
+
+    # Transform YearOfBirth to 4-digit integer year, missing/invalid as -1 (loaders.NO_YEAR)
+    data['YearOfBirth'] = loaders.decode_yob(data['YearOfBirth'])
+
+    # Enrollment dates: use the specified ISO week list, or with sweep_weeks (first, last) every ISO week
+    # from first to last, e.g. ('2021-01', '2024-40'), written as one compact cube instead of sheets
     enrollment_dates = ['2021-24', '2021-13', '2021-41', '2022-06', '2023-06', '2024-06']
+    if sweep_weeks:
+        enrollment_dates = iso_weeks(*sweep_weeks)
     # enrollment_dates = ['2021-24', '2022-06']   # complete faster for testing
                         
     dose_date_cols = [
@@ -172,84 +177,56 @@ def main(data_file, output_file):
         'Date_FourthDose', 'Date_FifthDose', 'Date_SixthDose'
     ]
 
-    def iso_week_to_date(iso_week_str):
-        # Expects 'YYYY-WW' format, returns pandas Timestamp for consistent comparisons
-        year, week = iso_week_str.split('-')
-        return pd.to_datetime(f'{year}-W{week}-1', format='%G-W%V-%u')
-
     # Dose dates are already pandas Timestamps from the initial conversion, no need to re-convert
     print(f"Dose dates already converted to Timestamps.")
 
-    with ExcelWriter(output_file, engine='xlsxwriter') as writer:
-        for enroll_str in enrollment_dates:
-            print(f"Processing enrollment date {enroll_str} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            enroll_timestamp = iso_week_to_date(enroll_str)
-            
-            # Vectorized dose group assignment using boolean masks
-            print(f"  Computing dose groups vectorized...")
-            df = data.copy()
-            
-            # Create boolean masks for each dose being valid (not null and <= enrollment_date)
-            dose1_valid = data['Date_FirstDose'].notna() & (data['Date_FirstDose'] <= enroll_timestamp)
-            dose2_valid = data['Date_SecondDose'].notna() & (data['Date_SecondDose'] <= enroll_timestamp)
-            dose3_valid = data['Date_ThirdDose'].notna() & (data['Date_ThirdDose'] <= enroll_timestamp)
-            dose4_valid = data['Date_FourthDose'].notna() & (data['Date_FourthDose'] <= enroll_timestamp)
-            dose5_valid = data['Date_FifthDose'].notna() & (data['Date_FifthDose'] <= enroll_timestamp)
-            dose6_valid = data['Date_SixthDose'].notna() & (data['Date_SixthDose'] <= enroll_timestamp)
-            
-            # Start with dose group 0 for everyone
-            df['dose_group'] = 0
-            
-            # Assign higher dose groups based on valid doses (order matters!)
-            df.loc[dose1_valid, 'dose_group'] = 1
-            df.loc[dose2_valid, 'dose_group'] = 2  
-            df.loc[dose3_valid, 'dose_group'] = 3
-            df.loc[dose4_valid, 'dose_group'] = 4
-            df.loc[dose5_valid, 'dose_group'] = 5
-            df.loc[dose6_valid, 'dose_group'] = 6
-            
-            # Cap at 5 (as in original code)
-            df['dose_group'] = df['dose_group'].clip(upper=5)
-            
-            print(f"  Creating one-hot encoding for dose groups...")
-            # One-hot encode dose_group (vectorized)
-            dose_onehot = pd.get_dummies(df['dose_group'], prefix='dose')
-            # Ensure all dose_0 ... dose_6 columns exist
-            for i in range(7):
-                colname = f'dose_{i}'
-                if colname not in dose_onehot:
-                    dose_onehot[colname] = 0
-            # Concatenate one-hot columns
-            df = pd.concat([df, dose_onehot[[f'dose_{i}' for i in range(7)]]], axis=1)
-            
-            print(f"  Grouping and aggregating...")
-            # Group by YearOfBirth, DateOfDeath, Gender and sum dose columns (includes deaths and survivors)
-            group_cols = ['YearOfBirth', 'DateOfDeath', 'Gender']
-            dose_cols = [f'dose_{i}' for i in range(7)]
-            # Now the magic line that does all the work
-            summary = df.groupby(group_cols, dropna=False)[dose_cols].sum().reset_index()
-            # Ensure YearOfBirth is integer and missing is -1
-            summary['YearOfBirth'] = summary['YearOfBirth'].fillna(-1).astype(int)
-            # Add Count column (sum of dose columns per row)
-            summary['Count'] = summary[dose_cols].sum(axis=1)
-            
-            print(f"  Writing to Excel sheet...")
-            # Write to Excel
-            out_cols = group_cols + dose_cols + ['Count']
-            summary[out_cols].to_excel(writer, sheet_name=enroll_str, index=False)
-            print(f"  Completed enrollment date {enroll_str}")
-            print("=" * 50)
+    # Everyone's dose group at every enrollment date at once (see enrollment.py): the people are
+    # grouped by YearOfBirth, DateOfDeath, Gender (includes deaths and survivors) once and the
+    # dose groups are counted for each group from the enrollment index each dose date falls on,
+    # so no copy of the data is made per enrollment date and more dates cost little.
+    # Dose group is the highest dose (1-6) given on or before the enrollment date, 0 if none,
+    # capped at 5 (as in original code).
+    print(f"Computing dose groups for {len(enrollment_dates)} enrollment dates at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    group_cols = ['YearOfBirth', 'DateOfDeath', 'Gender']
+    dose_cols = [f'dose_{i}' for i in range(7)]
+    cube = aggregate.make_cube(data, group_cols)
+    (cell_group, keys) = aggregate.group_cells(cube, group_cols)
+    enroll_timestamps = [date_codec.parse_iso_week(enroll_str) for enroll_str in enrollment_dates]   # 'YYYY-WW' format
+    # Ensure YearOfBirth is integer and missing is -1
+    keys['YearOfBirth'] = keys['YearOfBirth'].fillna(-1).astype(int)
+    if sweep_weeks:
+        write_sweep(output_file, cube, cell_group, keys, [data[col] for col in dose_date_cols], enrollment_dates, enroll_timestamps)
+        return
+
+    counts = enrollment.dose_group_counts(cube.row_cell, len(cube.size), [data[col] for col in dose_date_cols],
+                                          enroll_timestamps, max_group=5, n_groups=len(dose_cols))
+
+    # a table per enrollment date, to the KCOR store (see kcor_store.py) or a sheet each if output_file is an .xlsx
+    writer = kcor_store.writer(output_file)
+    for (k, enroll_str) in enumerate(enrollment_dates):
+        print(f"  Writing enrollment date {enroll_str}...")
+        summary = keys.copy()
+        for (g, col) in enumerate(dose_cols):
+            summary[col] = counts[cell_group, k, g]
+        # Add Count column (sum of dose columns per row)
+        summary['Count'] = summary[dose_cols].sum(axis=1)
+        out_cols = group_cols + dose_cols + ['Count']
+        writer.write(enroll_str, summary[out_cols])
+        print(f"  Completed enrollment date {enroll_str}")
+        print("=" * 50)
+    writer.close()
 
     print(f"Output written to {output_file}")
 
 
 # Entry point for command-line usage
-import sys
+import argparse
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python KCOR.py <input_csv> <output_xlsx>")
-        sys.exit(1)
-    data_file = sys.argv[1]
-    output_file = sys.argv[2]
-    main(data_file, output_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Count people by dose group at each enrollment date, by year of birth, date of death and sex.")
+    parser.add_argument('data_file', help='vax_24.csv or the store made from it (vax24_store.py)')
+    parser.add_argument('output_file', help='the KCOR store (directory) to write, or an .xlsx for a sheet per enrollment date, or with --sweep the cube (.parquet or .csv)')
+    parser.add_argument('--sweep', nargs=2, metavar=('FIRST', 'LAST'), default=None,
+                        help='use every ISO week from FIRST to LAST (e.g. 2021-01 2024-40) as an enrollment date')
+    args = parser.parse_args()
+    main(args.data_file, args.output_file, args.sweep)
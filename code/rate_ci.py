@@ -0,0 +1,76 @@
+# Confidence intervals for Poisson rates, a whole column at a time
+#
+# KCOR_analysis_no_detrend.py computed the CI of each weekly and cumulative
+# death rate with a DataFrame.apply over the rows, importing scipy and
+# calling chi2.ppf once per row. Here the bounds for arrays of deaths D and
+# person time PT come from one chi2.ppf call each (it's a ufunc):
+#   lower = chi2.ppf(alpha/2, 2D) / 2PT
+#   upper = chi2.ppf(1 - alpha/2, 2(D+1)) / 2PT
+# the exact (gamma) interval. With no deaths the lower bound is 0 and the
+# upper -log(alpha)/PT, and rows with no person time (or a NaN) get NaN.
+# Without scipy the log-rate normal approximation is used for D > 0.
+#
+# The age standardized rates (ASMR) were a Python loop over the (date, dose)
+# groups too. direct_standardized puts the deaths and person time into dense
+# (groups x age buckets) matrices and gets every group's weighted rate and
+# delta-method variance, sum((w_i/W)^2 D_i / PT_i^2) over the buckets with
+# person time, from matrix-vector products with the standard weights.
+#
+# Example usage:
+#   (lo, hi) = rate_ci.poisson_rate_ci(agg['deaths'], agg['person_time'])
+#   (asmr, lo, hi) = rate_ci.direct_standardized(group, n_groups, bucket, deaths, person_time, weights)
+
+import numpy as np
+
+try:
+    from scipy.stats import chi2
+except ImportError:
+    chi2 = None
+
+ALPHA = 0.05
+Z = 1.959963984540054   # ~97.5th percentile (two-sided 95%)
+
+
+def poisson_rate_ci(deaths, person_time, alpha=ALPHA):
+    # (lower, upper) float arrays of the 1 - alpha CI of each rate deaths / person_time
+    D = np.asarray(deaths, dtype=np.float64)
+    PT = np.asarray(person_time, dtype=np.float64)
+    lo = np.full(D.shape, np.nan)
+    hi = np.full(D.shape, np.nan)
+    ok = (PT > 0) & ~np.isnan(D)   # a NaN PT fails PT > 0
+    zero = ok & (D == 0)
+    lo[zero] = 0.0
+    hi[zero] = -np.log(alpha) / PT[zero]   # exact upper bound at zero deaths
+    some = ok & (D != 0)
+    (d, pt) = (D[some], PT[some])
+    if chi2 is not None:
+        lo[some] = 0.5 * chi2.ppf(alpha / 2.0, 2.0 * d) / pt
+        hi[some] = 0.5 * chi2.ppf(1.0 - alpha / 2.0, 2.0 * (d + 1.0)) / pt
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            log_rate = np.log(d / pt)
+            se_log = 1.0 / np.sqrt(d)
+        lo[some] = np.exp(log_rate - Z * se_log)
+        hi[some] = np.exp(log_rate + Z * se_log)
+    return (lo, hi)
+
+
+def direct_standardized(group, n_groups, bucket, deaths, person_time, weights, z=Z):
+    # (rate, lower, upper) arrays of the directly standardized rate of each
+    # group with its delta-method CI (lower clipped at 0). Each entry is the
+    # deaths and person time of a group (0 .. n_groups-1) in an age bucket
+    # (index into weights), at most one entry per group and bucket. Buckets
+    # without person time are left out, a group with none at all gets NaN.
+    D = np.zeros((n_groups, len(weights)))
+    PT = np.zeros((n_groups, len(weights)))
+    D[group, bucket] = deaths
+    PT[group, bucket] = person_time
+    w = np.asarray(weights, dtype=np.float64)
+    used = PT > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        W = used @ w
+        rate = np.where(used, D / PT, 0.0) @ w / W
+        var = np.where(used, D / PT ** 2, 0.0) @ (w * w) / (W * W)
+    se = np.sqrt(np.where(var >= 0, var, np.nan))   # NaN if no bucket had person time
+    lo = np.where(np.isnan(se), np.nan, np.fmax(0.0, rate - z * se))
+    return (rate, lo, rate + z * se)
@@ -0,0 +1,190 @@
+# Partitioned Parquet copy of the records file (buckets.py format)
+#
+# The Makefile used to cut records.csv down with awk (extract_vax_year.sh,
+# extract_dose.sh, extract_vax_code.sh), rewriting a multi-GB text file at
+# every step. convert.py --parquet DIR writes the records instead as a
+# Parquet dataset partitioned by vax year, dose and vax code:
+#   DIR/vax_year=2021/Dose_number=2/Vax_code=1/part-0-0.parquet
+# so e.g. the Pfizer dose 2 shots given in 2021 are read straight from their
+# partition. buckets.py, death_rates.py and count_deaths.py take the
+# dataset directory in place of a records file, with the filters
+#   --vax-year 2021 --dose 2 --vax-code 1
+# (each can take several values). Dates are int32 day numbers
+# (date.toordinal()) with NO_DATE for a missing date, vax_year is 0 for
+# rows without a vax date. A dataset is written next to its path and
+# swapped in when complete, and only ever replaces an older dataset, never
+# a directory with other files.
+#
+# Needs pyarrow (pip install pyarrow)
+
+import csv
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+import date_codec
+
+COLUMNS = ['mrn', 'Vax_code', 'Dose_number', 'Vax_date', 'Death_date', 'Vax_name', 'Birth_date']
+PARTITIONS = ['vax_year', 'Dose_number', 'Vax_code']
+DATE_COLUMNS = ['Vax_date', 'Death_date', 'Birth_date']
+
+
+PARTITION_PREFIX = f'{PARTITIONS[0]}='
+
+
+def need_pyarrow():
+    if pa is None:
+        raise ImportError('the Parquet records dataset needs pyarrow (pip install pyarrow)')
+
+
+def is_dataset(path):
+    # a dataset is a directory, a records file is a CSV
+    return os.path.isdir(path)
+
+
+def is_records_dataset(path):
+    # True if path is a directory holding a records dataset and nothing else
+    if not os.path.isdir(path):
+        return False
+    return all(name.startswith(PARTITION_PREFIX) for name in os.listdir(path))
+
+
+def check_replaceable(path):
+    # a dataset can only be written over an old dataset, never over other files
+    if os.path.lexists(path) and not is_records_dataset(path):
+        raise ValueError(f'{path} exists and is not a records dataset, not replacing it')
+
+
+class RecordWriter:
+    # takes the rows convert.py writes (dates as day numbers, '' if
+    # missing) and adds them to the dataset every chunksize rows. The
+    # dataset is built in a temporary directory next to path and only moved
+    # there by close(), replacing an old dataset at path (but nothing else).
+    def __init__(self, path, chunksize=5000000):
+        need_pyarrow()
+        path = os.path.normpath(path)
+        check_replaceable(path)
+        self.path = path
+        self.tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+        self.chunksize = chunksize
+        self.rows = []
+        self.n_parts = 0
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        cols = list(zip(*self.rows))
+        self.rows = []
+        data = {}
+        for (name, values) in zip(COLUMNS, cols):
+            if name in DATE_COLUMNS:
+                data[name] = np.array([date_codec.NO_DATE if v == '' else v for v in values], dtype=np.int32)
+            elif name == 'Vax_name':
+                data[name] = pa.array(values, type=pa.string())
+            elif name == 'mrn':
+                data[name] = np.array(values, dtype=np.int64)
+            else:
+                data[name] = np.array(values, dtype=np.int32)
+        data['vax_year'] = date_codec.years(data['Vax_date'])
+        pq.write_to_dataset(pa.table(data), self.tmp, partition_cols=PARTITIONS,
+                            basename_template=f'part-{self.n_parts}-{{i}}.parquet')
+        self.n_parts += 1
+
+    def close(self):
+        self.flush()
+        check_replaceable(self.path)   # in case something was put there while writing
+        old = None
+        if os.path.lexists(self.path):
+            print(f'replacing {self.path}')
+            old = self.tmp + '.old'
+            os.replace(self.path, old)
+        os.replace(self.tmp, self.path)
+        if old is not None:
+            shutil.rmtree(old)
+
+
+def dataset_filter(vax_year=None, dose=None, vax_code=None):
+    # pyarrow filter expression for the partitions to read, None for all
+    expr = None
+    for (name, value) in zip(PARTITIONS, (vax_year, dose, vax_code)):
+        if value is None:
+            continue
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+        e = ds.field(name).isin(values)
+        expr = e if expr is None else expr & e
+    return expr
+
+
+def open_dataset(path):
+    need_pyarrow()
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+
+def iter_batches(path, columns=COLUMNS, **filters):
+    # dicts of numpy arrays, one per record batch of the matching partitions
+    scanner = open_dataset(path).scanner(columns=columns, filter=dataset_filter(**filters))
+    for batch in scanner.to_batches():
+        if batch.num_rows:
+            yield {name: batch.column(name).to_numpy(zero_copy_only=False) for name in batch.schema.names}
+
+
+def read_records(path, columns=COLUMNS, **filters):
+    # the matching records as one DataFrame
+    return open_dataset(path).to_table(columns=columns, filter=dataset_filter(**filters)).to_pandas()
+
+
+def is_header(row):
+    # True for a header row like mrn,Vax_code,Dose_number,... rather than a record
+    return len(row) > 2 and not row[2].strip().isdigit()
+
+
+def open_rows(path, **filters):
+    # rows of strings like csv.reader gives for a records file (dates as
+    # m/d/Y), from either a records CSV or a dataset. Filters need a dataset.
+    # A header row at the top of a CSV (select_records.py writes one) is
+    # skipped, it's recognized by a dose number that isn't a number.
+    if not is_dataset(path):
+        if any(v is not None for v in filters.values()):
+            raise ValueError(f'{path} is not a records dataset, the --vax-year/--dose/--vax-code filters need one')
+        with open(path, 'r') as file:
+            reader = csv.reader(file)
+            for row in reader:
+                if not is_header(row):
+                    yield row
+                break
+            yield from reader
+        return
+    for batch in iter_batches(path, **filters):
+        cols = []
+        for name in COLUMNS:
+            if name in DATE_COLUMNS:
+                cols.append(date_codec.format_column(batch[name], 'mdy/').tolist())
+            else:
+                cols.append([str(v) for v in batch[name].tolist()])
+        yield from (list(row) for row in zip(*cols))
+
+
+def add_filter_args(parser):
+    # the partition filters as command line options
+    parser.add_argument('--vax-year', type=int, nargs='+', default=None, help='(records dataset) only these vax years')
+    parser.add_argument('--dose', type=int, nargs='+', default=None, help='(records dataset) only these dose numbers')
+    parser.add_argument('--vax-code', type=int, nargs='+', default=None, help='(records dataset) only these vax codes')
+
+
+def filters_from_args(args):
+    return {'vax_year': args.vax_year, 'dose': args.dose, 'vax_code': args.vax_code}
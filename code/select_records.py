@@ -0,0 +1,145 @@
+# Select records from a buckets.py format records file in one pass
+#
+# Does what chaining extract_vax_year.sh, extract_dose.sh and
+# extract_vax_code.sh did (three full scans and two temp files) in one
+# streaming pass, and can combine more conditions:
+#   --vax-year   vax date in one of these years (like extract_vax_year.sh)
+#   --dose       dose number is one of these (like extract_dose.sh)
+#   --vax-code   vax code (buckets.py batch) is one of these (like extract_vax_code.sh)
+#   --vax-name   vax name is one of these
+#   --born       year of birth in this range, inclusive
+# The input can also be a records dataset (see records_store.py), then only
+# the partitions matching --vax-year/--dose/--vax-code are read.
+#
+# Output is CSV with a header on stdout, or with --parquet DIR a Parquet file
+# in DIR (dates as day numbers) that buckets.py, death_rates.py and
+# count_deaths.py read like a records dataset.
+#
+# Example usage:
+# python select_records.py ../data/records.csv --vax-year 2021 --dose 2 --vax-code 1 >../data/pfizer_dose2_21.csv
+# python select_records.py ../data/records.csv --vax-year 2021 --born 1930 1949 --parquet ../data/old_2021
+
+import argparse
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import date_codec
+import records_store
+
+# convert.py writes with csv.writer, which ends lines with \r\n
+LINE_END = '\r\n'
+
+# None means no condition
+Predicate = namedtuple('Predicate', ['vax_year', 'dose', 'vax_code', 'vax_name', 'born'])
+
+
+def matches(cols, pred):
+    # bool mask of the rows that pass every condition. cols has the
+    # records_store columns with the dates as day numbers, the date
+    # columns can be functions that parse them when first needed.
+    n = len(cols['Dose_number'])
+    mask = np.ones(n, dtype=bool)
+    if pred.dose is not None:
+        mask &= np.isin(cols['Dose_number'], pred.dose)
+    if pred.vax_code is not None:
+        mask &= np.isin(cols['Vax_code'], pred.vax_code)
+    if pred.vax_name is not None:
+        mask &= np.isin(cols['Vax_name'], pred.vax_name)
+    if pred.vax_year is not None:
+        mask &= np.isin(date_codec.years(cols['Vax_date']()), pred.vax_year)
+    if pred.born is not None:
+        born = date_codec.years(cols['Birth_date']())
+        mask &= (born >= pred.born[0]) & (born <= pred.born[1])
+    return mask
+
+
+def csv_chunks(fname, chunksize):
+    # (columns, rows as read) for each chunk of a records file. The dates
+    # are only parsed if a condition or the output needs them.
+    date_fmt = None
+    for chunk in pd.read_csv(fname, dtype=str, keep_default_na=False, chunksize=chunksize):
+        raw = [chunk.iloc[:, i].to_numpy() for i in range(len(records_store.COLUMNS))]
+        if date_fmt is None and len(chunk):
+            date_fmt = date_codec.detect_format(raw[6][0])
+        cols = {
+            'mrn': raw[0],
+            'Vax_code': raw[1].astype(np.int64),
+            'Dose_number': raw[2].astype(np.int64),
+            'Vax_name': raw[5],
+        }
+        for (i, name) in [(3, 'Vax_date'), (4, 'Death_date'), (6, 'Birth_date')]:
+            cols[name] = (lambda values=raw[i]: date_codec.parse_column(values, date_fmt))
+        yield (cols, chunk)
+
+
+def dataset_chunks(path, pred):
+    # same as csv_chunks for a records dataset, where the year/dose/code
+    # conditions pick the partitions to read
+    filters = {'vax_year': pred.vax_year, 'dose': pred.dose, 'vax_code': pred.vax_code}
+    for batch in records_store.iter_batches(path, **filters):
+        cols = dict(batch)
+        for name in records_store.DATE_COLUMNS:
+            cols[name] = (lambda values=batch[name]: values)
+        yield (cols, None)
+
+
+def select_records(fname, pred, out_file=sys.stdout, parquet_dir=None, chunksize=1000000):
+    # writes the matching records as CSV to out_file, or to parquet_dir
+    if records_store.is_dataset(fname):
+        chunks = dataset_chunks(fname, pred)
+    else:
+        chunks = csv_chunks(fname, chunksize)
+
+    writer = None
+    n_rows = 0
+    for (cols, raw) in chunks:
+        mask = matches(cols, pred)
+        n_rows += int(np.count_nonzero(mask))
+        if parquet_dir is None and raw is not None:
+            # CSV to CSV, write the rows as they were read
+            raw[mask].to_csv(out_file, header=(writer is None), index=False, lineterminator=LINE_END)
+            writer = out_file
+            continue
+        cols = {name: (col() if callable(col) else col)[mask] for (name, col) in cols.items()}
+        if parquet_dir is None:
+            rows = pd.DataFrame({name: date_codec.format_column(cols[name], 'mdy/') if name in records_store.DATE_COLUMNS
+                                 else cols[name] for name in records_store.COLUMNS})
+            rows.to_csv(out_file, header=(writer is None), index=False, lineterminator=LINE_END)
+            writer = out_file
+            continue
+        if cols['mrn'].dtype == object:
+            try:
+                cols['mrn'] = cols['mrn'].astype(np.int64)
+            except ValueError:
+                pass    # not numeric, keep the strings
+        table = records_store.pa.table({name: cols[name] for name in records_store.COLUMNS})
+        if writer is None:
+            os.makedirs(parquet_dir, exist_ok=True)
+            writer = records_store.pq.ParquetWriter(os.path.join(parquet_dir, 'part-0.parquet'), table.schema)
+        writer.write_table(table.cast(writer.schema))
+    if parquet_dir is not None and writer is not None:
+        writer.close()
+    print(f'{n_rows} records selected', file=sys.stderr)
+    return n_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select records from a buckets.py format records file (or records dataset).")
+    parser.add_argument('fname', help='records file in buckets.py format, or a records dataset directory')
+    parser.add_argument('--vax-year', type=int, nargs='+', default=None, help='vax date in one of these years')
+    parser.add_argument('--dose', type=int, nargs='+', default=None, help='dose number is one of these')
+    parser.add_argument('--vax-code', type=int, nargs='+', default=None, help='vax code (the buckets.py batch) is one of these')
+    parser.add_argument('--vax-name', nargs='+', default=None, help='vax name is one of these')
+    parser.add_argument('--born', type=int, nargs=2, default=None, metavar=('FROM', 'TO'), help='year of birth in this range, inclusive')
+    parser.add_argument('--parquet', metavar='DIR', default=None, help='write a Parquet file to DIR instead of CSV to stdout')
+    parser.add_argument('--chunksize', type=int, default=1000000, help='rows read at a time')
+    args = parser.parse_args()
+
+    pred = Predicate(args.vax_year, args.dose, args.vax_code, args.vax_name, args.born)
+    if args.parquet:
+        records_store.need_pyarrow()
+    select_records(args.fname, pred, parquet_dir=args.parquet, chunksize=args.chunksize)
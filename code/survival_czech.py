@@ -55,6 +55,9 @@ import pandas as pd
 import numpy as np
 from lifelines import KaplanMeierFitter
 
+import date_codec
+import vax24_store
+
 data_file='../data/vax_24.csv'
 data_file='../data/vax_24_head20k.csv' # for debug
 output_file = '../data/suvival.csv'
@@ -87,42 +90,19 @@ index_fields = ['YearOfBirth', 'VaccineCode_FirstDose', 'VaccineCode_ThirdDose',
 import itertools
 
 def main(data_file, output_file):
-    # Load the CSV file into a DataFrame. 
-    # I have plenty of memory so let pandas know that to avoid type errors on dose 6 which happens later in the fil
-
-    data = pd.read_csv(data_file, low_memory=False)
-
-    # rename the columns in English
-    data.columns = [
-        'ID', 'Infection', 'Gender', 'YearOfBirth', 'DateOfPositiveTest', 'DateOfResult', 'Recovered', 'Date_COVID_death',
-        'Symptom', 'TestType', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose',
-        'Date_FifthDose', 'Date_SixthDose', 'Date_SeventhDose', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose',
-        'VaccineCode_ThirdDose', 'VaccineCode_FourthDose', 'VaccineCode_FifthDose', 'VaccineCode_SixthDose',
-        'VaccineCode_SeventhDose', 'PrimaryCauseHospCOVID', 'bin_Hospitalization', 'min_Hospitalization',
-        'days_Hospitalization', 'max_Hospitalization', 'bin_ICU', 'min_ICU', 'days_ICU', 'max_ICU', 'bin_StandardWard',
-        'min_StandardWard', 'days_StandardWard', 'max_StandardWard', 'bin_Oxygen', 'min_Oxygen', 'days_Oxygen',
-        'max_Oxygen', 'bin_HFNO', 'min_HFNO', 'days_HFNO', 'max_HFNO', 'bin_MechanicalVentilation_ECMO',
-        'min_MechanicalVentilation_ECMO', 'days_MechanicalVentilation_ECMO', 'max_MechanicalVentilation_ECMO',
-        'Mutation', 'DateOfDeath', 'Long_COVID', 'DCCI']
-
-    # Transform YearOfBirth to extract the first year as an integer, handling missing or invalid entries
-    data['YearOfBirth'] = data['YearOfBirth'].str.split('-').str[0].replace('', None).dropna().astype('Int32')
-
-    # Transform the VaccineCode columns to clean then up
-    # remove leading and trailing spaces, convert to uppercase so can be found in dictionary
-    brand_cols=['VaccineCode_FirstDose']
-    for col in brand_cols:
-        data[col] = data[col].str.strip().str.upper()
+    # Load the columns we need. data_file can be the vax_24 store (see vax24_store.py) or vax_24.csv itself.
+    # Either way the columns are named in English, YearOfBirth is the first year of the range,
+    # the VaccineCode columns are cleaned up (stripped and upper cased, categorical) and the dates are converted
+    # from the YYYY-WW ISO week format.
+    data = vax24_store.load(data_file, ['YearOfBirth', 'DateOfPositiveTest', 'Date_COVID_death', 'Date_FirstDose',
+                                        'Date_ThirdDose', 'VaccineCode_FirstDose', 'VaccineCode_ThirdDose', 'DateOfDeath'])
 
     # Ensure Infection is an integer (empty=0)
     # data['Infection'] = data['Infection'].fillna(0).astype('Int32')
 
-    # Convert dates from YYYY-WW format to pandas datetime format
+    # the dates are compared with datetime.date (see date_range), so remove the time part of the date
     for col in ['Date_COVID_death', 'DateOfPositiveTest', 'DateOfDeath', 'Date_FirstDose', 'Date_ThirdDose']:
-        data[col] = pd.to_datetime(data[col] + '-1', format='%G-%V-%u', errors='coerce').dt.date
-    # the dt.date will remove the time part of the date so things are cleaner. The  ISO format adds the time.
-    # %G-%V-%u because the Czech data uses ISO 8601 weeks
-    # format='%Y-%W-%w' was incorrect
+        data[col] = date_codec.date_objects(data[col])
 
     # Create 'died_in_NCmonth' column for deaths between May 30, 2021, and Oct 12, 2021 (inclusive)
     # data['died_in_NCmonth_2021'] = data['DateOfDeath'].apply(lambda x: 1 if pd.notna(x) and pd.Timestamp('2021-05-30') <= x <= pd.Timestamp('2021-10-12') else 0)
@@ -182,8 +162,9 @@ def main(data_file, output_file):
     # this is when we were counting date value_fields= ['Date_COVID_death', 'DateOfDeath']    
     # summary_df = data.groupby(index_fields)[value_fields].count().reset_index() 
     # make sure both have dropna=False!!
-    summary_df = data.groupby(index_fields, dropna=False)[value_fields].sum().reset_index()     
-    summary_df['Count'] = data.groupby(index_fields, dropna=False).size().values   # append a count column
+    # observed=True so only the combinations that are in the data are output (the codes are categorical)
+    summary_df = data.groupby(index_fields, dropna=False, observed=True)[value_fields].sum().reset_index()     
+    summary_df['Count'] = data.groupby(index_fields, dropna=False, observed=True).size().values   # append a count column
 
     # now modify the labels to be more user friendly. Will replace blank with blank
     from mfg_codes import MFG_DICT
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Checks the buckets.py counting engines against make_buckets_by_day, the
+original day by day version, on a small synthetic records file.
+
+to run: cd code; python -m pytest -q test_buckets.py
+"""
+
+import contextlib
+import datetime
+import io
+import random
+
+import pytest
+
+import buckets
+
+
+def write_records(path, n_people=80, seed=1):
+    # a records file in buckets.py format (what convert.py writes): an unvaxxed
+    # row and a row per dose, some people dead, some shots on the same day or
+    # after the death date. Every third person has no unvaxxed row, as in the
+    # NZ files, since n_vax only picks people whose doses are numbered from 1.
+    # make_buckets_by_day stops at the first month nobody died in, so the
+    # first 30 people die one a month from Jan 2020.
+    rng = random.Random(seed)
+    day0 = datetime.date(2021, 1, 1)
+
+    def fmt(d):
+        return f'{d.month}/{d.day}/{d.year}' if d else ''
+
+    rows = ['mrn,Vax_code,Dose_number,Vax_date,Death_date,Vax_name,Birth_date']
+    for pid in range(1, n_people + 1):
+        birth = datetime.date(rng.randint(1930, 2000), 1, 1)
+        if pid <= 30:
+            death = datetime.date(2020 + (pid - 1) // 12, (pid - 1) % 12 + 1, rng.randint(1, 28))
+        else:
+            death = day0 + datetime.timedelta(days=rng.randint(0, 600)) if rng.random() < 0.4 else None
+        if pid % 3:
+            rows.append(f'{pid},0,0,1/1/2020,{fmt(death)},U,{fmt(birth)}')
+        shot = day0 + datetime.timedelta(days=rng.randint(0, 200))
+        for dose in range(1, rng.choice([0, 1, 2, 2, 3, 4]) + 1):
+            code = rng.randint(1, 3)
+            rows.append(f'{pid},{code},{dose},{fmt(shot)},{fmt(death)},Vax{code},{fmt(birth)}')
+            shot += datetime.timedelta(days=rng.choice([0, 21, 28, 90, 180]))
+    path.write_text('\n'.join(rows) + '\n')
+
+
+@pytest.fixture
+def records(tmp_path):
+    # the records file, read into buckets.py's globals (reset first) and as People arrays
+    fname = tmp_path / 'records.csv'
+    write_records(fname)
+    for g in (buckets.vax_dates, buckets.death_dates, buckets.vax_age, buckets.all_people,
+              buckets.vaxxed_people, buckets.unvaxxed_people, buckets.all_dates):
+        g.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        buckets.read_nov9_csv(str(fname))
+        people = buckets.read_nov9_columnar(str(fname), chunksize=50)
+    return people
+
+
+def quiet(f, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f(*args, **kwargs)
+
+
+@pytest.mark.parametrize('n_vax', [None, 2])
+def test_engines_match_by_day(records, n_vax):
+    people = records
+    reference = quiet(buckets.make_buckets_by_day, n_vax=n_vax)
+    assert reference[0]
+    assert quiet(buckets.make_buckets, n_vax=n_vax) == reference
+    keep = buckets.select_people_columnar(people, n_vax=n_vax)
+    assert buckets.bucket_table_to_dicts(quiet(buckets.make_buckets_columnar, people, keep)) == reference
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3])
+def test_sharded_matches_by_day(records, workers):
+    people = records
+    reference = quiet(buckets.make_buckets_by_day)
+    assert sum(reference[1].values()) > 0
+    keep = buckets.select_people_columnar(people)
+    assert buckets.bucket_table_to_dicts(quiet(buckets.make_buckets_sharded, people, keep, workers)) == reference
+
+
+def test_groupings_match_regroup_buckets(records):
+    (alive_ct, dead_ct) = quiet(buckets.make_buckets_by_day)
+    table = buckets.dicts_to_bucket_table(alive_ct, dead_ct)
+    for (name, g) in buckets.GROUPINGS.items():
+        (keys, alive, dead) = buckets.regroup_table(table, g.key)
+        (ref_alive, ref_dead) = (alive_ct, dead_ct) if g.key is None else buckets.regroup_buckets(alive_ct, dead_ct, g.key)
+        got = list(zip(zip(*(k.tolist() for k in keys)), alive.tolist(), dead.tolist()))
+        assert got == [(key, ref_alive[key], ref_dead[key]) for key in sorted(ref_alive)], name
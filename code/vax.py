@@ -28,8 +28,13 @@ see group_cols below for the full list
 
 import pandas as pd
 import csv # for the quoting option on output
+import sys
 from datetime import timedelta
 
+import aggregate
+import horizons
+import loaders
+
 # time window for deaths in summary stats
 # so we can compare deaths for 90, 180, 270, etc. days from FIRST shot
 # thresholds=[90, 180, 270, 365, 455, 545, 635, 730]
@@ -61,26 +66,17 @@ def read_csv(file_path=source_file):
                      ]
     
     # the date_ columns (shot dates and the death date) are actual date objects which I later convert to strings in a later phase.
-    # Note the parse_dates argument to the read_csv.
+    # The other columns are categorical and yob is int16 (see loaders.py), which keeps the frame small.
     # new_cols must be exactly lined up to the list of selected columns
     new_cols = ['sex', 'yob', 'dod_', 
                 'date_1_', 'batch_1', 'brand_1', 
                 'date_2_', 'batch_2', 'brand_2', 
                 'date_3_', 'batch_3', 'brand_3']
 
-    # Read the CSV file into a DataFrame
-    df = pd.read_csv(file_path, usecols=selected_cols, 
-                     dtype={'OckovaciLatka_1':str, 'OckovaciLatka_2':str, 'OckovaciLatka_3':str,
-                            'Sarze_1': str, 'Sarze_2': str, 'Sarze_3': str
-                            },
-                     parse_dates=['DatumUmrti', 'Datum_1', 'Datum_2', 'Datum_3'])
-    # rename the columns
-    df.columns = new_cols
-    shot_batch_cols = ['batch_1', 'batch_2', 'batch_3']
-    
-    # now need to upper case everything and remove leading and trailing spaces
-    for col in shot_batch_cols:
-      df[col] = df[col].str.strip().str.upper()
+    # Read the CSV file into a DataFrame and rename the columns
+    # file_path can be the .xz file, it's read in blocks parsed in parallel
+    # the batch columns are upper cased with leading and trailing spaces removed as they're read
+    df = loaders.load_cr(file_path, selected_cols, new_cols)
 
     print("adding death columns...")
     # add shot death stats from last date of shot BEFORE we do the grouping!
@@ -101,12 +97,12 @@ def read_csv(file_path=source_file):
     # since grouping by single data would be overwhelming
     # df['month_year'] = df['date'].dt.strftime('%m-%Y')
     for old, new in [('dod_', 'month_of_death'), ('date_1_', 'date_1'), ('date_2_', 'date_2'),('date_3_', 'date_3')]:
-        df[new] = df[old].dt.strftime('%m-%Y')  
+        df[new] = loaders.date_labels(df[old], '%m-%Y')   # categorical, each month is formatted once
 
     # Create age column with 5 year age ranges
     # So grouping by age creates fewer categories in the index
-    df['age'] = ((2024 - df['yob']) // 5) * 5
-    df['age'] = df['age'].astype(str) + ' - ' + (df['age'] + 4).astype(str)
+    codes, ages = pd.factorize(((2024 - df['yob']) // 5) * 5)
+    df['age'] = loaders.categorical(codes, ages.astype(str) + ' - ' + (ages + 4).astype(str))
 
     # ok so this is our final source dataframe with lots of info.
     # so we can do various groupby analyses on it.
@@ -134,21 +130,22 @@ def add_death_cols(df, dod_col, shot_date_cols):
   # First, if you are NOT vaccinated, then let's pretend your vax date is Jan 1, 2020
   # and we'll set the type to UNVAXXED. fillna means fill only if empty.
   df['date_1_'] = df['date_1_'].fillna(pd.Timestamp('2020-01-01'))
-  df['brand_1'] = df['brand_1'].fillna('UNVAXXED')
+  df['brand_1'] = loaders.add_categories(df['brand_1'], ['UNVAXXED']).fillna('UNVAXXED')
 
   # now compute death outcomes for doses 1 to 3
   for dose in range(1,4):
     df[f'days_until_death_from_d{dose}'] = (df[dod_col] - df[f'date_{dose}_']).dt.days.round(0)
 
-    # now create boolean columns for each record indicating where the death was (90 days, 180 days, etc.)
-    for threshold in thresholds:
-      df[f'death_within_{threshold}d_d{dose}'] = df[f'days_until_death_from_d{dose}'] <= threshold
+    # now record which threshold the death was within (90 days, 180 days, etc.) as one small bin number
+    # per record: died within thresholds[i] days (and so all the later ones) if the bin is <= i, 
+    # len(thresholds) means no death within any of them. analyze() turns the bins into the counts.
+    df[f'death_bin_d{dose}'] = horizons.horizon_bins(df[f'days_until_death_from_d{dose}'].to_numpy(), thresholds)
 
   # Group by specified columns and sum the boolean columns
   # result = df.groupby(group_cols)[['death_within_3m', 'death_within_6m', 'death_within_9m', 'death_within_12m']].sum().reset_index()
   return df
 
-def analyze(df, group_cols):
+def analyze(cube, death_hists, group_cols):
     # this function basically does the groupings and adds the count column(s) for the two different
     # output styles vax1 and vax2.
     # vax1 output includes month of death, so lots more rows in the group
@@ -156,23 +153,25 @@ def analyze(df, group_cols):
     # vax3 is like vax2, but with single digit age ranges
     # print("grouping by", group_cols)
     # Define the grouping columns
+    # The groups are summed up from the cube of all the grouping columns (see aggregate.py) rather than
+    # from the records, death_hists has the death bins counted by cube cell for each dose.
 
     # Normally, we are looking at 1 year mortality from time of shot
     # But if month_of_death is included in the index, we just outout the # of people who have that combination in the index
 
+    # Important to include empty values as a permissiable value for the index (e.g., third shot is blank) (like groupby dropna=False)
+    # this is critical so we get all combos, not just people who got 3 shots!
+    (cell_group, summary_df) = aggregate.group_cells(cube, group_cols)
+    n_groups = len(summary_df)
+
     if 'month_of_death' in group_cols:
       # Calculate summary statistics (# shots, # comorbidities)
-      # Important to include empty values as a permissiable value for the index (e.g., third shot is blank) (dropna=False)
-      # specifying dropna is critical so we get all combos, not just people who got 3 shots!
-      summary_df = df.groupby(group_cols, dropna=False).agg(
-        count_of_dead_or_survived=('yob', 'size')  # of people who got that exact combination 
-        # CAUTION!!! If the index has a date of death filled in, count=# deaths
-        # if the index has NO date of death, then these are people who got shot who did NOT die
-        # i.e., who survived
-        # to find the total number of people who got shot that month, you must add up all the alive
-        # people and all the dead people who got shot in that month. It's tricky!
-
-      ).reset_index()
+      summary_df['count_of_dead_or_survived'] = aggregate.group_sum(cell_group, n_groups, cube.size)  # of people who got that exact combination 
+      # CAUTION!!! If the index has a date of death filled in, count=# deaths
+      # if the index has NO date of death, then these are people who got shot who did NOT die
+      # i.e., who survived
+      # to find the total number of people who got shot that month, you must add up all the alive
+      # people and all the dead people who got shot in that month. It's tricky!
     else:
       # OK, month of death isn't in group by, so this is our chance to create columns for deaths 
       # count number of people who died within N months of the most recent shot in this row
@@ -182,16 +181,17 @@ def analyze(df, group_cols):
 
       print("grouping and calculating deaths within N months for various N")
       # Group by specified columns and calculate counts and total
-      summary_df = df.groupby(group_cols, dropna=False).agg(
-        shots=('yob', 'size'),  # this is # shots given (size of the group identified by the index)
-        # now add the deaths for the different time thresholds after dose 1, dose 2, dose 3, ...
-        # (90 days, 180 days, etc)
-        # now add additional columns for dose 1 death thresholds, then dose 2 deaths thresholds, etc.
-        **{f'deaths_within_{threshold}d_d{dose}': (f'death_within_{threshold}d_d{dose}', 'sum') 
-           for dose in range(1,4) 
-           for threshold in thresholds  # thresholds will vary the fastest so output will be dose (slow vary) and threshold days (30, 90 days etc)
-          } 
-        ).reset_index()
+      summary_df['shots'] = aggregate.group_sum(cell_group, n_groups, cube.size)  # this is # shots given (size of the group identified by the index)
+      # now add the deaths for the different time thresholds after dose 1, dose 2, dose 3, ...
+      # (90 days, 180 days, etc): a histogram of the death bins for each group, cumulated over the thresholds
+      deaths = {}
+      for dose in range(1,4):
+        (cells, bins, counts) = death_hists[dose]
+        counts = horizons.cumulative_counts(cell_group[cells], n_groups, bins, len(thresholds), counts)
+        # thresholds will vary the fastest so output will be dose (slow vary) and threshold days (30, 90 days etc)
+        for (i, threshold) in enumerate(thresholds):
+          deaths[f'deaths_within_{threshold}d_d{dose}'] = counts[:, i]
+      summary_df = pd.concat([summary_df, pd.DataFrame(deaths)], axis=1)
       
       # print("done grouping...")
 
@@ -257,19 +257,23 @@ group_cols = (['sex', 'age', 'date_1', 'date_2', 'date_3', 'brand_1', 'brand_2',
 # 
 
 # Start executing here
-# Note that the input filename is hardcoded
+# The input filename defaults to source_file, or give it as the argument (e.g. ../data/CR_records.csv.xz)
 # read_csv will read in the file, change column names, add the death columns (for up to three doses)
 # so we will be set up for various groupings
-df=read_csv() 
+df=read_csv(sys.argv[1] if len(sys.argv) > 1 else source_file)
 
 # analyze two ways: one allows you to filter on death month, 
 # the other computes leaves the death month out of the group and sums the death count for 3,6,9,12 months after the shot () plus avg days until death
 suffix=1
 
+# count the records once by every combination of the grouping columns, each output is summed up from that
+cube=aggregate.make_cube(df, list(dict.fromkeys(col for cols in group_cols for col in cols)))
+death_hists={dose: aggregate.cell_histogram(cube, df[f'death_bin_d{dose}'].to_numpy(), len(thresholds)) for dose in range(1,4)}
+
 # write out .csv files for each group type: 
 # vax1.csv is for month of deeath in the index (for granualar analysis but TRICKY to use)
 # others where we count the deaths in first 90, 180, etc. days since the shot given to a person in the group
 for cols in group_cols:
-  df2=analyze(df, cols)
+  df2=analyze(cube, death_hists, cols)
   write_df_to_csv(df2, output_path+str(suffix)+'.csv')   # write it out
   suffix+=1
@@ -0,0 +1,190 @@
+# Canonical typed copy of vax_24.csv (the Nov 2024 Czech data)
+#
+# vax_24.py, cfr_by_wave.py, czech_ACM.py, survival_czech.py, old/KCOR.py
+# and czech_tte_prepare_inputs.py each read the whole raw CSV, renamed the
+# 53 Czech columns to English, parsed the ISO week dates and the year of
+# birth ranges and cleaned the vaccine codes, every run. The ingest step here
+# does that once (see loaders.py for the types) and writes a Parquet file,
+# dictionary encoded and zstd compressed, so each script reads just the
+# columns it needs. The file's metadata records the source file, its sha256
+# and the transforms applied, so a stale store can be spotted.
+#
+# Transforms (rows are kept as they are, nothing is dropped):
+#   - columns named in English (loaders.VAX24_COLUMNS)
+#   - YearOfBirth is the first year of the range (Int16)
+#   - VaccineCode_* stripped and upper cased (categorical)
+#   - Date* are the Monday of the ISO week (datetime64)
+# Scripts that drop the people infected more than once (duplicate records
+# with a different ID) use load(..., max_infection=1).
+#
+# load() also takes the raw vax_24.csv, so the scripts accept either.
+# iter_load() gives the same a chunk of rows at a time, for machines
+# without the memory for the whole file.
+#
+# Example usage (run from the code directory):
+#   python vax24_store.py ingest ../data/vax_24.csv ../data/vax_24.parquet
+#   python vax24_store.py info ../data/vax_24.parquet
+#   python vax24_store.py verify ../data/vax_24.parquet ../data/vax_24.csv
+#   python vax_24.py ../data/vax_24.parquet ../data/vax_24_summary.csv
+#
+# Needs pyarrow (pip install pyarrow)
+
+import argparse
+import datetime
+import json
+import os
+import sys
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+import bucket_cache
+import loaders
+
+# bump when the transforms change so old stores are rebuilt
+STORE_FORMAT = 1
+
+# key of our entry in the Parquet file's metadata
+META_KEY = b'vax24_store'
+
+TRANSFORMS = [
+    'columns named in English (loaders.VAX24_COLUMNS)',
+    'YearOfBirth: first year of the range, Int16',
+    'VaccineCode_*: stripped and upper cased, categorical',
+    'Date*: Monday of the ISO week, datetime64',
+    'other columns: smallest int type, or float32 if there are missing values',
+]
+
+
+def need_pyarrow():
+    if pa is None:
+        raise ImportError('the vax_24 store needs pyarrow (pip install pyarrow)')
+
+
+def is_store(path):
+    # a store is a Parquet file, anything else is taken to be vax_24.csv
+    return path.endswith('.parquet')
+
+
+def ingest(source, path, workers=None):
+    # reads vax_24.csv (can be the .xz) and writes the store to path
+    need_pyarrow()
+    print(f'reading {source}')
+    data = loaders.load_vax24(source, loaders.VAX24_COLUMNS, workers)
+    meta = {
+        'format': STORE_FORMAT,
+        'source': os.path.abspath(source),
+        'source_sha256': bucket_cache.file_hash(source),
+        'source_size': os.path.getsize(source),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'rows': len(data),
+        'transforms': TRANSFORMS,
+    }
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, META_KEY: json.dumps(meta).encode()})
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp, compression='zstd')
+    os.replace(tmp, path)
+    print(f'wrote {len(data)} rows to {path}')
+    return meta
+
+
+def info(path):
+    # the metadata ingest recorded
+    need_pyarrow()
+    return json.loads(pq.read_schema(path).metadata[META_KEY])
+
+
+def read_columns(columns, max_infection):
+    # the columns to read, Infection too if filtering on it
+    read = list(columns)
+    if max_infection is not None and 'Infection' not in read:
+        read.append('Infection')
+    return read
+
+
+def finish(data, columns, max_infection):
+    # data as load returns it: categories sorted, filtered on Infection, just the columns
+    for col in data.columns:
+        if isinstance(data[col].dtype, pd.CategoricalDtype) and not data[col].cat.categories.is_monotonic_increasing:
+            # the dictionaries can come back in another order, keep them sorted
+            data[col] = data[col].cat.reorder_categories(data[col].cat.categories.sort_values())
+    if max_infection is not None:
+        data = data[data['Infection'].fillna(0) <= max_infection].reset_index(drop=True)
+    return data[list(columns)]
+
+
+def load(path, columns, max_infection=None, workers=None):
+    # DataFrame of the columns (English names) from a store, or from the raw
+    # vax_24.csv if path isn't a store. With max_infection only the rows with
+    # Infection (empty is 0) at most that are kept.
+    read = read_columns(columns, max_infection)
+    if is_store(path):
+        need_pyarrow()
+        data = pq.read_table(path, columns=read).to_pandas()
+    else:
+        data = loaders.load_vax24(path, read, workers)
+    return finish(data, columns, max_infection)
+
+
+def iter_load(path, columns, chunksize, max_infection=None):
+    # the same as load, as DataFrames of up to chunksize rows (before the
+    # Infection filter) so the whole file is never in memory. Each chunk
+    # has its own categories.
+    read = read_columns(columns, max_infection)
+    if is_store(path):
+        need_pyarrow()
+        store = pq.ParquetFile(path)
+        # the pandas metadata makes the columns come back with the types they were written with
+        metadata = store.schema_arrow.metadata
+        for batch in store.iter_batches(batch_size=chunksize, columns=read):
+            yield finish(pa.Table.from_batches([batch]).replace_schema_metadata(metadata).to_pandas(), columns, max_infection)
+    else:
+        for data in loaders.iter_vax24(path, read, chunksize):
+            yield finish(data, columns, max_infection)
+
+
+def verify(path, source=None):
+    # problems with the store (empty list if none), checking it against source if given
+    meta = info(path)
+    problems = []
+    if meta['format'] != STORE_FORMAT:
+        problems.append(f"store format {meta['format']}, this code writes {STORE_FORMAT}")
+    source = source or meta['source']
+    if not os.path.exists(source):
+        problems.append(f'source {source} not found')
+    elif os.path.getsize(source) != meta['source_size'] or bucket_cache.file_hash(source) != meta['source_sha256']:
+        problems.append(f'{source} has changed since the store was made')
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make and check the typed Parquet copy of vax_24.csv.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('ingest', help='write the store from vax_24.csv')
+    p.add_argument('source', help='vax_24.csv (can be the .xz)')
+    p.add_argument('store', help='the .parquet file to write')
+    p.add_argument('--workers', type=int, default=None, help='processes parsing the CSV (default all cores)')
+    p = sub.add_parser('info', help='show what the store was made from')
+    p.add_argument('store')
+    p = sub.add_parser('verify', help='check the store is up to date with its source')
+    p.add_argument('store')
+    p.add_argument('source', nargs='?', default=None, help='the vax_24.csv to check against (default the one it was made from)')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        ingest(args.source, args.store, args.workers)
+    elif args.command == 'info':
+        print(json.dumps(info(args.store), indent=2))
+    elif args.command == 'verify':
+        problems = verify(args.store, args.source)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print('ok')
@@ -34,56 +34,74 @@
 # data.dtypes() to print out datatypes
 import pandas as pd
 
+import aggregate
+import horizons
+import loaders
+import vax24_store
+
 data_file='../data/vax_24.csv'
 # data_file='../data/sample.csv'
 output_file = '../data/vax_24_summary.csv'
 
+# generates all these but outputs only those items listed in value_fields
+day_list=[30, 60, 90,180,270,360,450,540,630,720]  
+
+# low COVID windows, the column is 1 if the person died in the window
+NC_WINDOWS = {'died_in_NCmonth_2021': ('2021-05-30', '2021-10-12'),
+              'died_in_NCmonth_2022': ('2022-05-10', '2022-07-10')}
+
+
+# the columns read from the file
+COLUMNS = ['Infection', 'YearOfBirth', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose',
+           'VaccineCode_FirstDose', 'VaccineCode_SecondDose', 'VaccineCode_ThirdDose', 'DateOfDeath', 'DCCI']
+
+# Define the index and value fields
+index_fields = ['YearOfBirth', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose', 'VaccineCode_ThirdDose', 'Date_FirstDose', 'Infection', 'DCCI']
+# list here the ones to output even though all are generated for all 3 doses
+value_fields = ['Countd1', 'Died_30d1', 'Died_60d1', 'Died_90d1', 'Died_180d1', 'Died_270d1', 'Died_360d1',
+                'Died_450d1', 'Died_540d1', 'Died_630d1', 'Died_720d1', 
+                'Countd2', 'Died_90d2', 'Died_180d2', 'Died_270d2', 'Died_360d2', 
+                'Countd3', 'Died_90d3', 'Died_180d3', 'Died_270d3', 'Died_360d3',
+                'died_in_NCmonth_2021', 'died_in_NCmonth_2022']  # this is set if the person died in a low COVID month
+
+doses=['d1', 'd2','d3']
+dose_dict={'d1':'FirstDose','d2':'SecondDose', 'd3':'ThirdDose'}
+
+
+def main(data_file, output_file, chunksize=None):
+    # Load the columns we use into a DataFrame with compact types (see loaders.py): the vaccine codes
+    # are categorical (stripped and upper cased), YearOfBirth is the first year of the range, the dates are
+    # converted from the ISO week format. Columns are named in English. data_file can be the
+    # vax_24 store (see vax24_store.py), which skips parsing the CSV, or vax_24.csv itself.
+    # With chunksize the file is read that many rows at a time and the group sums of the chunks are
+    # added up (aggregate.GroupSum), so memory goes with the number of groups instead of the people.
+    # Every step before the groupby is done record by record so the result is the same.
+    # records with a missing index field are left out, as groupby does by default
+    total = aggregate.GroupSum(index_fields, value_fields, dropna=True)
+    if chunksize:
+        for data in vax24_store.iter_load(data_file, COLUMNS, chunksize):
+            total.add(add_fields(data))
+    else:
+        total.add(add_fields(vax24_store.load(data_file, COLUMNS)))
+    summary_df = total.result()
 
-def main(data_file, output_file):
-    # Load the CSV file into a DataFrame. 
-    # I have plenty of memory so let pandas know that to avoid type errors on dose 6 which happens later in the file
-    data = pd.read_csv(data_file, low_memory=False)
-
-    # rename the columns in English
-    data.columns = [
-        'ID', 'Infection', 'Gender', 'YearOfBirth', 'DateOfPositiveTest', 'DateOfResult', 'Recovered', 'Deceased',
-        'Symptom', 'TestType', 'Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose',
-        'Date_FifthDose', 'Date_SixthDose', 'Date_SeventhDose', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose',
-        'VaccineCode_ThirdDose', 'VaccineCode_FourthDose', 'VaccineCode_FifthDose', 'VaccineCode_SixthDose',
-        'VaccineCode_SeventhDose', 'PrimaryCauseHospCOVID', 'bin_Hospitalization', 'min_Hospitalization',
-        'days_Hospitalization', 'max_Hospitalization', 'bin_ICU', 'min_ICU', 'days_ICU', 'max_ICU', 'bin_StandardWard',
-        'min_StandardWard', 'days_StandardWard', 'max_StandardWard', 'bin_Oxygen', 'min_Oxygen', 'days_Oxygen',
-        'max_Oxygen', 'bin_HFNO', 'min_HFNO', 'days_HFNO', 'max_HFNO', 'bin_MechanicalVentilation_ECMO',
-        'min_MechanicalVentilation_ECMO', 'days_MechanicalVentilation_ECMO', 'max_MechanicalVentilation_ECMO',
-        'Mutation', 'DateOfDeath', 'Long_COVID', 'DCCI']
-
-
-    # Define the index and value fields
-    index_fields = ['YearOfBirth', 'VaccineCode_FirstDose', 'VaccineCode_SecondDose', 'VaccineCode_ThirdDose', 'Date_FirstDose', 'Infection', 'DCCI']
-    # list here the ones to output even though all are generated for all 3 doses
-    value_fields = ['Countd1', 'Died_30d1', 'Died_60d1', 'Died_90d1', 'Died_180d1', 'Died_270d1', 'Died_360d1',
-                    'Died_450d1', 'Died_540d1', 'Died_630d1', 'Died_720d1', 
-                    'Countd2', 'Died_90d2', 'Died_180d2', 'Died_270d2', 'Died_360d2', 
-                    'Countd3', 'Died_90d3', 'Died_180d3', 'Died_270d3', 'Died_360d3',
-                    'died_in_NCmonth_2021', 'died_in_NCmonth_2022']  # this is set if the person died in a low COVID month
-
-    # Transform YearOfBirth to extract the first year as an integer, handling missing or invalid entries
-    data['YearOfBirth'] = data['YearOfBirth'].str.split('-').str[0].replace('', None).dropna().astype('Int32')
-
-    # Transform the VaccineCode columns to clean then up
-    # remove leading and trailing spaces, convert to uppercase so can be found in dictionary
-    brand_cols=['VaccineCode_FirstDose', 'VaccineCode_SecondDose', 'VaccineCode_ThirdDose']
-    for col in brand_cols:
-        data[col] = data[col].str.strip().str.upper()
+    # now modify the labels to be more user friendly
+    from mfg_codes import MFG_DICT
 
-    # Ensure Infection is an integer (empty=0)
-    data['Infection'] = data['Infection'].fillna(0).astype('Int32')
+    # Transform VaccineCode_xxxDose using the dictionary so have friendly names.
+    for d in doses:
+        summary_df['VaccineCode_'+dose_dict[d]] = summary_df['VaccineCode_'+dose_dict[d]].map(MFG_DICT) 
 
-    # Convert dates from YYYY-WW format to pandas datetime format
-    for col in ['Date_FirstDose', 'Date_SecondDose','Date_ThirdDose', 'DateOfDeath']:
-        data[col] = pd.to_datetime(data[col] + '-1', format='%G-%V-%u', errors='coerce')
-    # %G-%V-%u because the Czech data uses ISO 8601 weeks
-    # format='%Y-%W-%w' was incorrect
+    # Write the summary DataFrame to a CSV file
+    summary_df.to_csv(output_file, index=False)
+
+    print(f"Summary file has been written to {output_file}.")
+
+
+def add_fields(data):
+    # the records to count (those with a first dose, real or PLACEBO) with the value_fields added
+    # Ensure Infection is an integer (empty=0)
+    data['Infection'] = data['Infection'].fillna(0).astype('int16')
 
     # For rows with no doses and death date >= 2022-01, set Date_FirstDose 
     # and VaccineCode_FirstDose to 2022 to avoid the effect where in 2021, people more 
@@ -95,23 +113,19 @@ def main(data_file, output_file):
     # this avoids picking people who were unvaxxed because they died before they could get their vaccine
     # which artificially increases deaths in the unvaccinated (think EVERYONE wanted to be vaxxed and you only didn't get 
     # vaxxed if you died.)
+    data['VaccineCode_FirstDose'] = loaders.add_categories(data['VaccineCode_FirstDose'], ['PLACEBO'])
     data.loc[
     data[['Date_FirstDose', 'Date_SecondDose', 'Date_ThirdDose', 'Date_FourthDose']].isna().all(axis=1) & 
         (data['DateOfDeath'].fillna(pd.Timestamp('2099-01-01')) > pd.Timestamp('2022-01-01')),
         ['Date_FirstDose', 'VaccineCode_FirstDose']] = [pd.Timestamp('2022-01-01'), 'PLACEBO']
 
-    # Create 'died_in_NCmonth' column for deaths between May 30, 2021, and Oct 12, 2021 (inclusive)
-    data['died_in_NCmonth_2021'] = data['DateOfDeath'].apply(lambda x: 1 if pd.notna(x) and pd.Timestamp('2021-05-30') <= x <= pd.Timestamp('2021-10-12') else 0)
-    data['died_in_NCmonth_2022'] = data['DateOfDeath'].apply(lambda x: 1 if pd.notna(x) and pd.Timestamp('2022-05-10') <= x <= pd.Timestamp('2022-07-10') else 0)
+    # Create 'died_in_NCmonth' columns for deaths in the low COVID windows in NC_WINDOWS (inclusive)
+    for (name, died) in horizons.in_windows(data['DateOfDeath'], NC_WINDOWS).items():
+        data[name] = died
     
     #  Drop rows without a first dose. We need to count everyone who got a dose, dead or alive. We gave unvaxxed people a "PLACEBO" does in Jan 2022.
     data = data.dropna(subset=['Date_FirstDose'])
 
-    doses=['d1', 'd2','d3']
-    dose_dict={'d1':'FirstDose','d2':'SecondDose', 'd3':'ThirdDose'}
-    # generates all these but outputs only those items listed above in value_fields
-    day_list=[30, 60, 90,180,270,360,450,540,630,720]  
-
     # Compute days till death (dtd) and convert to int32. do for each dose.
     # also create count for each dose
     # Original code: 
@@ -120,44 +134,31 @@ def main(data_file, output_file):
         data['dt'+d] = (data['DateOfDeath'] - data['Date_'+dose_dict[d]]).dt.days.astype('Int32')
         data['Count'+d] = data['Date_'+dose_dict[d]].notna().astype(int)  # Count for each dose
 
-    # Compute the Died_xxdx fields using the dtdx column
+    # Compute the Died_xxdx fields using the dtdx column, all the days in day_list at once
     # make sure that x >=0  so that people can't be vaccinated after they die
     for d in doses:
-        for day in day_list:
-            data['Died_'+str(day)+d] = data['dt'+d].apply(lambda x: 1 if pd.notna(x) and x >= 0 and x <= day else 0)
+        for (day, died) in horizons.within_horizons(data['dt'+d], day_list, lower=0).items():
+            data['Died_'+str(day)+d] = died
 
     # effectively creates lines like these
     # data['Died_180d1'] = data['dtd1'].apply(lambda x: 1 if pd.notna(x) and x <= 180 else 0)
 
     # groupby only summarizes fields with values so ensure that the Code fields have a value "NONE"
     VaccineCode_fields=['VaccineCode_SecondDose', 'VaccineCode_ThirdDose']
-    data[VaccineCode_fields] = data[VaccineCode_fields].fillna('NONE')
-
-    # Perform group_by with aggregation. This does all the heavy lifting!
-    summary_df = data.groupby(index_fields)[value_fields].sum().reset_index()
-
-    # now modify the labels to be more user friendly
-    from mfg_codes import MFG_DICT
-
-    # Transform VaccineCode_xxxDose using the dictionary so have friendly names.
-    for d in doses:
-        summary_df['VaccineCode_'+dose_dict[d]] = summary_df['VaccineCode_'+dose_dict[d]].map(MFG_DICT) 
-
-    # Write the summary DataFrame to a CSV file
-    summary_df.to_csv(output_file, index=False)
-
-    print(f"Summary file has been written to {output_file}.")
+    for col in VaccineCode_fields:
+        data[col] = loaders.add_categories(data[col], ['NONE']).fillna('NONE')
 
+    return data
 
-import sys
 
-# Check for command-line arguments
-if len(sys.argv) != 3:
-    print("Usage: python script.py <source_file> <output_file>")
-    sys.exit(1)
+import argparse
 
-# Command-line arguments
-data_file = sys.argv[1]
-output_file = sys.argv[2]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize vax_24.csv (or its store) by birth year, vaccine codes, first dose date, infection and DCCI.")
+    parser.add_argument('data_file', help='vax_24.csv or the store made from it (vax24_store.py)')
+    parser.add_argument('output_file', help='the summary CSV to write')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='read this many records at a time to bound memory (default the whole file at once)')
+    args = parser.parse_args()
 
-main(data_file, output_file)
\ No newline at end of file
+    main(args.data_file, args.output_file, args.chunksize)
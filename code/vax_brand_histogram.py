@@ -1,26 +1,35 @@
 # I wrote this code to look at the CR data and compute historgrams for what is in there.
-# this only works if the csv.xz file is uncompressed
-# this happens in the make process.
+# It reads the csv.xz file directly (or the uncompressed csv), so no need to uncompress it first.
+# python vax_brand_histogram.py [data/CR_records.csv.xz]
+
+import sys
 
 import pandas as pd
 
+import xz_reader
+
 # Specify the path to your CSV file
-csv_filename = "data/CR_records.csv"
+csv_filename = "data/CR_records.csv.xz"
 
 def histogram(csv_file):
-    # Read the CSV file into a pandas DataFrame
-    df = pd.read_csv(csv_file)
-
     # select the column for dose 1, 2, 3 (start at column 5 and increment by 4 stopping at 14)
     # which are the 3 most interesting doses
-    for col in range(5, 14, 4):
+    cols = list(range(5, 14, 4))
+    counts = [[] for _ in cols]
+
+    # Read the file in blocks and count each block
+    for df in xz_reader.iter_chunks(csv_file, usecols=cols, dtype=str):
+        for (i, col) in enumerate(cols):
+            counts[i].append(df.iloc[:, i].value_counts())
+
+    for c in counts:
         # Calculate the histogram of for the vaccine types
-        value_counts = df.iloc[:, col].value_counts()  # Access column 3 using index
+        value_counts = pd.concat(c).groupby(level=0).sum().sort_values(ascending=False, kind='stable')
 
         # Print the histogram (number of occurrences for each unique value)
         print(value_counts)
 
-histogram(csv_filename)
+histogram(sys.argv[1] if len(sys.argv) > 1 else csv_filename)
 
 """
 Here's the output:
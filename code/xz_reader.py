@@ -0,0 +1,92 @@
+# Streaming reader for the CR records file, compressed or not
+#
+# The scripts used to need CR_records.csv expanded on disk (make uncompress)
+# and each re-read the multi-GB text file. This reads CR_records.csv.xz (or
+# the plain CSV) as a stream: the text is cut into blocks of whole lines,
+# the blocks are parsed by pd.read_csv in a pool of worker processes, and
+# the DataFrames come back in file order. xz decompression itself is one
+# stream, so it runs in this process while the workers parse.
+#
+# Lines are cut at newlines, so quoted fields must not contain newlines
+# (the CR file doesn't have any).
+#
+# Example usage:
+#   for df in xz_reader.iter_chunks('../data/CR_records.csv.xz', usecols=['DatumUmrti'], dtype=str):
+#       ...
+#   for row in xz_reader.iter_rows('../data/CR_records.csv.xz'):   # lists of strings like csv.reader
+#       ...
+
+import io
+import lzma
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+# uncompressed bytes per block handed to a worker
+CHUNK_BYTES = 64 << 20
+
+
+def open_source(fname):
+    # binary stream of the uncompressed text
+    if fname.endswith('.xz'):
+        return lzma.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def line_blocks(f, chunk_bytes=CHUNK_BYTES):
+    # blocks of about chunk_bytes that end at a line end
+    rest = b''
+    while True:
+        block = f.read(chunk_bytes)
+        if not block:
+            if rest:
+                yield rest
+            return
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            rest = block
+            continue
+        rest = block[cut:]
+        yield block[:cut]
+
+
+def parse_block(args):
+    # worker: the header line plus a block of lines -> DataFrame
+    (header, block, read_csv_args) = args
+    return pd.read_csv(io.BytesIO(header + block), **read_csv_args)
+
+
+def iter_chunks(fname, workers=None, chunk_bytes=CHUNK_BYTES, **read_csv_args):
+    # DataFrames for consecutive blocks of the file, parsed with
+    # pd.read_csv(**read_csv_args) (usecols, dtype, parse_dates, ...)
+    workers = workers or os.cpu_count() or 1
+    with open_source(fname) as f:
+        header = f.readline()
+        blocks = line_blocks(f, chunk_bytes)
+        if workers <= 1:
+            for block in blocks:
+                yield parse_block((header, block, read_csv_args))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # keep a couple of blocks per worker in flight so memory stays bounded
+            pending = deque()
+            for block in blocks:
+                pending.append(pool.submit(parse_block, (header, block, read_csv_args)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def read_all(fname, workers=None, **read_csv_args):
+    # the whole file as one DataFrame, like pd.read_csv
+    return pd.concat(iter_chunks(fname, workers, **read_csv_args), ignore_index=True)
+
+
+def iter_rows(fname, workers=None):
+    # the data rows (no header) as lists of strings, like csv.reader gives
+    for df in iter_chunks(fname, workers, dtype=str, keep_default_na=False):
+        yield from df.fillna('').values.tolist()